@@ -1,17 +1,83 @@
+import time
+T_ARRANQUE = time.perf_counter() # inicio del proceso, para el reporte de tiempos de arranque
 
-
-from dash import Dash, html, dcc, Input, Output, State ,ctx
+from dash import Dash, html, dcc, Input, Output, State ,ctx, ClientsideFunction, callback, clientside_callback, MATCH, ALL
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
-import pandas as pd
-import plotly.express as px
 import os
+import json
+import io
+import tempfile
+import shutil
+import math
+import gzip
+import hashlib
+import pickle
+import sqlite3
+import select
+import importlib
+import importlib.util
+import flask
+import argparse
 from dotenv import load_dotenv
 import psycopg2
-import geopandas as gpd
-import sys
+import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.errors
+from psycopg2 import sql
+import logging
+import threading
+import contextvars
+import functools
+import copy
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
 import warnings
 warnings.filterwarnings('ignore')
 
+log = logging.getLogger('dashboard')
+
+arranque = {} # etapa -> segundos del arranque del proceso, se reporta en el log, en /ready y en /metrics
+
+class ModuloPerezoso:
+    """ 
+    Modulo que se importa hasta que se usa uno de sus atributos
+
+    Args:
+        nombre (str) -> nombre del modulo, p. ej. 'geopandas'
+    """
+
+    def __init__(self, nombre):
+        self._nombre = nombre
+        self._modulo = None
+
+    def _cargar(self):
+        """ 
+        Returns:
+            (obj) -> el modulo, importado la primera vez
+        """
+        if self._modulo is None:
+            t0 = time.perf_counter()
+            self._modulo = importlib.import_module(self._nombre) # el lock de importacion de python serializa a los hilos
+            arranque.setdefault('import ' + self._nombre, time.perf_counter() - t0)
+            log.info('%s importado en %.2f s', self._nombre, time.perf_counter() - t0)
+        return self._modulo
+
+    def __getattr__(self, atributo):
+        return getattr(self._cargar(), atributo)
+
+# pandas, numpy, plotly y geopandas tardan cerca de un segundo en importarse y el layout no los necesita,
+# se importan con la primera consulta o figura (o en /ready, que los precalienta)
+pd = ModuloPerezoso('pandas')
+np = ModuloPerezoso('numpy')
+px = ModuloPerezoso('plotly.express')
+go = ModuloPerezoso('plotly.graph_objects')
+escalas = ModuloPerezoso('plotly.colors')
+gpd = ModuloPerezoso('geopandas')
+
+arranque['importaciones'] = time.perf_counter() - T_ARRANQUE
+
 #funciones
 # -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 #**************************************************************************#
@@ -23,48 +89,571 @@ warnings.filterwarnings('ignore')
 #╚═╝      ╚═════╝ ╚═╝  ╚═══╝ ╚═════╝   ╚═╝   ╚═╝ ╚═════╝ ╚═╝  ╚═══╝╚══════╝#
 #**************************************************************************#
 
-def connect(params_dic):
+class ConexionPreparada(psycopg2.extensions.connection):
+    """ Conexion de psycopg2 que recuerda las sentencias preparadas de su sesion de postgres (ver preparada) """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas = set()
+
+class PoolConexiones:
     """ 
-    Generar la coneccion con la base de datos
+    Pool de conexiones a PostgreSQL compartido entre hilos
+
+    Las conexiones se abren hasta que se piden por primera vez. Cada prestamo revisa que la conexion
+    siga viva y, si se cayo, la reemplaza por una nueva sin tumbar el proceso.
 
     Args:
         params_dic (dic) -> diccionario con los datos que se usan para la conecicon
+        minimo (int) -> numero de conexiones que se mantienen abiertas
+        maximo (int) -> numero maximo de conexiones prestadas al mismo tiempo
+        espera (float) -> segundos maximos que se espera por una conexion libre
+    """
+
+    def __init__(self, params_dic, minimo = 1, maximo = 10, espera = 30):
+        self.params_dic = params_dic
+        self.minimo = minimo
+        self.maximo = maximo
+        self.espera = espera
+
+        self._pool = None
+        self._pid = os.getpid()
+        self._heredados = [] # pools heredados de un fork, nunca se cierran desde el proceso hijo
+        self._lock = threading.Lock()
+        self._libres = threading.BoundedSemaphore(maximo) # bloquea cuando todas las conexiones estan prestadas
+        self.al_prestar = None # funcion opcional que recibe el pid del backend en cada prestamo
+        self._metricas = {
+            'prestamos': 0,
+            'en_uso': 0,
+            'reconexiones': 0,
+            'agotado': 0,
+            'espera_total': 0.0,
+            'espera_max': 0.0
+            }
+
+    def _revisar_fork(self):
+        # los callbacks en segundo plano corren en procesos hijos: las conexiones heredadas comparten socket con
+        # el padre, asi que el hijo arranca un pool propio y guarda el heredado sin cerrarlo (cerrarlo tumbaria
+        # las conexiones del padre)
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._heredados.append(self._pool)
+            self._pool = None
+            self._lock = threading.Lock()
+            self._libres = threading.BoundedSemaphore(self.maximo)
+            self._metricas['en_uso'] = 0
+
+    def _iniciar(self):
+        # el pool se crea hasta el primer prestamo para no conectar al importar la app
+        with self._lock:
+            if self._pool is None:
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.minimo, self.maximo, connection_factory = ConexionPreparada,
+                                                                  **self.params_dic)
+        return self._pool
+
+    @staticmethod
+    def _sana(conn):
+        """ 
+        Revisa que la conexion siga respondiendo
+
+        Args:
+            conn (obj) -> coneccion a base de datos
+
+        Returns:
+            (bool) -> True si la conexion responde
+        """
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        """ 
+        Presta una conexion sana del pool, esperando si todas estan ocupadas
+
+        Returns:
+            (obj) -> coneccion a base de datos
+        """
+        self._revisar_fork()
+        t0 = time.perf_counter()
+
+        if not self._libres.acquire(timeout = self.espera):
+            with self._lock:
+                self._metricas['agotado'] += 1
+            raise psycopg2.pool.PoolError('no hay conexiones libres despues de {} s'.format(self.espera))
+
+        try:
+            pool = self._iniciar()
+            conn = pool.getconn()
+            reconexion = False
+
+            if not self._sana(conn): # se descarta la conexion caida y se abre una nueva
+                log.warning('conexion caida en el pool, reconectando...')
+                pool.putconn(conn, close = True)
+                conn = pool.getconn()
+                reconexion = True
+        except Exception:
+            self._libres.release()
+            raise
+
+        espera = time.perf_counter() - t0
+
+        with self._lock:
+            self._metricas['prestamos'] += 1
+            self._metricas['en_uso'] += 1
+            self._metricas['reconexiones'] += int(reconexion)
+            self._metricas['espera_total'] += espera
+            self._metricas['espera_max'] = max(self._metricas['espera_max'], espera)
+
+        if self.al_prestar is not None:
+            self.al_prestar(conn.get_backend_pid())
+
+        return conn
+
+    def putconn(self, conn, close = False):
+        """ 
+        Regresa una conexion al pool
+
+        Args:
+            conn (obj) -> coneccion a base de datos prestada por getconn
+            close (bool) -> si es True la conexion se cierra en lugar de reutilizarse
+        """
+        try:
+            self._pool.putconn(conn, close = close or bool(conn.closed))
+        finally:
+            with self._lock:
+                self._metricas['en_uso'] -= 1
+            self._libres.release()
+
+    @contextmanager
+    def conexion(self):
+        """ 
+        Presta una conexion durante un bloque with y la regresa al terminar
+
+        Returns:
+            (obj) -> coneccion a base de datos
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def metricas(self):
+        """ 
+        Estadisticas de uso del pool
+
+        Returns:
+            (dic) -> prestamos, conexiones en uso, reconexiones, veces agotado y tiempos de espera en segundos
+        """
+        with self._lock:
+            m = dict(self._metricas)
+        m['espera_prom'] = m['espera_total'] / m['prestamos'] if m['prestamos'] else 0.0
+        return m
+
+    def cerrar(self):
+        """ Cierra todas las conexiones del pool """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.closeall()
+                self._pool = None
+
+TIPOS_NUMERICOS_DUCKDB = r'^(U?(TINY|SMALL|BIG|HUGE)?INT(EGER)?|FLOAT|REAL|DOUBLE|DECIMAL)' #data_type de information_schema en DuckDB
+
+class BackendDuckDB:
+    """
+    Backend local de solo lectura: DuckDB sobre archivos Parquet/GeoParquet en lugar de PostgreSQL
+
+    Cada archivo <tabla>.parquet del directorio se expone como la vista "<esquema>"."<tabla>", asi las mismas
+    queries compuestas (psycopg2.sql) de mapa, grafica, cubo y exportacion corren sin cambios (ver texto_duckdb).
+    Las capas de geometria son GeoParquet con la columna 'geom' en WKB y EPSG:4326, y las descripciones de
+    las columnas se leen de descripciones.json ({tabla: {columna: descripcion}}). El directorio se arma
+    desde postgres con 'python app.py parquet'. No hay tablas pre-agregadas ni teselas de manzanas.
+
+    Se usa en lugar del pool en las funciones que reciben 'conn': query_columnas, postgresql_to_dataframe,
+    postgresql_to_GEOdataframe y filas_exportacion pasan la consulta a este objeto.
+
+    Args:
+        directorio (str) -> carpeta con los archivos Parquet
+        esquema (str) -> string con el nombre del esquema con el que se nombran las vistas
+        hilos (int) -> hilos de DuckDB, si es None usa todos los nucleos
+    """
+
+    def __init__(self, directorio, esquema = 'Dashboards', hilos = None):
+        import duckdb # opcional, solo se necesita con BACKEND=duckdb
+
+        self._duckdb = duckdb
+        self.directorio = directorio
+        self.esquema = esquema
+        self.hilos = hilos
+        self.tablas = {os.path.splitext(a)[0]: os.path.join(directorio, a) # tabla -> ruta del archivo
+                       for a in sorted(os.listdir(directorio)) if a.endswith('.parquet')}
+
+        ruta = os.path.join(directorio, 'descripciones.json')
+        self._descripciones = {}
+        if os.path.exists(ruta):
+            with open(ruta, encoding = 'utf-8') as f:
+                self._descripciones = json.load(f)
+
+        self._abrir()
+        log.info('backend duckdb en %s: %s', directorio, sorted(self.tablas))
+
+    def _abrir(self):
+        # base en memoria con una vista por archivo; se vuelve a abrir en un proceso hijo (callbacks en fondo)
+        self._pid = os.getpid()
+        self._db = self._duckdb.connect(':memory:')
+
+        if self.hilos:
+            self._db.execute('SET threads = {}'.format(int(self.hilos)))
+        try: # la geometria se lee como WKB aunque este cargada la extension spatial
+            self._db.execute('SET enable_geoparquet_conversion = false')
+        except self._duckdb.Error:
+            pass
+
+        self._db.execute(texto_duckdb(sql.SQL('CREATE SCHEMA IF NOT EXISTS {}').format(sql.Identifier(self.esquema))))
+        for tabla, ruta in self.tablas.items():
+            self._db.execute(texto_duckdb(sql.SQL('CREATE VIEW {}.{} AS SELECT * FROM read_parquet({})').format(
+                sql.Identifier(self.esquema), sql.Identifier(tabla), sql.Literal(ruta))))
+
+    @contextmanager
+    def _cursor(self):
+        # cada consulta usa su propio cursor, la conexion de DuckDB no se comparte entre hilos
+        if self._pid != os.getpid():
+            self._abrir()
+        c = self._db.cursor()
+        try:
+            yield c
+        finally:
+            c.close()
+
+    def dataframe(self, select_query, tipos = None):
+        """
+        Args:
+            select_query (obj) -> query compuesto (psycopg2.sql) o string
+            tipos (dic) -> esquema de tipos {columna: dtype} para las columnas que se deben convertir
+
+        Returns:
+            (obj) -> DataFrame con el resultado, ya tipado por DuckDB
+        """
+        with self._cursor() as c:
+            df = c.execute(texto_duckdb(select_query)).df()
+        return df.astype({k: v for k, v in (tipos or {}).items() if k in df.columns})
+
+    def geodataframe(self, select_query, geom = 'geom'):
+        """
+        Args:
+            select_query (obj) -> query compuesto (psycopg2.sql) o string sobre una capa GeoParquet
+            geom (str) -> columna con la geometria en WKB
+
+        Returns:
+            (obj) -> GeoDataFrame con el resultado
+        """
+        df = self.dataframe(select_query)
+        df[geom] = gpd.GeoSeries.from_wkb(df[geom].map(bytes))
+        return gpd.GeoDataFrame(df, geometry = geom, crs = 'EPSG:4326')
+
+    def bloques(self, select_query, tamano = 5000):
+        """
+        Args:
+            select_query (obj) -> query compuesto (psycopg2.sql) o string
+            tamano (int) -> filas por bloque, se redondea a los vectores de 2048 filas de DuckDB
+
+        Returns:
+            (generator) -> DataFrames con el resultado por partes
+        """
+        with self._cursor() as c:
+            c.execute(texto_duckdb(select_query))
+            while True:
+                df = c.fetch_df_chunk(max(1, tamano // 2048))
+                if df.empty:
+                    break
+                yield df
+
+    def columnas(self, esquema, tabla, numericas = False):
+        """
+        Args:
+            esquema (str) -> string con el nombre del esquema
+            tabla (str) -> nombre de la tabla de datos
+            numericas (bool) -> si es True solo regresa las columnas numericas
+
+        Returns:
+            (list) -> columnas de la tabla que empiezan con mayuscula, en el orden del archivo
+        """
+        with self._cursor() as c:
+            df = c.execute("""SELECT column_name, data_type FROM information_schema.columns
+                                WHERE table_schema = ? AND table_name = ? ORDER BY ordinal_position""", [esquema, tabla]).df()
+
+        df = df[df['column_name'].str.match('^[A-Z]')]
+        if numericas:
+            df = df[df['data_type'].str.match(TIPOS_NUMERICOS_DUCKDB)]
+        return df['column_name'].to_list()
+
+    def descripciones(self, tabla):
+        """
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+
+        Returns:
+            (dic) -> {columna: descripcion} de descripciones.json
+        """
+        return dict(self._descripciones.get(tabla, {}))
+
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) #limites de los histogramas de latencia
+CUBETAS_BYTES = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7, 5e7) #limites de los histogramas de tamano de respuesta
+
+callback_actual = contextvars.ContextVar('callback_actual', default = None) # callback de mapas en curso, etiqueta las consultas a los caches
+
+class Metricas:
+    """ 
+    Histogramas y contadores en memoria, expuestos en el formato de texto de Prometheus por la ruta /metrics
+
+    Los histogramas son acumulativos como los de Prometheus, asi el p99 se obtiene con histogram_quantile.
+    Cada proceso lleva sus propias metricas; los procesos de los callbacks en segundo plano las vuelcan al
+    terminar en un almacen compartido que el proceso web suma a las suyas en /metrics.
+
+    Args:
+        compartido (obj) -> diskcache.Cache opcional donde se acumulan las metricas de otros procesos
+    """
+
+    def __init__(self, compartido = None):
+        self.compartido = compartido
+
+        self._histogramas = {} # nombre -> {etiquetas: [cubetas, conteos acumulados, suma, total]}
+        self._contadores = {} # nombre -> {etiquetas: valor}
+        self._lock = threading.Lock()
+
+    def observar(self, nombre, valor, cubetas = CUBETAS_SEGUNDOS, **etiquetas):
+        """ 
+        Agrega una observacion a un histograma
+
+        Args:
+            nombre (str) -> nombre de la metrica
+            valor (float) -> valor observado
+            cubetas (tuple) -> limites superiores de las cubetas
+            etiquetas (str) -> etiquetas de la serie
+        """
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            h = self._histogramas.setdefault(nombre, {}).setdefault(clave, [cubetas, [0] * len(cubetas), 0.0, 0])
+            for i, limite in enumerate(h[0]):
+                if valor <= limite:
+                    h[1][i] += 1
+            h[2] += valor
+            h[3] += 1
+
+    def contar(self, nombre, n = 1, **etiquetas):
+        """ 
+        Suma a un contador
+
+        Args:
+            nombre (str) -> nombre de la metrica
+            n (float) -> cantidad que se suma
+            etiquetas (str) -> etiquetas de la serie
+        """
+        clave = tuple(sorted(etiquetas.items()))
+        with self._lock:
+            serie = self._contadores.setdefault(nombre, {})
+            serie[clave] = serie.get(clave, 0) + n
+
+    def reiniciar(self):
+        """ Descarta las metricas del proceso, p. ej. las heredadas del proceso web por un trabajo en segundo plano """
+        with self._lock:
+            self._histogramas = {}
+            self._contadores = {}
+
+    @staticmethod
+    def _sumar(histogramas, contadores, otros_histogramas, otros_contadores):
+        # suma las series de otros_* en histogramas y contadores, que se modifican
+        for nombre, series in otros_histogramas.items():
+            destino = histogramas.setdefault(nombre, {})
+            for clave, (cubetas, conteos, suma, total) in series.items():
+                h = destino.get(clave)
+                if h is None or tuple(h[0]) != tuple(cubetas): # cubetas distintas no se pueden sumar, gana la ultima
+                    destino[clave] = [cubetas, list(conteos), suma, total]
+                else:
+                    h[1] = [a + b for a, b in zip(h[1], conteos)]
+                    h[2] += suma
+                    h[3] += total
+
+        for nombre, series in otros_contadores.items():
+            destino = contadores.setdefault(nombre, {})
+            for clave, valor in series.items():
+                destino[clave] = destino.get(clave, 0) + valor
+
+    def volcar(self):
+        """ 
+        Pasa las metricas del proceso al almacen compartido y las descarta, para no contarlas dos veces
+        """
+        if self.compartido is None:
+            return
+
+        with self._lock:
+            histogramas, contadores = self._histogramas, self._contadores
+            self._histogramas, self._contadores = {}, {}
+
+        with self.compartido.transact():
+            acumulado = self.compartido.get('metricas', ({}, {}))
+            self._sumar(*acumulado, histogramas, contadores)
+            self.compartido.set('metricas', acumulado)
+
+    @staticmethod
+    def _etiquetas(pares):
+        # {a="x",b="y"} escapando comillas, diagonales y saltos de linea
+        if not pares:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                              for k, v in pares) + '}'
+
+    def texto(self, instantaneas = ()):
+        """ 
+        Metricas en formato de texto de Prometheus
+
+        Args:
+            instantaneas (list) -> tuplas (nombre, tipo, etiquetas, valor) que se leen al momento, p. ej. del pool
+
+        Returns:
+            (str) -> cuerpo de la respuesta de /metrics
+        """
+        lineas = []
+        histogramas, contadores = {}, {}
+
+        with self._lock: # copia para sumar lo de otros procesos sin tocar las series propias
+            self._sumar(histogramas, contadores, self._histogramas, self._contadores)
+
+        if self.compartido is not None:
+            try:
+                self._sumar(histogramas, contadores, *self.compartido.get('metricas', ({}, {})))
+            except Exception as error: # sin el almacen se exponen solo las metricas del proceso web
+                log.warning('no se pudieron leer las metricas de los trabajos en segundo plano: %s', error)
+
+        for nombre, series in sorted(histogramas.items()):
+            lineas.append('# TYPE {} histogram'.format(nombre))
+            for clave, (cubetas, conteos, suma, total) in series.items():
+                for limite, conteo in zip(cubetas, conteos):
+                    lineas.append('{}_bucket{} {}'.format(nombre, self._etiquetas(clave + (('le', repr(float(limite))),)), conteo))
+                lineas.append('{}_bucket{} {}'.format(nombre, self._etiquetas(clave + (('le', '+Inf'),)), total))
+                lineas.append('{}_sum{} {!r}'.format(nombre, self._etiquetas(clave), suma))
+                lineas.append('{}_count{} {}'.format(nombre, self._etiquetas(clave), total))
+
+        for nombre, series in sorted(contadores.items()):
+            lineas.append('# TYPE {} counter'.format(nombre))
+            for clave, valor in series.items():
+                lineas.append('{}{} {}'.format(nombre, self._etiquetas(clave), valor))
+
+        anterior = None
+        for nombre, tipo, etiquetas, valor in sorted(instantaneas, key = lambda m: m[0]): # cada familia debe ir junta
+            if tipo == 'counter' and not nombre.endswith('_total'):
+                nombre = nombre + '_total'
+            if nombre != anterior:
+                anterior = nombre
+                lineas.append('# TYPE {} {}'.format(nombre, tipo))
+            lineas.append('{}{} {}'.format(nombre, self._etiquetas(tuple(sorted(etiquetas.items()))), valor))
+
+        return '\n'.join(lineas) + '\n'
+
+def medir(funcion):
+    """ 
+    Decorador de las funciones que consultan la base de datos: registra en metricas el tiempo de cada
+    llamada, las filas traidas y los errores (tambien los que se regresan como mensaje)
+
+    Args:
+        funcion (function) -> funcion de consulta
 
     Returns:
-        (obj) -> coneccion a base de datos
+        (function) -> funcion medida
     """
-    conn = None
-    try:
-        # connect to the PostgreSQL server
-        conn = psycopg2.connect(**params_dic)
-    except (Exception, psycopg2.DatabaseError) as error:
-        sys.exit(1) 
-    return conn
+    @functools.wraps(funcion)
+    def medida(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            r = funcion(*args, **kwargs)
+        except Exception:
+            metricas.contar('dashboard_db_errores_total', funcion = funcion.__name__)
+            raise
+        finally:
+            metricas.observar('dashboard_db_segundos', time.perf_counter() - t0, funcion = funcion.__name__)
+
+        if isinstance(r, str): # las funciones de consulta regresan el mensaje de error en lugar de lanzarlo
+            metricas.contar('dashboard_db_errores_total', funcion = funcion.__name__)
+        else:
+            metricas.contar('dashboard_db_filas_total', len(r), funcion = funcion.__name__)
+        return r
+
+    return medida
+
+def medir_callback(funcion):
+    """ 
+    Decorador del cuerpo de los callbacks de mapas: registra en metricas el tiempo de calculo y deja el nombre
+    del callback en callback_actual para etiquetar las consultas a los caches. Mide lo mismo si el callback corre
+    en el proceso web o en segundo plano, donde la peticion HTTP regresa antes de que termine el calculo.
+
+    Args:
+        funcion (function) -> cuerpo del callback
+
+    Returns:
+        (function) -> funcion medida
+    """
+    @functools.wraps(funcion)
+    def medida(*args, **kwargs):
+        token = callback_actual.set(funcion.__name__)
+        t0 = time.perf_counter()
+        try:
+            return funcion(*args, **kwargs)
+        except PreventUpdate:
+            raise
+        except Exception:
+            metricas.contar('dashboard_callback_errores_total', callback = funcion.__name__)
+            raise
+        finally:
+            metricas.observar('dashboard_callback_calculo_segundos', time.perf_counter() - t0, callback = funcion.__name__)
+            callback_actual.reset(token)
+
+    return medida
+
+def contar_consulta_cache(cache, hit):
+    """ 
+    Cuenta una consulta a un cache hecha desde un callback de mapas, etiquetada con el nombre del callback
 
+    Args:
+        cache (str) -> nombre del cache
+        hit (bool) -> si el valor estaba guardado
+    """
+    callback = callback_actual.get()
+    if callback is not None and cache is not None:
+        metricas.contar('dashboard_cache_consultas_total', cache = cache, callback = callback, resultado = 'hit' if hit else 'miss')
+
+@medir
 def query_columnas(conn,esquema = 'Dashboards', datos = 'caracteristicas_poblacionales'):
     """ 
     Obtencion de columnas del tema especificado
 
     Args:
-        conn (obj) -> coneccion a base de datos
+        conn (obj) -> pool de conexiones a base de datos
         esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
         datos (str) -> nombre de la tabla a la que se piden las columnas
 
     Returns:
-        (str) -> cadena de caracteres con el query para obtener las columnas de una tabla.
+        (list) -> columnas de la tabla que empiezan con mayuscula
     """
 
-    Q = """SELECT * FROM (                                                
+    Q = sql.SQL("""SELECT * FROM (                                                
         SELECT column_name FROM information_schema.columns                
-            WHERE table_schema = '{}' AND table_name   = '{}') as tab     
-                WHERE column_name ~ '^[A-Z].*$' ;""".format(esquema,datos) #  se genera el query para obtener las columnas de cada base de datos  
+            WHERE table_schema = {} AND table_name   = {}) as tab     
+                WHERE column_name ~ '^[A-Z].*$'""").format(sql.Literal(esquema), sql.Literal(datos)) #  se genera el query para obtener las columnas de cada base de datos  
     
-    cursor = conn.cursor()
-    try: 
-        df = pd.read_sql(Q, con=conn) #se transfiere el query a un DF de pandas
+    if isinstance(conn, BackendDuckDB):
+        return conn.columnas(esquema, datos)
+
+    try: # sin base de datos el prestamo de la conexion tambien falla
+        with conn.conexion() as c:
+            df = pd.read_sql(texto_query(c, Q), con=c) #se transfiere el query a un DF de pandas
     except: 
         return "Error: en query_columnas"
-    cursor.close()
 
     return df['column_name'].to_list() # se regresa el DF como una lista
 
@@ -74,11 +663,12 @@ def col_description_query(tabla= 'caracteristicas_poblacionales',esquema='Dashbo
     Args:
         tabla (str) -> string con el nombre de la tabla de datos de donde se obtienen las columnas
         esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
-        cols (list) -> Lista con strings de cada nombre de columna a obtener 
-    
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) con las columnas 'col' y 'description'
     '''
 
-    QQ = """
+    QQ = sql.SQL("""
 
     select * FROM (
 
@@ -86,20 +676,52 @@ def col_description_query(tabla= 'caracteristicas_poblacionales',esquema='Dashbo
     FROM pg_catalog.pg_description AS d
     LEFT JOIN information_schema.columns AS c ON
       c.ordinal_position = d.objsubid
-      AND c.table_name = '{}'
+      AND c.table_name = {tabla}
     WHERE objoid = (
       SELECT oid
       FROM pg_class
-      WHERE relname = '{}' AND relnamespace = (
-        SELECT oid FROM pg_catalog.pg_namespace WHERE nspname = '{}'
+      WHERE relname = {tabla} AND relnamespace = (
+        SELECT oid FROM pg_catalog.pg_namespace WHERE nspname = {esquema}
       )
     )
-    	) as tt ;
+    	) as tt
 
-    """.format(tabla,tabla,esquema)
+    """).format(tabla = sql.Literal(tabla), esquema = sql.Literal(esquema))
 
     return QQ
 
+ESTADISTICOS = { #estadisticos de los dropdowns y su funcion de agregacion en SQL, cualquier otro se toma como COUNT
+    'suma' : 'SUM',
+    'prom' : 'AVG',
+    'promedio' : 'AVG',
+    'count' : 'COUNT',
+    'conteo' : 'COUNT'
+    }
+
+SUFIJOS_ROLLUP = { #sufijo de las columnas de las tablas pre-agregadas para cada funcion SQL
+    'SUM' : 'suma',
+    'AVG' : 'prom',
+    'COUNT' : 'conteo'
+    }
+
+CLASES_MANZANAS = 6 #clases por cuantiles del mapa de manzanas, cada una es una capa de teselas
+
+CANAL_CAMBIOS = 'dashboards_cambios' #canal de NOTIFY por el que los disparadores avisan que cambio una tabla
+
+def tabla_tema(datos = 'Poblacion'):
+    ''' 
+    Nombre de la tabla de datos que corresponde a un tema
+
+    Args:
+        datos (str) -> tema elegido en el dropdown ('Poblacion' o 'Economia') o nombre de la tabla
+
+    Returns:
+        (str) -> nombre de la tabla de datos
+    '''
+    if datos == 'Poblacion' : return 'caracteristicas_poblacionales'
+    elif datos == 'Economia' : return 'caracteristicas_economicas'
+    return datos
+
 def map_query_constructor(esquema = 'Dashboards', 
                       base = 'manzanas', 
                       datos = 'caracteristicas_poblacionales' , 
@@ -119,84 +741,442 @@ def map_query_constructor(esquema = 'Dashboards',
         agreg (str) -> string con el nombre de la tabla con la que se agrupara y unira la base
         col1_1 (str) -> string con el nombre de la columna del primer campo a utilizar en el mapa 1
         col1_2 (str) -> string con el nombre de la columna del segundo campo a utilizar en la grafica 1
-        col2_1 (str) -> string con el nombre de la columna del primer campo a utilizar en el mapa 2
-        col2_2 (str) -> string con el nombre de la columna del segundo campo a utilizar en la grafica 2
         estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
         estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
-        estad2_1 (str) -> string con el nombre del estadistico que se usara para col2_1 
-        estad2_2 (str) -> string con el nombre del estadistico que se usara para col2_2 
 
     Returns:
-        (str) -> cadena de caracteres con el query para obtener la tabla de datos a usar en el dashboard.
+        (obj) -> query compuesto (psycopg2.sql) para obtener la tabla de datos a usar en el dashboard.
+    """
+
+    d = tabla_tema(datos) #  elije entre las opciones de tablas de datos para la variable datos
+
+    loc = sql.Identifier(agreg[0:4])
+
+    campos = [
+        sql.SQL('b.{} as {}').format(sql.Identifier(agreg), loc), #elije las columnas segun la agregacion que se necesita
+        sql.SQL('COUNT(b.{}) as {}').format(sql.Identifier(agreg), sql.Identifier(agreg + '_cont')) #genera la columna del conteo segun la agregacion que se necesita
+        ]
+
+    #get statistics, una columna repetida solo usa su primer estadistico
+    rep = []
+    for col, est in ((col1_1, estad1_1), (col1_2, estad1_2)):
+        if col not in rep:
+            campos.append(sql.SQL('{}(t.{}) as {}').format(sql.SQL(ESTADISTICOS.get(est, 'COUNT')), sql.Identifier(col), sql.Identifier(col)))
+            rep.append(col)
+
+    # union y agrupacion sin subconsulta: de cada tabla solo se leen la llave, la agregacion y las columnas pedidas
+    return sql.SQL('SELECT {campos} FROM {esq}.{base} as b LEFT JOIN {esq}.{datos} as t '
+                   'ON b.cvegeo = t.cvegeo GROUP BY b.{agreg}').format(
+        campos = sql.SQL(', ').join(campos),
+        agreg = sql.Identifier(agreg),
+        datos = sql.Identifier(d),
+        esq = sql.Identifier(esquema),
+        base = sql.Identifier(base))
+
+def geoQuery(esquema = 'Dashboards',agreg = 'sectores'): 
+    """ 
+    Constructor de query para la obtencion de los Geo Data Frames
+
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        agreg (str) -> string con el nombre de la tabla con la que se agrupara y unira la base
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) para obtener las geometrias de la agregacion.
+
+    """ 
+
+    return sql.SQL('SELECT id, ident, geom FROM {}.{}').format(sql.Identifier(esquema), sql.Identifier(agreg)) # solo lo que usan el mapa y la grafica
+
+def geo_vista_query(esquema = 'Dashboards', agreg = 'sectores', limites = (-180, -85, 180, 85)):
+    """ 
+    Constructor de query para las geometrias de la agregacion que tocan un rectangulo
+
+    El filtro && compara contra la caja de cada geometria y usa el indice GiST de la columna geom; el rectangulo
+    se lleva al SRID de la capa (Find_SRID, como en mvt_query_constructor) y las geometrias se regresan en EPSG:4326.
+
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        agreg (str) -> string con el nombre de la tabla de geometrias de la agregacion
+        limites (tuple) -> (oeste, sur, este, norte) en grados, EPSG:4326
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) para obtener las geometrias dentro de los limites
+    """
+    return sql.SQL("""SELECT id, ident, ST_Transform(geom, 4326) AS geom FROM {esq}.{agreg}
+    WHERE geom && ST_Transform(ST_MakeEnvelope({limites}, 4326), Find_SRID({esq_lit}, {agreg_lit}, 'geom'))""").format(
+        esq = sql.Identifier(esquema), agreg = sql.Identifier(agreg), limites = sql.SQL(', ').join(sql.Literal(float(l)) for l in limites),
+        esq_lit = sql.Literal(esquema), agreg_lit = sql.Literal(agreg))
+
+def rollup_nombre(datos = 'caracteristicas_poblacionales', agreg = 'sectores'):
+    """ 
+    Nombre de la tabla pre-agregada de una tabla de datos en una agregacion
+
+    Args:
+        datos (str) -> tema o nombre de la tabla de datos
+        agreg (str) -> string con el nombre de la agregacion
+
+    Returns:
+        (str) -> nombre de la tabla pre-agregada
     """
+    return 'rollup_{}_{}'.format(tabla_tema(datos), agreg)
 
-    if datos == 'Poblacion' : d = 'caracteristicas_poblacionales' #  elije entre las opciones de tablas de datos para la variable datos
-    elif datos == 'Economia' : d = 'caracteristicas_economicas'   
+def columnas_numericas_query(esquema = 'Dashboards', datos = 'caracteristicas_poblacionales'):
+    """ 
+    Constructor de query para obtener las columnas de datos numericas de una tabla
 
-    try: 
-        Q = 'select ' 
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        datos (str) -> tema o nombre de la tabla de datos
 
-        Q = Q + '{} as {}, '.format(agreg, agreg[0:4]) #elije las columnas segun la agregacion que se necesita
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) para obtener las columnas numericas
+    """
+    return sql.SQL("""SELECT column_name FROM information_schema.columns
+            WHERE table_schema = {} AND table_name = {} AND column_name ~ '^[A-Z].*$'
+                AND data_type IN ('smallint', 'integer', 'bigint', 'numeric', 'real', 'double precision')
+                    ORDER BY ordinal_position""").format(sql.Literal(esquema), sql.Literal(tabla_tema(datos)))
+
+def cubo_query_constructor(esquema = 'Dashboards',
+                           base = 'manzanas',
+                           datos = 'caracteristicas_poblacionales',
+                           agreg = 'sectores',
+                           columnas = ['POB1']):
+    """ 
+    Constructor de query del cubo de una agregacion: SUM, AVG y COUNT de todas las columnas en una sola consulta
 
-        Q = Q + 'COUNT({}) as {}_cont, '.format(agreg,agreg)  #genera la columna del conteo segun la agregacion que se necesita
+    Las columnas resultantes se llaman '<columna>__<suma|prom|conteo>' (ver SUFIJOS_ROLLUP), ademas de la
+    columna de la agregacion y '<agreg>_cont' con el conteo de manzanas.
 
-        #get statistics
-        l = [col1_1,col1_2]
-        e = [estad1_1, estad1_2]
-        rep =[]
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla con la minima granularidad
+        datos (str) -> tema o nombre de la tabla de datos
+        agreg (str) -> string con el nombre de la columna con la que se agrupara la base
+        columnas (list) -> columnas numericas de la tabla de datos
 
-        for i in range(0,len(l)):
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) para obtener el cubo
+    """
+    a = sql.Identifier(agreg)
 
-            if l[i] not in rep:
-                #elije el estadistico para cada columna elegida
-                if e[i]== 'suma' : est = 'SUM'
-                elif e[i]== 'prom' : est = 'AVG'
-                elif e[i]== 'count' : est = 'COUNT'
-                else: est = 'COUNT'
-                
-                Q = Q +  '{}(tabla."{}") as "{}", '.format(est, l[i], l[i])
+    campos = [sql.SQL('b.{} as {}').format(a, a), sql.SQL('COUNT(b.{}) as {}').format(a, sql.Identifier(agreg + '_cont'))]
 
-                rep.append(l[i])    
+    for col in columnas:
+        for funcion, sufijo in SUFIJOS_ROLLUP.items():
+            campos.append(sql.SQL('{}(t.{}) as {}').format(sql.SQL(funcion), sql.Identifier(col), sql.Identifier('{}__{}'.format(col, sufijo))))
 
+    return sql.SQL('SELECT {} FROM {}.{} as b LEFT JOIN {}.{} as t ON b.cvegeo = t.cvegeo GROUP BY b.{}').format(
+        sql.SQL(', ').join(campos), sql.Identifier(esquema), sql.Identifier(base), sql.Identifier(esquema), sql.Identifier(tabla_tema(datos)), a)
 
-        Q = Q[:-2] + ' '
+def rollup_create_query(esquema = 'Dashboards',
+                        base = 'manzanas',
+                        datos = 'caracteristicas_poblacionales',
+                        agreg = 'sectores',
+                        columnas = ['POB1']):
+    """ 
+    Constructor de query que materializa SUM, AVG y COUNT de cada columna numerica en una agregacion
 
-        Q = Q + 'FROM (SELECT {}, {}.* '.format(agreg,d) #inicia el query de union
+    La tabla se crea con el sufijo '__nueva' y reemplaza a la anterior dentro de la misma transaccion,
+    asi las consultas nunca ven una tabla a medio construir.
 
-        Q = Q + 'FROM "{}".{} '.format(esquema, base) 
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla con la minima granularidad
+        datos (str) -> tema o nombre de la tabla de datos
+        agreg (str) -> string con el nombre de la columna con la que se agrupara la base
+        columnas (list) -> columnas numericas de la tabla de datos
 
-        Q = Q + 'LEFT JOIN "{}".{} '.format(esquema, d)  
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) con las sentencias para crear la tabla pre-agregada
+    """
+    d = tabla_tema(datos)
+    nombre = rollup_nombre(d, agreg)
+
+    return sql.SQL('DROP TABLE IF EXISTS {esq}.{nueva}; '
+                   'CREATE TABLE {esq}.{nueva} AS {cubo}; '
+                   'DROP TABLE IF EXISTS {esq}.{tabla}; '
+                   'ALTER TABLE {esq}.{nueva} RENAME TO {tabla}; '
+                   'CREATE INDEX ON {esq}.{tabla} ({agreg});').format(
+        esq = sql.Identifier(esquema),
+        nueva = sql.Identifier(nombre + '__nueva'),
+        tabla = sql.Identifier(nombre),
+        agreg = sql.Identifier(agreg),
+        cubo = cubo_query_constructor(esquema = esquema, base = base, datos = d, agreg = agreg, columnas = columnas))
+
+def rollup_query_constructor(esquema = 'Dashboards',
+                             datos = 'caracteristicas_poblacionales',
+                             agreg = 'sectores',
+                             col1_1 = 'POB1',
+                             col1_2 = 'POB2',
+                             estad1_1 = 'suma',
+                             estad1_2 = 'suma'):
+    """ 
+    Constructor de query que lee de la tabla pre-agregada con la misma forma que map_query_constructor
 
-        Q = Q + 'ON {}.cvegeo = {}.cvegeo ) as tabla GROUP BY {};'.format(base, d,agreg[0:4] ) #agrupacion
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        datos (str) -> tema o nombre de la tabla de datos
+        agreg (str) -> string con el nombre de la agregacion
+        col1_1 (str) -> string con el nombre de la columna del primer campo
+        col1_2 (str) -> string con el nombre de la columna del segundo campo
+        estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
+        estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
 
-    except:
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) para obtener la tabla de datos a usar en el dashboard.
+    """
+    campos = [sql.SQL('{} as {}').format(sql.Identifier(agreg), sql.Identifier(agreg[0:4])), sql.Identifier(agreg + '_cont')]
 
-        print('error en query constructor.')
+    rep = []
+    for col, est in ((col1_1, estad1_1), (col1_2, estad1_2)):
+        if col not in rep:
+            campos.append(sql.SQL('{} as {}').format(sql.Identifier('{}__{}'.format(col, SUFIJOS_ROLLUP[ESTADISTICOS.get(est, 'COUNT')])), sql.Identifier(col)))
+            rep.append(col)
 
-    return Q
+    return sql.SQL('select {} FROM {}.{}').format(sql.SQL(', ').join(campos), sql.Identifier(esquema), sql.Identifier(rollup_nombre(datos, agreg)))
 
-def geoQuery(esquema = 'Dashboards',agreg = 'sectores'): 
+def mvt_query_constructor(esquema = 'Dashboards', base = 'manzanas', datos = 'caracteristicas_poblacionales', col = 'POB1'):
     """ 
-    Constructor de query para la obtencion de los Geo Data Frames
+    Constructor de query para una tesela vectorial (MVT) de las manzanas con el valor de una columna
+
+    El query lleva los parametros %(z)s, %(x)s, %(y)s de la tesela y %(minimo)s, %(maximo)s del rango de
+    valores; solo se incluyen las manzanas con minimo <= valor < maximo.
 
     Args:
         esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
-        agreg (str) -> string con el nombre de la tabla con la que se agrupara y unira la base
+        base (str) -> string con el nombre de la tabla de manzanas (con columna geom)
+        datos (str) -> tema o nombre de la tabla de datos
+        col (str) -> columna de la tabla de datos que se pinta
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) que regresa la tesela con ST_AsMVT
+    """
+    return sql.SQL("""
+    WITH limites AS (
+        SELECT ST_TileEnvelope(%(z)s, %(x)s, %(y)s) AS env,
+               ST_Transform(ST_TileEnvelope(%(z)s, %(x)s, %(y)s), Find_SRID({esq_lit}, {base_lit}, 'geom')) AS env_srid
+    ), mvt AS (
+        SELECT b.cvegeo, t.{col} AS valor,
+               ST_AsMVTGeom(ST_Transform(b.geom, 3857), limites.env, 4096, 64, true) AS geom
+        FROM {esq}.{base} AS b
+        JOIN {esq}.{tabla} AS t ON b.cvegeo = t.cvegeo, limites
+        WHERE b.geom && limites.env_srid AND t.{col} >= %(minimo)s AND t.{col} < %(maximo)s
+    )
+    SELECT ST_AsMVT(mvt, {base_lit}, 4096, 'geom') FROM mvt
+    """).format(esq = sql.Identifier(esquema), base = sql.Identifier(base), tabla = sql.Identifier(tabla_tema(datos)),
+                col = sql.Identifier(col), esq_lit = sql.Literal(esquema), base_lit = sql.Literal(base))
+
+def cortes_query(esquema = 'Dashboards', datos = 'caracteristicas_poblacionales', col = 'POB1', clases = 6):
+    """ 
+    Constructor de query para los cuantiles de una columna, usados como cortes de las clases del mapa de manzanas
+
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        datos (str) -> tema o nombre de la tabla de datos
+        col (str) -> columna de la tabla de datos
+        clases (int) -> numero de clases
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) que regresa la columna 'cortes' con clases + 1 valores
+    """
+    q = [i / clases for i in range(clases + 1)]
+
+    return sql.SQL('SELECT percentile_cont({}::float8[]) WITHIN GROUP (ORDER BY {}) AS cortes FROM {}.{}').format(
+        sql.Literal(q), sql.Identifier(col), sql.Identifier(esquema), sql.Identifier(tabla_tema(datos)))
+
+def disparador_query(esquema = 'Dashboards', tabla = 'caracteristicas_poblacionales'):
+    """ 
+    Constructor de query que instala el disparador que avisa por NOTIFY cuando cambia una tabla
+
+    El disparador es por sentencia (no por fila), asi una recarga completa manda un solo aviso con
+    '<esquema>.<tabla>' en el canal CANAL_CAMBIOS.
+
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        tabla (str) -> tabla que se vigila
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) con la funcion y el disparador
+    """
+    return sql.SQL("""CREATE OR REPLACE FUNCTION {esq}.dashboards_notificar() RETURNS trigger LANGUAGE plpgsql AS $$
+                      BEGIN
+                          PERFORM pg_notify({canal}, TG_TABLE_SCHEMA || '.' || TG_TABLE_NAME);
+                          RETURN NULL;
+                      END $$;
+                      DROP TRIGGER IF EXISTS dashboards_notificar ON {esq}.{tabla};
+                      CREATE TRIGGER dashboards_notificar AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {esq}.{tabla}
+                          FOR EACH STATEMENT EXECUTE FUNCTION {esq}.dashboards_notificar();""").format(
+        esq = sql.Identifier(esquema), tabla = sql.Identifier(tabla), canal = sql.Literal(CANAL_CAMBIOS))
+
+def cambios_query(esquema = 'Dashboards'):
+    """ 
+    Constructor de query para los contadores de modificaciones de las tablas de un esquema
+
+    Args:
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql) que regresa 'tabla', 'cambios' (filas insertadas, actualizadas
+                 y borradas desde que arranco postgres) y 'disparador' (si la tabla ya avisa por NOTIFY)
+    """
+    return sql.SQL("""SELECT s.relname AS tabla, s.n_tup_ins + s.n_tup_upd + s.n_tup_del AS cambios,
+                             EXISTS (SELECT 1 FROM pg_trigger t WHERE t.tgrelid = s.relid AND t.tgname = 'dashboards_notificar') AS disparador
+                      FROM pg_stat_user_tables s WHERE s.schemaname = {}""").format(sql.Literal(esquema))
+
+def texto_query(c, select_query):
+    """ 
+    Args:
+        c (obj) -> coneccion a base de datos, necesaria para citar los identificadores
+        select_query (obj) -> query compuesto (psycopg2.sql) o string
+
+    Returns:
+        (str) -> texto de la query
+    """
+    if isinstance(select_query, sql.Composable):
+        return select_query.as_string(c)
+    return select_query
+
+def texto_duckdb(select_query):
+    """ 
+    Texto de una query compuesta sin conexion a postgres, para el backend de DuckDB
+
+    DuckDB cita los identificadores y los strings igual que postgres; las listas se escriben como listas de DuckDB.
+
+    Args:
+        select_query (obj) -> query compuesto (psycopg2.sql) o string, sin placeholders
 
     Returns:
-        (str) -> cadena de caracteres con el query para obtener la tabla de datos a usar en el dashboard.
+        (str) -> texto de la query
+    """
+    if isinstance(select_query, sql.Composed):
+        return ''.join(texto_duckdb(s) for s in select_query.seq)
+    if isinstance(select_query, sql.SQL):
+        return select_query.string
+    if isinstance(select_query, sql.Identifier):
+        return '.'.join('"{}"'.format(s.replace('"', '""')) for s in select_query.strings)
+    if isinstance(select_query, sql.Literal):
+        return literal_duckdb(select_query.wrapped)
+    if isinstance(select_query, str):
+        return select_query
+    raise TypeError('no se puede pasar a DuckDB: {!r}'.format(select_query))
+
+def literal_duckdb(valor):
+    """ 
+    Args:
+        valor (obj) -> None, bool, numero, string o lista
+
+    Returns:
+        (str) -> el valor escrito como literal de SQL de DuckDB
+    """
+    if valor is None:
+        return 'NULL'
+    if isinstance(valor, bool):
+        return 'true' if valor else 'false'
+    if isinstance(valor, (int, float)):
+        return repr(valor) if math.isfinite(valor) else "'{}'::DOUBLE".format(valor)
+    if isinstance(valor, (list, tuple)):
+        return '[{}]'.format(', '.join(literal_duckdb(v) for v in valor))
+    return "'{}'".format(str(valor).replace("'", "''"))
+
+def preparada(c, select_query):
+    """ 
+    Ejecuta una query como sentencia preparada del lado del servidor
+
+    La sentencia se prepara la primera vez que se ve su texto en la conexion y despues solo se ejecuta, asi
+    las consultas repetidas de un panel se saltan el parseo y la planeacion. Las sentencias viven lo que
+    la sesion de postgres; al llegar a PREPARADAS_MAX en una conexion se liberan todas.
+
+    Args:
+        c (obj) -> coneccion a base de datos ya prestada (ConexionPreparada)
+        select_query (obj) -> query compuesto (psycopg2.sql) o string
+
+    Returns:
+        (tuple) -> (lista de filas, lista de nombres de columnas)
+    """
+    texto = texto_query(c, select_query).strip().rstrip(';')
+    nombre = sql.Identifier('q_' + hashlib.sha1(texto.encode('utf-8')).hexdigest()[0:20])
+    preparadas = getattr(c, 'preparadas', None)
+
+    try:
+        with c.cursor() as cursor:
+            if preparadas is None: # conexion sin registro de sentencias, se ejecuta directo
+                cursor.execute(texto)
+
+            else:
+                if nombre.string not in preparadas:
+                    if len(preparadas) >= max_preparadas:
+                        cursor.execute('DEALLOCATE ALL')
+                        preparadas.clear()
+                    cursor.execute(sql.SQL('PREPARE {} AS {}').format(nombre, sql.SQL(texto)))
+                    preparadas.add(nombre.string)
+
+                try:
+                    cursor.execute(sql.SQL('EXECUTE {}').format(nombre))
+                except psycopg2.errors.FeatureNotSupported: # el plan guardado ya no corresponde a la tabla, p. ej. un rollup reconstruido
+                    c.rollback()
+                    cursor.execute(sql.SQL('DEALLOCATE {}').format(nombre))
+                    cursor.execute(sql.SQL('PREPARE {} AS {}').format(nombre, sql.SQL(texto)))
+                    cursor.execute(sql.SQL('EXECUTE {}').format(nombre))
+
+            filas = cursor.fetchall()
+            columnas = [d[0] for d in cursor.description]
+    finally:
+        c.rollback()
+
+    return filas, columnas
+
+def copiar_query(c, select_query, destino):
+    """ 
+    Escribe el resultado de una query en CSV con COPY ... TO STDOUT, sin pasar fila por fila por python
 
+    Args:
+        c (obj) -> coneccion a base de datos ya prestada
+        select_query (obj) -> query compuesto (psycopg2.sql) o string, puede terminar en ';'
+        destino (obj) -> archivo binario donde se escribe el CSV con encabezado
+
+    Returns:
+        (obj) -> el mismo destino, regresado al inicio para leerlo
+    """
+    q = sql.SQL('COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER true)').format(sql.SQL(texto_query(c, select_query).strip().rstrip(';')))
+
+    try:
+        with c.cursor() as cursor:
+            cursor.copy_expert(q.as_string(c), destino)
+    finally:
+        c.rollback()
+
+    destino.seek(0)
+    return destino
+
+def hay_pyarrow():
     """ 
+    Returns:
+        (bool) -> si pyarrow esta instalado, sin importarlo; es opcional (lector CSV y exportacion Parquet/Arrow)
+    """
+    return importlib.util.find_spec('pyarrow') is not None
 
-    return 'SELECT * FROM "{}"."{}" '.format(esquema,agreg)
+def motor_csv():
+    """ 
+    Returns:
+        (str) -> lector de CSV de pandas, el de pyarrow (multihilo) si esta instalado
+    """
+    return 'pyarrow' if hay_pyarrow() else 'c'
 
-def postgresql_to_dataframe(conn, select_query):
+@medir
+def postgresql_to_dataframe(conn, select_query, tipos = None, modo = 'copy'):
     """ 
     Funcion para obtener el DataFrame a partir de una query
 
+    Por defecto el resultado se trae con COPY en CSV y se lee con un lector vectorizado, con columnas ya tipadas;
+    pd.read_sql arma una tupla de python por fila e infiere los tipos al final.
+
     Args:
-        conn (obj) -> coneccion a base de datos
-        select_query (str) -> string con la consulta para obtener un DataFrame
+        conn (obj) -> pool de conexiones, se presta una conexion solo durante la consulta
+        select_query (obj) -> query compuesto (psycopg2.sql) o string con la consulta para obtener un DataFrame
+        tipos (dic) -> esquema de tipos {columna: dtype} para las columnas que no se deben inferir
+        modo (str) -> 'copy'; 'preparada' para consultas chicas y repetidas (ver preparada); 'read_sql' para
+                      resultados que CSV no representa como arreglos
 
 
     Returns:
@@ -204,204 +1184,1966 @@ def postgresql_to_dataframe(conn, select_query):
     
     """
 
-    cursor = conn.cursor()
-    try:
-        df = pd.read_sql( select_query, con=conn ) #obtener DF de un query de posrtgresql
+    if isinstance(conn, BackendDuckDB): # el modo no aplica, DuckDB entrega las columnas ya tipadas
+        try:
+            return conn.dataframe(select_query, tipos)
+        except Exception:
+            return "Error: en postgresql_to_dataframe"
+
+    try: # sin base de datos el prestamo de la conexion tambien falla
+        with conn.conexion() as c:
+            if modo == 'copy':
+                df = pd.read_csv(copiar_query(c, select_query, io.BytesIO()), dtype = tipos, engine = motor_csv())
+            elif modo == 'preparada':
+                filas, columnas = preparada(c, select_query)
+                df = pd.DataFrame.from_records(filas, columns = columnas, coerce_float = True)
+                df = df.astype({k: v for k, v in (tipos or {}).items() if k in df.columns})
+            else:
+                df = pd.read_sql( texto_query(c, select_query), con=c ) #obtener DF de un query de posrtgresql
     except:
         
        return "Error: en postgresql_to_dataframe"
-    
-    cursor.close()
 
     return df
 
+@medir
 def postgresql_to_GEOdataframe(conn, select_query):
     """ 
     Funcion para obtener el GeoDataFrame a partir de una query
 
     Args:
-        conn (obj) -> coneccion a base de datos
-        select_query (str) -> string con la consulta para obtener un GeoDataFrame
+        conn (obj) -> pool de conexiones, se presta una conexion solo durante la consulta
+        select_query (obj) -> query compuesto (psycopg2.sql) o string con la consulta para obtener un GeoDataFrame
 
 
     Returns:
         (obj) -> GeoDataframe obtenido a partir de la query
     
     """
-    cursor = conn.cursor()
-    try:
-        gdf = gpd.read_postgis(select_query, con=conn)
+    if isinstance(conn, BackendDuckDB):
+        try:
+            return conn.geodataframe(select_query)
+        except Exception:
+            return "Error: en postgresql_to_GEOdataframe"
+
+    try: # sin base de datos el prestamo de la conexion tambien falla
+        with conn.conexion() as c:
+            gdf = gpd.read_postgis(texto_query(c, select_query), con=c)
     except:
         
        return "Error: en postgresql_to_GEOdataframe"
-    
-    cursor.close()
 
     return gdf
 
-def mapa(conn, esquema = 'Dashboards',
-    base = 'manzanas' ,
-    datos = 'caracteristicas_poblacionales',
+def refrescar_rollups(conn, esquema = 'Dashboards', base = 'manzanas', tablas = [], agregaciones = []):
+    """ 
+    Vuelve a construir las tablas pre-agregadas de cada tabla de datos en cada agregacion
 
-    col1_1 = 'POB1',
-    col1_2 = 'POB2',
-    estad1_1 = 'suma',
-    estad1_2 = 'suma',
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla con la minima granularidad
+        tablas (list) -> tablas de datos a pre-agregar
+        agregaciones (list) -> agregaciones en las que se pre-agrega cada tabla
 
-    agreg1 = 'sectores'):
-    """ descripcion de funcion"""
+    Returns:
+        (list) -> nombres de las tablas pre-agregadas construidas
+    """
+    if isinstance(conn, BackendDuckDB):
+        raise RuntimeError('las tablas pre-agregadas solo existen con BACKEND=postgres')
 
-    #obtener los primeros 4 caracteres de la columna de agregacion para crear los nombres de las nuevas columnas de agrupacion
-    loc1 = agreg1[0:4]
+    hechas = []
 
-    #get column descriptions
-    l = [col1_1,col1_2]
-    rep =[]
+    for tabla in tablas:
+        columnas = postgresql_to_dataframe(conn, columnas_numericas_query(esquema = esquema, datos = tabla))
+        if isinstance(columnas, str):
+            raise RuntimeError('no se pudieron leer las columnas de {}'.format(tabla))
 
-    for i in range(0,len(l)):
-        if l[i] not in rep:
-            rep.append(l[i])
-            
-    if datos == 'Poblacion' : d = 'caracteristicas_poblacionales' #  elije entre las opciones de tablas de datos para la variable datos
-    elif datos == 'Economia' : d = 'caracteristicas_economicas'
-    
-    col_desc = postgresql_to_dataframe(conn, col_description_query(tabla=d, esquema=esquema) )
+        for ag in agregaciones:
+            t0 = time.perf_counter()
 
-    df1 = postgresql_to_dataframe(conn,map_query_constructor(esquema=esquema, #obtener el primer DF
-                                                         agreg=agreg1, 
-                                                         base=base ,
-                                                         datos=datos ,
-                                                         col1_1=col1_1,
-                                                         col1_2=col1_2,
-                                                         estad1_1=estad1_1,
-                                                         estad1_2=estad1_2
-                                                         ))        
+            with conn.conexion() as c:
+                with c.cursor() as cursor:
+                    cursor.execute(rollup_create_query(esquema = esquema, base = base, datos = tabla, agreg = ag,
+                                                       columnas = columnas['column_name'].to_list()))
+                    cursor.execute(sql.SQL('SELECT pg_notify({}, {})').format( # la tabla nueva no tiene disparador, se avisa aqui
+                        sql.Literal(CANAL_CAMBIOS), sql.Literal('{}.{}'.format(esquema, rollup_nombre(tabla, ag)))))
+                c.commit()
 
-    gdf1 = postgresql_to_GEOdataframe(conn, geoQuery(agreg=agreg1) ) #obtener el primer GDF
-    gdf1.set_index('id', inplace=True)
+            hechas.append(rollup_nombre(tabla, ag))
+            log.info('rollup %s listo en %.1f s', hechas[-1], time.perf_counter() - t0)
 
-    #graficando el primer mapa
+        cache_agregados.invalidar(tabla)
 
-    un1 = pd.merge(gdf1,df1,how='left', left_on=gdf1.index,right_on=loc1 )
-    un1.set_index(loc1, inplace = True)
-    un1 = un1.fillna(0)
-    un1[loc1]= un1.index.values
-    l1 = un1.columns.to_list()
-    l1.remove('geom')
+    return hechas
 
+def volcar_parquet(conn, destino, esquema = 'Dashboards', tablas = [], descripciones = {}):
+    """ 
+    Copia tablas de postgres a archivos Parquet para el backend de DuckDB (BACKEND=duckdb)
 
+    Las tablas con columna 'geom' se guardan como GeoParquet en EPSG:4326. Se leen con los tipos de
+    postgres (sin pasar por CSV) para que claves como cvegeo sigan siendo texto.
 
-    labs1 = { #labels
-            col1_2: estad1_1 + ' de ' + col_desc[col_desc['col']== col1_2].iloc[0,1],
-            col1_1: estad1_2 + ' de ' + col_desc[col_desc['col']== col1_1].iloc[0,1],
-            'ident':agreg1,
-            agreg1+'_cont':'conteo de manzanas',
-            loc1:agreg1,
-            'index':'id'
-            }
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        destino (str) -> carpeta donde se escriben <tabla>.parquet y descripciones.json
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        tablas (list) -> tablas a copiar: la base, las tablas de datos y las capas de las agregaciones
+        descripciones (dic) -> {tabla: {columna: descripcion}} que se guardan en descripciones.json
 
-    #----------------------------------------------------------------------------------------------------
-    fig = px.choropleth_mapbox(un1, width = 800,
-                               geojson=un1.geometry, 
-                               locations=un1.index , color=col1_1,
-                               hover_name= 'ident',
-                               hover_data=l1,
-                               color_continuous_scale="Viridis",
-                               range_color=(df1[col1_1].min(), df1[col1_1].max()),
-                               mapbox_style="carto-positron",
-                               zoom=10, 
-                               center = {"lat": 32.484948, "lon": -116.936904},
-                               opacity=0.5,
-                               labels=labs1
-                               )
-    fig.update_layout(margin={"r":10,"t":10,"l":10,"b":10},coloraxis_colorbar = dict( titleside = 'right'), autosize=True)
+    Returns:
+        (list) -> rutas de los archivos escritos
+    """
+    os.makedirs(destino, exist_ok = True)
+    hechas = []
+
+    for tabla in tablas:
+        t0 = time.perf_counter()
+        cols = postgresql_to_dataframe(conn, sql.SQL('SELECT column_name FROM information_schema.columns WHERE table_schema = {} AND table_name = {}').format(
+            sql.Literal(esquema), sql.Literal(tabla)), modo = 'read_sql')
+        if isinstance(cols, str) or cols.empty:
+            raise RuntimeError('no se encontro la tabla {}'.format(tabla))
+
+        Q = sql.SQL('SELECT * FROM {}.{}').format(sql.Identifier(esquema), sql.Identifier(tabla))
+        ruta = os.path.join(destino, tabla + '.parquet')
+
+        if 'geom' in cols['column_name'].values:
+            df = postgresql_to_GEOdataframe(conn, Q)
+            if isinstance(df, str):
+                raise RuntimeError('no se pudo leer la capa {}'.format(tabla))
+            df = df.set_crs(4326) if df.crs is None else df.to_crs(4326)
+        else:
+            df = postgresql_to_dataframe(conn, Q, modo = 'read_sql')
+            if isinstance(df, str):
+                raise RuntimeError('no se pudo leer la tabla {}'.format(tabla))
+
+        df.to_parquet(ruta, index = False)
+        hechas.append(ruta)
+        log.info('%s: %s filas en %.1f s', ruta, len(df), time.perf_counter() - t0)
+
+    with open(os.path.join(destino, 'descripciones.json'), 'w', encoding = 'utf-8') as f:
+        json.dump(descripciones, f, ensure_ascii = False, indent = 1)
+
+    return hechas
+
+def simplificar(gdf, tolerancia = 0.0005):
+    """ 
+    Version simplificada de una capa conservando los bordes compartidos entre poligonos vecinos
 
-    return fig ,un1
+    Usa shapely.coverage_simplify (shapely >= 2.1), que simplifica cada borde compartido una sola vez y
+    no deja huecos ni traslapes; con versiones anteriores simplifica cada poligono con preserve_topology.
 
-def grafica(conn, esquema = 'Dashboards',
-    base = 'manzanas' ,
-    datos = 'caracteristicas_poblacionales',
+    Args:
+        gdf (obj) -> GeoDataFrame con la capa completa
+        tolerancia (float) -> tolerancia de simplificacion en unidades del CRS (grados en EPSG:4326)
 
-    col1_1 = 'POB1',
-    col1_2 = 'POB2',
-    estad1_1 = 'suma',
-    estad1_2 = 'suma',
-    select_1 = [],
+    Returns:
+        (obj) -> GeoDataFrame con las mismas columnas y geometrias simplificadas
+    """
+    if not tolerancia:
+        return gdf
 
-    agreg1 = 'sectores'):
-    """ descripcion de funcion"""
+    geom = gdf.geometry
 
-    #obtener los primeros 4 caracteres de la columna de agregacion para crear los nombres de las nuevas columnas de agrupacion
-    loc1 = agreg1[0:4]
+    try:
+        import shapely
+        nuevas = shapely.coverage_simplify(np.asarray(geom), tolerancia)
+    except (ImportError, AttributeError):
+        nuevas = geom.simplify(tolerancia, preserve_topology = True)
 
-    #get column descriptions
-    l = [col1_1,col1_2]
-    rep =[]
+    gdf = gdf.copy()
+    gdf[geom.name] = gpd.GeoSeries(nuevas, index = gdf.index, crs = gdf.crs)
+    return gdf
 
-    for i in range(0,len(l)):
-        if l[i] not in rep:
-            rep.append(l[i])
-            
-    if datos == 'Poblacion' : d = 'caracteristicas_poblacionales' #  elije entre las opciones de tablas de datos para la variable datos
-    elif datos == 'Economia' : d = 'caracteristicas_economicas'
-    
-    col_desc = postgresql_to_dataframe(conn, col_description_query(tabla=d, esquema=esquema) )
+class CacheGeometrias:
+    """ 
+    Almacen en memoria de las capas de agregacion (colonias, delegaciones, sectores, subsectores)
 
-    df1 = postgresql_to_dataframe(conn,map_query_constructor(esquema=esquema, #obtener el primer DF
-                                                         agreg=agreg1, 
-                                                         base=base ,
-                                                         datos=datos ,
-                                                         col1_1=col1_1,
-                                                         col1_2=col1_2,
-                                                         estad1_1=estad1_1,
-                                                         estad1_2=estad1_2
-                                                         ))        
+    Cada capa se lee una sola vez de la base de datos y se guarda indexada por 'id', junto con versiones
+    simplificadas a varios niveles de detalle. Cuando el total de las capas guardadas pasa del limite de
+    memoria se descartan las que se usaron hace mas tiempo. Los GeoDataFrames entregados son compartidos
+    entre callbacks, por lo que no deben modificarse.
 
-    gdf1 = postgresql_to_GEOdataframe(conn, geoQuery(agreg=agreg1) ) #obtener el primer GDF
-    gdf1.set_index('id', inplace=True)
+    Args:
+        max_bytes (int) -> memoria maxima aproximada que pueden ocupar las capas guardadas
+        niveles (dic) -> nivel de detalle -> tolerancia de simplificacion; 'completo' siempre existe
+        compartido (obj) -> CacheCompartido opcional donde se buscan las capas ya simplificadas por otro proceso
+    """
 
-    #se seleccionan los datos desde la seleccion del mapa para visualizarlos en grafica
-    if select_1 == []: sel1 = df1[loc1].to_list()
-    else:sel1 = select_1
+    def __init__(self, max_bytes = 256 * 1024 ** 2, niveles = {'panel': 0.0005, 'modal': 0.0001}, compartido = None):
+        self.max_bytes = max_bytes
+        self.niveles = dict(niveles, completo = 0)
+        self.compartido = compartido
+
+        self._capas = OrderedDict() # (esquema, agreg) -> capa, ordenado del menos al mas reciente
+        self._lock = threading.Lock()
+        self._cargas = {} # un lock por capa para que solo un hilo la lea de la base de datos
+        self._metricas = {'hits': 0, 'misses': 0}
+
+    @staticmethod
+    def _tamano(gdf):
+        # memoria de las columnas normales mas el tamano en WKB de las geometrias
+        geom = gdf.geometry.to_wkb().map(len).sum()
+        return int(gdf.drop(columns = gdf.geometry.name).memory_usage(deep = True).sum() + geom)
+
+    def _capa(self, conn, agreg, esquema):
+        # regresa {'niveles': {nivel: gdf}, 'geojson': {nivel: (geojson, geojson gzip, etag)}, 'tamano': bytes}, o el mensaje de error
+        clave = (esquema, agreg)
+
+        with self._lock:
+            if clave in self._capas:
+                self._capas.move_to_end(clave)
+                self._metricas['hits'] += 1
+                contar_consulta_cache('geometrias', True)
+                return self._capas[clave]
+            carga = self._cargas.setdefault(clave, threading.Lock())
+
+        with carga:
+            with self._lock: # otro hilo pudo haber cargado la capa mientras se esperaba
+                if clave in self._capas:
+                    self._capas.move_to_end(clave)
+                    self._metricas['hits'] += 1
+                    contar_consulta_cache('geometrias', True)
+                    return self._capas[clave]
+                self._metricas['misses'] += 1
+            contar_consulta_cache('geometrias', False)
+
+            capa = self._leer_compartido(esquema, agreg)
+            if capa is not None:
+                return self._guardar(clave, agreg, capa)
+
+            gdf = postgresql_to_GEOdataframe(conn, geoQuery(esquema = esquema, agreg = agreg))
+            if isinstance(gdf, str): #error en la consulta, no se guarda
+                return gdf
+
+            gdf = gdf.set_index('id')
+
+            t0 = time.perf_counter()
+            versiones = {nivel: simplificar(gdf, tol) for nivel, tol in self.niveles.items()}
+
+            geojson = {}
+            for nivel, v in versiones.items(): # se sirve tal cual por /geo/<agreg>.geojson, con los ids de la capa
+                cuerpo = v.geometry.to_json().encode('utf-8')
+                geojson[nivel] = (cuerpo, gzip.compress(cuerpo, 6), hashlib.sha1(cuerpo).hexdigest())
+
+            capa = {
+                'niveles': versiones,
+                'geojson': geojson,
+                'tamano': sum(self._tamano(v) for v in versiones.values()) + sum(len(g[0]) + len(g[1]) for g in geojson.values())
+                }
+
+            log.info('capa %s: %s poligonos, geojson por nivel %s, simplificada en %.2f s',
+                     agreg, len(gdf), {n: len(g[0]) for n, g in geojson.items()}, time.perf_counter() - t0)
+
+            if self.compartido is not None:
+                self.compartido.set(self._clave_compartida(esquema, agreg), capa, etiquetas = ('geo', 'geo:' + agreg))
+
+            return self._guardar(clave, agreg, capa)
+
+    def _clave_compartida(self, esquema, agreg):
+        # las tolerancias forman parte de la llave, un worker con otros niveles no reutiliza la capa
+        return ('capa', esquema, agreg, tuple(sorted(self.niveles.items())))
+
+    def _leer_compartido(self, esquema, agreg):
+        if self.compartido is None:
+            return None
+        return self.compartido.get(self._clave_compartida(esquema, agreg), etiquetas = ('geo', 'geo:' + agreg))
+
+    def _guardar(self, clave, agreg, capa):
+        if capa['tamano'] > self.max_bytes:
+            log.warning('la capa %s (%s bytes) excede el limite del cache de geometrias', agreg, capa['tamano'])
+            return capa
+
+        with self._lock:
+            self._capas[clave] = capa
+            while self.tamano() > self.max_bytes:
+                self._capas.popitem(last = False)
+
+        return capa
+
+    def obtener(self, conn, agreg = 'sectores', esquema = 'Dashboards', nivel = 'completo'):
+        """ 
+        Obtiene la capa de geometrias de una agregacion, leyendola de la base de datos solo la primera vez
+
+        Args:
+            conn (obj) -> pool de conexiones a base de datos
+            agreg (str) -> string con el nombre de la tabla de geometrias de la agregacion
+            esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+            nivel (str) -> nivel de detalle ('completo', 'modal', 'panel'...), si no existe se usa 'completo'
+
+        Returns:
+            (obj) -> GeoDataFrame indexado por 'id'
+        """
+        capa = self._capa(conn, agreg, esquema)
+        if isinstance(capa, str):
+            return capa
+        return capa['niveles'].get(nivel, capa['niveles']['completo'])
+
+    def peso_geojson(self, conn, agreg = 'sectores', esquema = 'Dashboards', nivel = 'completo'):
+        """ 
+        Args:
+            conn (obj) -> pool de conexiones a base de datos
+            agreg (str) -> string con el nombre de la tabla de geometrias de la agregacion
+            esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+            nivel (str) -> nivel de detalle
+
+        Returns:
+            (int) -> tamano en bytes del GeoJSON de las geometrias en ese nivel
+        """
+        g = self.geojson(conn, agreg = agreg, esquema = esquema, nivel = nivel)
+        return 0 if isinstance(g, str) else len(g[0])
+
+    def geojson(self, conn, agreg = 'sectores', esquema = 'Dashboards', nivel = 'completo'):
+        """ 
+        GeoJSON ya serializado de una capa, para servirlo sin volver a convertir las geometrias
+
+        Args:
+            conn (obj) -> pool de conexiones a base de datos
+            agreg (str) -> string con el nombre de la tabla de geometrias de la agregacion
+            esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+            nivel (str) -> nivel de detalle, si no existe se usa 'completo'
+
+        Returns:
+            (tuple) -> (geojson en bytes, geojson comprimido con gzip, etag), o el mensaje de error
+        """
+        capa = self._capa(conn, agreg, esquema)
+        if isinstance(capa, str):
+            return capa
+        return capa['geojson'].get(nivel, capa['geojson']['completo'])
+
+    def tamano(self):
+        """ 
+        Returns:
+            (int) -> memoria aproximada ocupada por las capas guardadas
+        """
+        return sum(c['tamano'] for c in self._capas.values())
+
+    def metricas(self):
+        """ 
+        Returns:
+            (dic) -> hits, misses, numero de capas guardadas y bytes que ocupan
+        """
+        with self._lock:
+            m = dict(self._metricas)
+            m['entradas'] = len(self._capas)
+            m['bytes'] = self.tamano()
+        return m
+
+    def invalidar(self, agreg = None, esquema = None):
+        """ 
+        Descarta capas guardadas para que se vuelvan a leer en la siguiente consulta
+
+        Args:
+            agreg (str) -> agregacion a descartar, si es None se descartan todas
+            esquema (str) -> esquema de la capa a descartar, si es None aplica a todos
+        """
+        if self.compartido is not None: # en el cache compartido se descarta la agregacion en todos los esquemas
+            self.compartido.invalidar('geo' if agreg is None else 'geo:' + agreg)
+
+        with self._lock:
+            for clave in list(self._capas):
+                if (agreg is None or clave[1] == agreg) and (esquema is None or clave[0] == esquema):
+                    del self._capas[clave]
+
+class UnSoloVuelo:
+    """ 
+    Junta las llamadas concurrentes con la misma clave en una sola ejecucion (single flight)
 
-    #graficando el primer mapa
+    La primera llamada con una clave ejecuta la funcion; las que llegan mientras sigue en curso esperan y
+    reciben el mismo resultado (o la misma excepcion). No guarda nada: al terminar la clave queda libre.
+    Solo junta llamadas dentro del mismo proceso. Si la primera llamada se interrumpe (KeyboardInterrupt,
+    SystemExit) las que esperaban reciben un RuntimeError; si tarda mas de 'espera' ejecutan la funcion ellas mismas.
+
+    Args:
+        espera (float) -> segundos maximos que una llamada espera a la que esta en curso
+    """
+
+    def __init__(self, espera = 120):
+        self.espera = espera
+
+        self._vuelos = {} # clave -> [evento, resultado, excepcion]
+        self._lock = threading.Lock()
+        self._metricas = {'ejecuciones': 0, 'compartidas': 0, 'vencidas': 0}
+
+    def hacer(self, clave, funcion):
+        """ 
+        Args:
+            clave (tuple) -> clave de la llamada
+            funcion (func) -> funcion sin argumentos que se ejecuta una sola vez por vuelo
+
+        Returns:
+            (obj) -> resultado de la funcion, calculado aqui o por la llamada que ya estaba en curso
+        """
+        with self._lock:
+            vuelo = self._vuelos.get(clave)
+            lider = vuelo is None
+            if lider:
+                vuelo = self._vuelos[clave] = [threading.Event(), None, None]
+                self._metricas['ejecuciones'] += 1
+            else:
+                self._metricas['compartidas'] += 1
+
+        if not lider:
+            if not vuelo[0].wait(self.espera): # la llamada en curso no termina, se calcula aparte
+                with self._lock:
+                    self._metricas['vencidas'] += 1
+                return funcion()
+            if vuelo[2] is not None:
+                raise vuelo[2]
+            return vuelo[1]
+
+        try:
+            vuelo[1] = funcion()
+        except Exception as error:
+            vuelo[2] = error
+            raise
+        except BaseException as error: # las que esperan no deben tomar el None como resultado
+            vuelo[2] = RuntimeError('se interrumpio el calculo compartido de {!r}: {!r}'.format(clave, error))
+            raise
+        finally:
+            with self._lock:
+                del self._vuelos[clave]
+            vuelo[0].set()
+
+        return vuelo[1]
+
+    def metricas(self):
+        """ 
+        Returns:
+            (dic) -> ejecuciones hechas, llamadas que compartieron una ejecucion en curso y las que dejaron de esperarla
+        """
+        with self._lock:
+            return dict(self._metricas)
+
+class CacheCompartido:
+    """ 
+    Cache en disco (SQLite, via diskcache) compartido por todos los procesos del host
+
+    Cada worker de gunicorn tiene sus propios CacheLRU y CacheGeometrias en memoria; este almacen va detras
+    de ellos como segundo nivel, asi un DataFrame, una figura o una capa calculada por un worker la lee otro
+    sin consultar la base de datos. Los valores se guardan serializados con pickle y se desalojan por LRU al
+    pasar del limite de tamano. Para invalidar por etiqueta se guarda un contador (generacion) por etiqueta
+    que forma parte de la llave: al incrementarlo las entradas viejas dejan de encontrarse y salen por LRU.
+    Cada cache en memoria usa su propio espacio del almacen (ver espacio), con sus llaves y generaciones;
+    invalidar todo un espacio solo incrementa su generacion, el almacen nunca se vacia.
+    Un error del disco nunca rompe una consulta, solo se trata como miss.
+
+    Args:
+        directorio (str) -> carpeta de la base SQLite y de los valores grandes
+        max_bytes (int) -> tamano maximo en disco, se desalojan las entradas usadas hace mas tiempo
+        ttl (float) -> segundos que vive una entrada, si es None no expiran
+        max_entrada (int) -> tamano maximo de una sola entrada serializada, las mas grandes no se guardan
+    """
+
+    def __init__(self, directorio, max_bytes = 512 * 1024 ** 2, ttl = 600, max_entrada = None):
+        import diskcache
+
+        self.ttl = ttl
+        self.max_entrada = max_entrada if max_entrada is not None else max_bytes // 8
+        self._cache = diskcache.Cache(directorio, size_limit = max_bytes, eviction_policy = 'least-recently-used',
+                                      timeout = 1) # con la base ocupada mas de 1 s se trata como miss
+        self._errores = (diskcache.Timeout, OSError, sqlite3.Error, pickle.PickleError, EOFError)
+        self._metricas = {'hits': 0, 'misses': 0, 'errores': 0, 'omitidas': 0}
+        self._lock = threading.Lock()
+        self.nombre = None # espacio de las llaves, ver espacio
+
+    def espacio(self, nombre):
+        """ 
+        Args:
+            nombre (str) -> nombre del espacio, uno por cache que usa el almacen
+
+        Returns:
+            (obj) -> CacheCompartido sobre el mismo almacen (y las mismas metricas) cuyas llaves y generaciones
+                     no se mezclan con las de otros espacios
+        """
+        vista = copy.copy(self)
+        vista.nombre = nombre
+        return vista
+
+    def _contar(self, nombre):
+        with self._lock:
+            self._metricas[nombre] += 1
+
+    def _generacion(self, etiqueta):
+        # etiqueta None es la generacion de todo el espacio
+        return self._cache.get(('generacion', self.nombre, etiqueta), 0)
+
+    def _llave(self, clave, etiquetas):
+        # la llave incluye el espacio, su generacion y la de cada etiqueta, ver invalidar
+        return (self.nombre, self._generacion(None), clave, tuple(self._generacion(e) for e in sorted(etiquetas, key = str)))
+
+    def get(self, clave, etiquetas = ()):
+        """ 
+        Args:
+            clave (tuple) -> clave de la entrada
+            etiquetas (tuple) -> etiquetas con las que se guardo la entrada
+
+        Returns:
+            (obj) -> valor guardado o None si no existe, expiro, se invalido o no se pudo leer
+        """
+        try:
+            valor = self._cache.get(self._llave(clave, etiquetas))
+        except self._errores as error:
+            log.warning('cache compartido: no se pudo leer %s (%s)', clave, error)
+            self._contar('errores')
+            return None
+
+        self._contar('misses' if valor is None else 'hits')
+        return valor
+
+    def set(self, clave, valor, etiquetas = ()):
+        """ 
+        Args:
+            clave (tuple) -> clave de la entrada
+            valor (obj) -> valor a guardar, debe poder serializarse con pickle
+            etiquetas (tuple) -> etiquetas con las que se podra invalidar la entrada
+        """
+        try:
+            cuerpo = pickle.dumps(valor, protocol = pickle.HIGHEST_PROTOCOL)
+            if len(cuerpo) > self.max_entrada: # desalojaria casi todo el cache
+                self._contar('omitidas')
+                return
+            # se guardan los bytes ya serializados para no volver a serializar dentro de diskcache
+            self._cache.set(self._llave(clave, etiquetas), _Serializado(cuerpo), expire = self.ttl)
+        except self._errores as error:
+            log.warning('cache compartido: no se pudo guardar %s (%s)', clave, error)
+            self._contar('errores')
+
+    def invalidar(self, etiqueta = None):
+        """ 
+        Args:
+            etiqueta (str) -> se descartan las entradas del espacio con esta etiqueta en todos los procesos, si es None
+                              se descartan todas las del espacio
+        """
+        try:
+            self._cache.incr(('generacion', self.nombre, etiqueta), default = 0)
+        except self._errores as error:
+            log.warning('cache compartido: no se pudo invalidar %s (%s)', etiqueta, error)
+            self._contar('errores')
+
+    def metricas(self):
+        """ 
+        Returns:
+            (dic) -> hits, misses, errores, entradas omitidas por tamano, numero de entradas y bytes en disco
+        """
+        with self._lock:
+            m = dict(self._metricas)
+        try:
+            m['entradas'] = len(self._cache)
+            m['bytes'] = self._cache.volume()
+        except self._errores:
+            pass
+        return m
+
+class _Serializado:
+    # valor ya serializado con pickle: diskcache lo guarda tal cual y al leerlo se deserializa el original
+    __slots__ = ('cuerpo',)
+
+    def __init__(self, cuerpo):
+        self.cuerpo = cuerpo
+
+    def __reduce__(self):
+        return (pickle.loads, (self.cuerpo,))
+
+class CacheLRU:
+    """ 
+    Cache en memoria con desalojo por tamano (LRU) y por tiempo de vida (TTL)
+
+    Cada entrada puede llevar etiquetas (tabla, agregacion...) para invalidar de una vez todas las
+    entradas que dependen de algo que cambio. Los valores guardados son compartidos entre callbacks,
+    por lo que no deben modificarse. Los calculos de una misma clave que coinciden en el tiempo (dos paneles
+    o dos usuarios pidiendo lo mismo) se hacen una sola vez, ver UnSoloVuelo.
+
+    Args:
+        max_items (int) -> numero maximo de entradas guardadas
+        ttl (float) -> segundos que vive una entrada, si es None no expiran
+        max_bytes (int) -> tamano maximo del total de las entradas, si es None solo se limita por numero
+        medir (func) -> funcion que regresa el tamano en bytes de un valor, se usa con max_bytes
+        compartido (obj) -> CacheCompartido opcional que se consulta antes de calcular un valor que no esta en memoria
+        nombre (str) -> nombre del cache en las metricas por callback
+    """
+
+    def __init__(self, max_items = 128, ttl = 600, max_bytes = None, medir = len, compartido = None, nombre = None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.medir = medir
+        self.compartido = compartido
+        self.nombre = nombre
+
+        self._datos = OrderedDict() # clave -> (valor, expiracion, etiquetas, bytes), del menos al mas reciente
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._metricas = {'hits': 0, 'misses': 0, 'desalojos': 0}
+        self._vuelos = UnSoloVuelo()
+
+    def get(self, clave):
+        """ 
+        Args:
+            clave (tuple) -> clave de la entrada
+
+        Returns:
+            (obj) -> valor guardado o None si no existe o ya expiro
+        """
+        with self._lock:
+            entrada = self._datos.get(clave)
+
+            if entrada is not None and entrada[1] is not None and entrada[1] < time.monotonic():
+                self._quitar(clave)
+                entrada = None
+
+            if entrada is None:
+                self._metricas['misses'] += 1
+            else:
+                self._datos.move_to_end(clave)
+                self._metricas['hits'] += 1
+
+        contar_consulta_cache(self.nombre, entrada is not None)
+        return None if entrada is None else entrada[0]
+
+    def set(self, clave, valor, etiquetas = ()):
+        """ 
+        Args:
+            clave (tuple) -> clave de la entrada
+            valor (obj) -> valor a guardar
+            etiquetas (tuple) -> etiquetas con las que se podra invalidar la entrada
+        """
+        expira = time.monotonic() + self.ttl if self.ttl is not None else None
+        tamano = self.medir(valor) if self.max_bytes is not None else 0
+
+        if self.max_bytes is not None and tamano > self.max_bytes: # no cabe, no se guarda
+            return
+
+        with self._lock:
+            if clave in self._datos:
+                self._quitar(clave)
+
+            self._datos[clave] = (valor, expira, frozenset(etiquetas), tamano)
+            self._bytes += tamano
+
+            while len(self._datos) > self.max_items or (self.max_bytes is not None and self._bytes > self.max_bytes):
+                self._quitar(next(iter(self._datos)))
+                self._metricas['desalojos'] += 1
+
+    def _quitar(self, clave):
+        # se llama con el lock tomado
+        self._bytes -= self._datos.pop(clave)[3]
+
+    def obtener(self, clave, calcular, etiquetas = ()):
+        """ 
+        Regresa el valor guardado o lo calcula y lo guarda. Si no esta en memoria se busca primero en el cache
+        compartido (calculado por otro proceso). Los mensajes de error (str) no se guardan, pero si se comparten
+        con las llamadas que esperaban el mismo calculo.
+
+        Args:
+            clave (tuple) -> clave de la entrada
+            calcular (func) -> funcion sin argumentos que genera el valor
+            etiquetas (tuple) -> etiquetas con las que se podra invalidar la entrada
+
+        Returns:
+            (obj) -> valor guardado o recien calculado
+        """
+        valor = self.get(clave)
+
+        if valor is None:
+            def calcular_y_guardar():
+                with self._lock: # otra llamada pudo guardarlo entre el get y el inicio del vuelo
+                    entrada = self._datos.get(clave)
+                if entrada is not None and (entrada[1] is None or entrada[1] >= time.monotonic()):
+                    return entrada[0]
+
+                if self.compartido is not None:
+                    v = self.compartido.get(clave, etiquetas)
+                    if v is not None:
+                        self.set(clave, v, etiquetas)
+                        return v
+
+                v = calcular()
+                if v is not None and not isinstance(v, str):
+                    self.set(clave, v, etiquetas)
+                    if self.compartido is not None:
+                        self.compartido.set(clave, v, etiquetas)
+                return v
+
+            valor = self._vuelos.hacer(clave, calcular_y_guardar)
+
+        return valor
+
+    def invalidar(self, etiqueta = None):
+        """ 
+        Args:
+            etiqueta (str) -> se descartan las entradas con esta etiqueta (tambien en el cache compartido), si es None se descartan todas
+        """
+        if self.compartido is not None:
+            self.compartido.invalidar(etiqueta)
+
+        with self._lock:
+            if etiqueta is None:
+                self._datos.clear()
+                self._bytes = 0
+                return
+
+            for clave in [c for c, e in self._datos.items() if etiqueta in e[2]]:
+                self._quitar(clave)
+
+    def metricas(self):
+        """ 
+        Returns:
+            (dic) -> hits, misses, desalojos, calculos compartidos (y esperas vencidas), numero de entradas guardadas y bytes medidos
+        """
+        with self._lock:
+            m = dict(self._metricas)
+            m['entradas'] = len(self._datos)
+            m['bytes'] = self._bytes
+        vuelos = self._vuelos.metricas()
+        m['compartidas'], m['vencidas'] = vuelos['compartidas'], vuelos['vencidas']
+        return m
+
+def cubo(conn, esquema = 'Dashboards', base = 'manzanas', datos = 'caracteristicas_poblacionales', agreg = 'sectores'):
+    """ 
+    Cubo de una tabla de datos en una agregacion, con todos los estadisticos de todas las columnas numericas
+
+    Se trae en una sola consulta (de la tabla pre-agregada si esta completa, o con la union en vivo) y se
+    guarda en cache_agregados, asi cambiar de columna o de estadistico ya no consulta la base de datos.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla con la minima granularidad
+        datos (str) -> tema o nombre de la tabla de datos
+        agreg (str) -> string con el nombre de la agregacion
+
+    Returns:
+        (obj) -> DataFrame con la columna de la agregacion, '<agreg>_cont' y '<columna>__<sufijo>' (compartido, no modificar)
+    """
+    d = tabla_tema(datos)
+
+    def calcular():
+        columnas = catalogo.numericas(d)
+        necesarias = {'{}__{}'.format(col, s) for col in columnas for s in SUFIJOS_ROLLUP.values()}
+
+        if necesarias <= catalogo.rollup(d, agreg):
+            Q = sql.SQL('SELECT * FROM {}.{}').format(sql.Identifier(esquema), sql.Identifier(rollup_nombre(d, agreg)))
+        else:
+            Q = cubo_query_constructor(esquema = esquema, base = base, datos = d, agreg = agreg, columnas = columnas)
+
+        tipos = {c: 'float64' for c in necesarias} # los estadisticos siempre como flotantes aunque vengan enteros
+        tipos['{}_cont'.format(agreg)] = 'int64'
+
+        return postgresql_to_dataframe(conn, Q, tipos = tipos)
+
+    return cache_agregados.obtener(('cubo', esquema, base, d, agreg), calcular, etiquetas = (d, agreg, base))
+
+def rebanar_cubo(cubo, agreg = 'sectores', col1_1 = 'POB1', col1_2 = 'POB2', estad1_1 = 'suma', estad1_2 = 'suma'):
+    """ 
+    Selecciona del cubo las columnas pedidas, con la misma forma que el resultado de map_query_constructor
+
+    Args:
+        cubo (obj) -> DataFrame regresado por cubo()
+        agreg (str) -> string con el nombre de la agregacion
+        col1_1 (str) -> string con el nombre de la columna del primer campo
+        col1_2 (str) -> string con el nombre de la columna del segundo campo
+        estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
+        estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
+
+    Returns:
+        (obj) -> DataFrame agregado, o None si el cubo no tiene alguna de las columnas
+    """
+    nombres = {agreg: agreg[0:4], agreg + '_cont': agreg + '_cont'}
+    conteos = [agreg + '_cont'] # enteros como en la consulta, en el cubo todos los estadisticos son flotantes
+
+    for col, est in ((col1_1, estad1_1), (col1_2, estad1_2)):
+        if col not in nombres.values():
+            nombres['{}__{}'.format(col, SUFIJOS_ROLLUP[ESTADISTICOS.get(est, 'COUNT')])] = col
+            if ESTADISTICOS.get(est, 'COUNT') == 'COUNT':
+                conteos.append(col)
+
+    if not set(nombres) <= set(cubo.columns):
+        return None
+
+    df = cubo[list(nombres)].rename(columns = nombres)
+    return df.astype({c: 'int64' for c in conteos})
+
+def agregados(conn, esquema = 'Dashboards',
+    base = 'manzanas',
+    datos = 'caracteristicas_poblacionales',
+    agreg = 'sectores',
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma'):
+    """ 
+    Tabla agregada por agregacion para las columnas y estadisticos pedidos, guardada en cache_agregados
+
+    La clave del cache se construye con los parametros normalizados (tabla real, columnas sin repetir y
+    funcion SQL de cada estadistico), asi mapa, grafica, descargas y el mapa maximizado comparten el resultado.
+    Con MODO_DATOS=cubo el resultado se rebana del cubo del tema y la agregacion en lugar de consultarse.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla con la minima granularidad
+        datos (str) -> tema o nombre de la tabla de datos
+        agreg (str) -> string con el nombre de la tabla con la que se agrupara y unira la base
+        col1_1 (str) -> string con el nombre de la columna del primer campo
+        col1_2 (str) -> string con el nombre de la columna del segundo campo
+        estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
+        estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
+
+    Returns:
+        (obj) -> DataFrame agregado (compartido, no modificar)
+    """
+    d = tabla_tema(datos)
+
+    if modo_datos == 'cubo': # se rebana el cubo en memoria, solo se consulta si el cubo no tiene la columna
+        c = cubo(conn, esquema=esquema, base=base, datos=d, agreg=agreg)
+        df = None if isinstance(c, str) else rebanar_cubo(c, agreg=agreg, col1_1=col1_1, col1_2=col1_2,
+                                                          estad1_1=estad1_1, estad1_2=estad1_2)
+        if df is not None:
+            return df
+
+    pares = {} # igual que en map_query_constructor, una columna repetida solo usa su primer estadistico
+    for col, est in ((col1_1, estad1_1), (col1_2, estad1_2)):
+        pares.setdefault(col, ESTADISTICOS.get(est, 'COUNT'))
+
+    clave = ('agregados', esquema, base, d, agreg, tuple(sorted(pares.items())))
+
+    def calcular():
+        return postgresql_to_dataframe(conn, agregados_query(esquema=esquema, base=base, datos=d, agreg=agreg,
+                                                             col1_1=col1_1, col1_2=col1_2, estad1_1=estad1_1, estad1_2=estad1_2),
+                                       modo = 'preparada') # la misma forma de consulta se repite en cada panel
+
+    return cache_agregados.obtener(clave, calcular, etiquetas = (d, agreg, base))
+
+def agregados_query(esquema = 'Dashboards',
+    base = 'manzanas',
+    datos = 'caracteristicas_poblacionales',
+    agreg = 'sectores',
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma'):
+    """ 
+    Query de la tabla agregada: de la tabla pre-agregada si tiene todas las columnas, si no con la union completa
+
+    Args:
+        (mismos que agregados, sin conn)
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql)
+    """
+    d = tabla_tema(datos)
+
+    necesarias = {'{}__{}'.format(col, SUFIJOS_ROLLUP[ESTADISTICOS.get(est, 'COUNT')]) for col, est in ((col1_1, estad1_1), (col1_2, estad1_2))}
+
+    if necesarias <= catalogo.rollup(d, agreg):
+        return rollup_query_constructor(esquema=esquema, datos=d, agreg=agreg,
+                                        col1_1=col1_1, col1_2=col1_2, estad1_1=estad1_1, estad1_2=estad1_2)
+
+    return map_query_constructor(esquema=esquema, agreg=agreg, base=base, datos=d,
+                                 col1_1=col1_1, col1_2=col1_2, estad1_1=estad1_1, estad1_2=estad1_2)
+
+def exportar_query(esquema = 'Dashboards',
+    base = 'manzanas',
+    datos = 'caracteristicas_poblacionales',
+    agreg = 'sectores',
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma'):
+    """ 
+    Query de la tabla de descarga: cada geometria de la agregacion (sin la geometria) con sus datos agregados
+
+    Args:
+        (mismos que agregados, sin conn)
+
+    Returns:
+        (obj) -> query compuesto (psycopg2.sql)
+    """
+    cols = [sql.SQL('a.{}').format(sql.Identifier(col)) for col in dict.fromkeys([col1_1, col1_2])]
+
+    sub = agregados_query(esquema=esquema, base=base, datos=datos, agreg=agreg,
+                          col1_1=col1_1, col1_2=col1_2, estad1_1=estad1_1, estad1_2=estad1_2)
+
+    return sql.SQL('SELECT g.id as {loc}, g.ident, a.{cont}, {cols} FROM {esq}.{agreg} as g LEFT JOIN ({sub}) as a ON a.{loc} = g.id ORDER BY g.id').format(
+        loc = sql.Identifier(agreg[0:4]),
+        cont = sql.Identifier(agreg + '_cont'),
+        cols = sql.SQL(', ').join(cols),
+        esq = sql.Identifier(esquema),
+        agreg = sql.Identifier(agreg),
+        sub = sub)
+
+def tipos_exportacion(agreg = 'sectores', col1_1 = 'POB1', col1_2 = 'POB2'):
+    """ 
+    Tipos fijos de las columnas de exportar_query, iguales en todos los bloques de la descarga
+
+    Args:
+        agreg (str) -> string con el nombre de la agregacion
+        col1_1 (str) -> string con el nombre de la primera columna
+        col1_2 (str) -> string con el nombre de la segunda columna
+
+    Returns:
+        (dic) -> columna -> tipo de pandas; 'ident' como texto para no perder ceros a la izquierda
+    """
+    tipos = {agreg[0:4]: 'int64', 'ident': 'str', agreg + '_cont': 'float64'}
+    tipos.update({col: 'float64' for col in (col1_1, col1_2)})
+    return tipos
+
+def filas_exportacion(conn, select_query, tamano = 5000, tipos = None):
+    """ 
+    Lee un query en bloques sin traer todo a memoria
+
+    El resultado se copia con COPY a un archivo temporal (en memoria hasta EXPORT_SPOOL_MB, despues en disco)
+    y la conexion se regresa al pool en cuanto termina la copia; los bloques se leen del archivo. El primer
+    bloque sale hasta que termina toda la copia: a cambio, una descarga lenta no retiene una conexion del
+    pool y un error de la base de datos ocurre antes de mandar el primer byte.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        select_query (obj) -> query compuesto (psycopg2.sql) o string con la consulta
+        tamano (int) -> filas por bloque
+        tipos (dic) -> columna -> tipo de pandas; sin tipos fijos cada bloque adivina los suyos y pueden no coincidir
+
+    Returns:
+        (generator) -> DataFrames de hasta 'tamano' filas, con los nulos numericos en 0 como en la descarga anterior
+    """
+    tipos = tipos or {}
+    numericas = {c: 0 for c, t in tipos.items() if t != 'str'}
+
+    def ajustar(df):
+        df = df.fillna(numericas) if tipos else df.fillna(0)
+        return df.astype({c: t for c, t in tipos.items() if c in df.columns})
+
+    if isinstance(conn, BackendDuckDB):
+        for df in conn.bloques(select_query, tamano = tamano):
+            yield ajustar(df)
+        return
+
+    with tempfile.SpooledTemporaryFile(max_size = spool_exportacion) as archivo:
+        with conn.conexion() as c:
+            copiar_query(c, select_query, archivo)
+
+        opciones = {}
+        if tipos: # en el CSV de COPY solo el campo vacio es nulo; un ident 'NA' es texto
+            opciones = {'dtype': {c: ('float64' if t == 'int64' else t) for c, t in tipos.items()}, # int64 con nulos se llena antes de convertir
+                        'keep_default_na': False, 'na_values': {c: [''] for c in tipos}}
+
+        for df in pd.read_csv(archivo, chunksize = tamano, **opciones):
+            yield ajustar(df)
+
+def exportar_csv(bloques):
+    """ 
+    Args:
+        bloques (generator) -> DataFrames de filas_exportacion
+
+    Returns:
+        (generator) -> bytes del CSV, un pedazo por bloque
+    """
+    encabezado = True
+    for df in bloques:
+        yield df.to_csv(index = False, header = encabezado).encode('utf-8')
+        encabezado = False
+
+class _Tubo:
+    # archivo de solo escritura que junta lo escrito por pyarrow para mandarlo por pedazos
+    closed = False
+
+    def __init__(self):
+        self._partes = []
+
+    def write(self, datos):
+        self._partes.append(bytes(datos))
+        return len(datos)
+
+    def flush(self):
+        pass
+
+    def vaciar(self):
+        datos = b''.join(self._partes)
+        self._partes = []
+        return datos
+
+def exportar_arrow(bloques, formato = 'arrow'):
+    """ 
+    Escribe los bloques en Parquet (un row group por bloque) o en Arrow IPC stream, mandando cada bloque al terminarlo
+
+    Args:
+        bloques (generator) -> DataFrames de filas_exportacion
+        formato (str) -> 'parquet' o 'arrow'
+
+    Returns:
+        (generator) -> bytes del archivo, un pedazo por bloque
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tubo = _Tubo()
+    sink = pa.PythonFile(tubo, mode = 'w')
+    escritor, esquema_arrow = None, None
+
+    for df in bloques:
+        tabla = pa.Table.from_pandas(df, schema = esquema_arrow, preserve_index = False)
+
+        if escritor is None: # el esquema del primer bloque se usa para todos
+            esquema_arrow = tabla.schema
+            escritor = pq.ParquetWriter(sink, esquema_arrow) if formato == 'parquet' else pa.ipc.new_stream(sink, esquema_arrow)
+
+        escritor.write_table(tabla)
+        yield tubo.vaciar()
+
+    if escritor is not None:
+        escritor.close()
+    yield tubo.vaciar()
+
+class CatalogoMetadatos:
+    """ 
+    Catalogo en memoria con las columnas y descripciones de las tablas de datos
+
+    Se carga de la base de datos una vez (al arrancar o en la primera consulta) y despues todas las
+    busquedas son sobre diccionarios. Si se define un intervalo de refresco, el catalogo se vuelve a
+    leer cuando pasa ese tiempo desde la ultima carga.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        tablas (list) -> nombres de las tablas de datos a catalogar
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        refresco (float) -> segundos entre recargas del catalogo, si es None o 0 no se recarga
+    """
+
+    def __init__(self, conn, tablas, esquema = 'Dashboards', refresco = None):
+        self.conn = conn
+        self.tablas = list(tablas)
+        self.esquema = esquema
+        self.refresco = refresco
+
+        self._columnas = {} # tabla -> [columnas de datos]
+        self._numericas = {} # tabla -> [columnas de datos numericas]
+        self._descripciones = {} # tabla -> {columna: descripcion}
+        self._opciones = {} # tabla -> {columna: descripcion} para los dropdowns
+        self._rollups = {} # nombre de tabla pre-agregada -> {columnas}
+        self._cargado = None
+        self._vencido = False # una tabla cambio, se recarga en la siguiente consulta
+        self._lock = threading.Lock()
+        self._carga = threading.RLock() # solo un hilo recarga, los demas usan el catalogo actual
+
+    def cargar(self):
+        """ 
+        Lee de la base de datos las columnas y descripciones de todas las tablas del catalogo
+        """
+        with self._carga: # la precarga al arrancar y la primera consulta no leen el catalogo dos veces
+            self._cargar()
+
+    def _cargar(self):
+        columnas, numericas, descripciones, opciones = {}, {}, {}, {}
+
+        for tabla in self.tablas:
+            cols = query_columnas(self.conn, esquema = self.esquema, datos = tabla)
+            if isinstance(cols, str):
+                raise RuntimeError('no se pudo cargar el catalogo de {}'.format(tabla))
+
+            if isinstance(self.conn, BackendDuckDB): # sin pg_description, los tipos y descripciones los da el backend
+                numericas[tabla] = self.conn.columnas(self.esquema, tabla, numericas = True)
+                descripciones[tabla] = self.conn.descripciones(tabla)
+
+            else:
+                nums = postgresql_to_dataframe(self.conn, columnas_numericas_query(esquema = self.esquema, datos = tabla))
+                desc = postgresql_to_dataframe(self.conn, col_description_query(tabla = tabla, esquema = self.esquema),
+                                               tipos = {'col': 'str', 'description': 'str'})
+
+                if isinstance(nums, str) or isinstance(desc, str):
+                    raise RuntimeError('no se pudo cargar el catalogo de {}'.format(tabla))
+
+                desc = desc.dropna(subset = ['description']) # sin descripcion se muestra el nombre de la columna
+                descripciones[tabla] = dict(zip(desc['col'], desc['description']))
+                numericas[tabla] = nums['column_name'].to_list()
+
+            columnas[tabla] = cols
+            opciones[tabla] = {c: descripciones[tabla].get(c, c) for c in cols}
+
+        rollups = {}
+        if not isinstance(self.conn, BackendDuckDB):
+            r = postgresql_to_dataframe(self.conn, sql.SQL("""SELECT table_name, column_name FROM information_schema.columns
+                                                        WHERE table_schema = {} AND table_name LIKE 'rollup\\_%'""").format(sql.Literal(self.esquema)))
+            if isinstance(r, str):
+                raise RuntimeError('no se pudieron leer las tablas pre-agregadas')
+            rollups = r.groupby('table_name')['column_name'].agg(set).to_dict()
+
+        with self._lock:
+            self._columnas, self._numericas = columnas, numericas
+            self._descripciones, self._opciones = descripciones, opciones
+            self._rollups = rollups
+            self._cargado = time.monotonic()
+            self._vencido = False
+
+        log.info('catalogo de metadatos cargado: %s', {t: len(c) for t, c in columnas.items()})
+
+    def _pendiente(self):
+        return self._cargado is None or self._vencido or (self.refresco and time.monotonic() - self._cargado > self.refresco)
+
+    def _vigente(self):
+        # carga perezosa y recarga cuando se cumple el intervalo de refresco
+        if not self._pendiente():
+            return
+
+        if self._cargado is not None: # ya hay catalogo: si otro hilo esta recargando se usa el actual
+            if not self._carga.acquire(blocking = False):
+                return
+        else: # primera carga: se espera a la que ya esta en curso
+            self._carga.acquire()
+
+        try:
+            if not self._pendiente(): # otro hilo lo cargo mientras se esperaba
+                return
+            try:
+                self.cargar()
+            except Exception as error:
+                if self._cargado is None:
+                    raise
+                log.warning('no se pudo refrescar el catalogo, se usa el anterior: %s', error)
+                self._cargado = time.monotonic()
+                self._vencido = False
+        finally:
+            self._carga.release()
+
+    def invalidar(self):
+        """ 
+        Marca el catalogo para recargarlo en la siguiente consulta, conservando el actual si la recarga falla
+        """
+        self._vencido = True
+
+    def columnas(self, tabla):
+        """ 
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+
+        Returns:
+            (list) -> columnas de datos de la tabla
+        """
+        self._vigente()
+        return self._columnas.get(tabla, [])
+
+    def numericas(self, tabla):
+        """ 
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+
+        Returns:
+            (list) -> columnas de datos numericas de la tabla
+        """
+        self._vigente()
+        return self._numericas.get(tabla, [])
+
+    def descripcion(self, tabla, col):
+        """ 
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+            col (str) -> nombre de la columna
+
+        Returns:
+            (str) -> descripcion de la columna, o su nombre si no tiene
+        """
+        self._vigente()
+        return self._descripciones.get(tabla, {}).get(col, col)
+
+    def etiqueta(self, tabla, col, estad):
+        """ 
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+            col (str) -> nombre de la columna
+            estad (str) -> estadistico aplicado a la columna
+
+        Returns:
+            (str) -> texto para los ejes y leyendas, p. ej. 'suma de Poblacion total'
+        """
+        return '{} de {}'.format(estad, self.descripcion(tabla, col))
+
+    def rollup(self, tabla, agreg):
+        """ 
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+            agreg (str) -> string con el nombre de la agregacion
+
+        Returns:
+            (set) -> columnas de la tabla pre-agregada, vacio si no existe
+        """
+        self._vigente()
+        return self._rollups.get(rollup_nombre(tabla, agreg), set())
+
+    def opciones(self, tabla):
+        """ 
+        Args:
+            tabla (str) -> nombre de la tabla de datos
+
+        Returns:
+            (dic) -> opciones {columna: descripcion} para los dropdowns de columnas
+        """
+        self._vigente()
+        return self._opciones.get(tabla, {})
+
+class VigilanteCambios:
+    """ 
+    Hilo que escucha en una conexion propia los avisos de cambios en las tablas y descarta lo que dependia de ellas
+
+    Las tablas con el disparador de disparador_query avisan por LISTEN/NOTIFY en cuanto se confirma la
+    transaccion. Las que no lo tienen se revisan cada 'sondeo' segundos comparando los contadores de
+    pg_stat_user_tables (postgres los publica con algunos segundos de retraso). Si la conexion se cae se
+    reintenta y, como pudieron perderse avisos, al reconectar se descarta todo lo vigilado.
+
+    Args:
+        params_dic (dic) -> diccionario con los datos que se usan para la conecicon
+        tablas (list) -> tablas vigiladas del esquema
+        al_cambiar (func) -> funcion que recibe el conjunto de tablas que cambiaron
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        sondeo (float) -> segundos entre revisiones de pg_stat_user_tables, 0 para solo escuchar avisos
+        reintento (float) -> segundos de espera antes de volver a conectar
+    """
+
+    def __init__(self, params_dic, tablas, al_cambiar, esquema = 'Dashboards', sondeo = 60, reintento = 30):
+        self.params_dic = params_dic
+        self.tablas = set(tablas)
+        self.al_cambiar = al_cambiar
+        self.esquema = esquema
+        self.sondeo = sondeo
+        self.reintento = reintento
+
+        self._contadores = {} # tabla sin disparador -> cambios vistos en el ultimo sondeo
+        self._alto = threading.Event()
+        self._hilo = None
+        self._lock = threading.Lock()
+        self._metricas = {'avisos': 0, 'sondeos': 0, 'invalidaciones': 0, 'reconexiones': 0}
+
+    def iniciar(self):
+        """ 
+        Arranca el hilo, si no esta corriendo
+        """
+        if self._hilo is None or not self._hilo.is_alive():
+            self._alto.clear()
+            self._hilo = threading.Thread(target = self._correr, name = 'vigilante-cambios', daemon = True)
+            self._hilo.start()
+
+    def detener(self):
+        """ 
+        Pide al hilo que termine, lo hace en menos de un segundo
+        """
+        self._alto.set()
+
+    def _contar(self, nombre, n = 1):
+        with self._lock:
+            self._metricas[nombre] += n
+
+    def _avisar(self, tablas):
+        tablas = tablas & self.tablas
+        if tablas:
+            log.info('cambiaron %s, se descartan sus datos en cache', sorted(tablas))
+            self._contar('invalidaciones', len(tablas))
+            try:
+                self.al_cambiar(tablas)
+            except Exception: # una falla al invalidar no debe tumbar al hilo
+                log.exception('no se pudo invalidar %s', sorted(tablas))
+
+    def _sondear(self, cursor):
+        # regresa las tablas sin disparador cuyos contadores cambiaron desde el sondeo anterior
+        cursor.execute(cambios_query(esquema = self.esquema))
+        cambiadas, contadores = set(), {}
+
+        for tabla, cambios, disparador in cursor.fetchall():
+            if disparador or tabla not in self.tablas:
+                continue
+            contadores[tabla] = cambios
+            if tabla in self._contadores and self._contadores[tabla] != cambios:
+                cambiadas.add(tabla)
+
+        self._contadores = contadores
+        self._contar('sondeos')
+        return cambiadas
+
+    def _escuchar(self, conn):
+        with conn.cursor() as cursor:
+            cursor.execute(sql.SQL('LISTEN {}').format(sql.Identifier(CANAL_CAMBIOS)))
+            self._sondear(cursor) # contadores de referencia
+            siguiente = time.monotonic() + self.sondeo
+
+            while not self._alto.is_set():
+                espera = min(1, max(0, siguiente - time.monotonic())) if self.sondeo else 1 # revisa _alto cada segundo
+
+                if select.select([conn], [], [], espera) != ([], [], []):
+                    conn.poll()
+                    tablas = set()
+                    while conn.notifies:
+                        aviso = conn.notifies.pop(0)
+                        esquema, _, tabla = aviso.payload.partition('.')
+                        if esquema == self.esquema:
+                            tablas.add(tabla)
+                    self._contar('avisos', len(tablas))
+                    self._avisar(tablas)
+
+                if self.sondeo and time.monotonic() >= siguiente:
+                    self._avisar(self._sondear(cursor))
+                    siguiente = time.monotonic() + self.sondeo
+
+    def _correr(self):
+        conectado = False
+
+        while not self._alto.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self.params_dic)
+                conn.autocommit = True # LISTEN y los avisos solo llegan fuera de una transaccion
+
+                if conectado: # durante la desconexion pudieron perderse avisos
+                    self._contar('reconexiones')
+                    self._avisar(set(self.tablas))
+                conectado = True
+
+                self._escuchar(conn)
+            except psycopg2.Error as error:
+                log.warning('vigilante de cambios sin conexion, se reintenta en %s s: %s', self.reintento, error)
+                self._alto.wait(self.reintento)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+    def metricas(self):
+        """ 
+        Returns:
+            (dic) -> avisos recibidos, sondeos hechos, tablas invalidadas y reconexiones
+        """
+        with self._lock:
+            return dict(self._metricas)
+
+def invalidar_cambios(tablas):
+    """ 
+    Descarta de los caches solo lo que depende de las tablas que cambiaron
+
+    Args:
+        tablas (set) -> nombres de las tablas del esquema que cambiaron
+    """
+    for tabla in tablas:
+        if tabla in bds: # tabla de datos: sus agregados, figuras y teselas; las columnas pudieron cambiar
+            cache_agregados.invalidar(tabla)
+            cache_figuras.invalidar(tabla)
+            invalidar_teselas(tabla)
+            catalogo.invalidar()
+
+        elif tabla in agreg: # capa de una agregacion: sus geometrias y todo lo agregado en ella
+            cache_geo.invalidar(tabla, esquema = esqu)
+            cache_vista.invalidar(tabla)
+            cache_agregados.invalidar(tabla)
+            cache_figuras.invalidar(tabla)
+
+        elif tabla == 'manzanas': # la base entra en todos los agregados y en las teselas
+            cache_agregados.invalidar(tabla)
+            cache_figuras.invalidar()
+            invalidar_teselas()
+
+        elif tabla.startswith('rollup_'): # la tabla pre-agregada se cambio desde otro proceso
+            catalogo.invalidar()
+            for d in bds:
+                for ag in agreg:
+                    if tabla == rollup_nombre(d, ag):
+                        cache_agregados.invalidar(d)
+                        cache_figuras.invalidar(d)
+
+def ruta_geojson(conn, agreg = 'sectores', esquema = 'Dashboards', nivel = 'panel'):
+    """ 
+    URL de la capa en la ruta /geo/<agreg>.geojson, con la version del contenido para que el navegador la guarde
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        agreg (str) -> string con el nombre de la agregacion
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        nivel (str) -> nivel de detalle
+
+    Returns:
+        (str) -> URL relativa de la capa, o None si no se pudo cargar
+    """
+    g = cache_geo.geojson(conn, agreg = agreg, esquema = esquema, nivel = nivel)
+    if isinstance(g, str):
+        return None
+    return app.get_relative_path('/geo/{}.geojson?nivel={}&v={}'.format(agreg, nivel, g[2][0:12]))
+
+def limites_vista(relayout, ancho = 800, alto = 450):
+    """ 
+    Vista actual del mapa a partir del relayoutData de un dcc.Graph con mapbox
+
+    Usa las esquinas que manda plotly en 'mapbox._derived'; si no vienen, las calcula con el centro, el zoom y
+    el tamano del mapa en pixeles (mapbox gl usa teselas de 512 px).
+
+    Args:
+        relayout (dic) -> relayoutData del mapa
+        ancho (int) -> ancho del mapa en pixeles
+        alto (int) -> alto del mapa en pixeles
+
+    Returns:
+        (dic) -> 'centro' {'lat', 'lon'}, 'zoom' y 'limites' (oeste, sur, este, norte), o None si el evento no movio el mapa
+    """
+    if not relayout or 'mapbox.center' not in relayout:
+        return None
+
+    centro = relayout['mapbox.center']
+    zoom = float(relayout.get('mapbox.zoom', zoom_mapa))
+    esquinas = (relayout.get('mapbox._derived') or {}).get('coordinates')
+
+    if esquinas:
+        lons, lats = [e[0] for e in esquinas], [e[1] for e in esquinas]
+        limites = (min(lons), min(lats), max(lons), max(lats))
+    else:
+        mundo = 512 * 2 ** zoom # pixeles que mide el mundo en ese zoom
+        dx = ancho / 2 / mundo * 360
+        yc = math.log(math.tan(math.pi / 4 + math.radians(centro['lat']) / 2)) # latitud en mercator
+        dy = alto / 2 / mundo * 2 * math.pi
+        lat = lambda y: math.degrees(2 * math.atan(math.exp(y)) - math.pi / 2)
+        limites = (centro['lon'] - dx, lat(yc - dy), centro['lon'] + dx, lat(yc + dy))
+
+    return {'centro': centro, 'zoom': zoom, 'limites': limites}
+
+def teselas_vista(limites, zoom, maximo = 16):
+    """ 
+    Teselas (esquema XYZ de web mercator) que cubren una vista
+
+    Se usa un nivel menos que el zoom de la vista, asi la vista cabe en pocas teselas y moverse un poco
+    reutiliza las mismas; si aun son mas de 'maximo' se sube de nivel.
+
+    Args:
+        limites (tuple) -> (oeste, sur, este, norte) en grados
+        zoom (float) -> zoom de la vista
+        maximo (int) -> numero maximo de teselas
+
+    Returns:
+        (tuple) -> (z, [(x, y), ...])
+    """
+    oeste, sur, este, norte = limites
+    z = max(0, int(zoom) - 1)
+
+    while True:
+        n = 2 ** z
+        columna = lambda lon: min(n - 1, max(0, int((lon + 180) / 360 * n)))
+        fila = lambda lat: min(n - 1, max(0, int((1 - math.asinh(math.tan(math.radians(max(-85.0511, min(85.0511, lat))))) / math.pi) / 2 * n)))
+        xs, ys = range(columna(oeste), columna(este) + 1), range(fila(norte), fila(sur) + 1)
+
+        if len(xs) * len(ys) <= maximo or z == 0:
+            return z, [(x, y) for x in xs for y in ys]
+        z -= 1
+
+def limites_tesela(z, x, y):
+    """ 
+    Args:
+        z, x, y (int) -> coordenadas de la tesela
+
+    Returns:
+        (tuple) -> (oeste, sur, este, norte) de la tesela en grados
+    """
+    n = 2 ** z
+    lat = lambda fila: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * fila / n))))
+    return (x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y))
+
+def capa_vista(conn, agreg = 'sectores', esquema = 'Dashboards', limites = (-180, -85, 180, 85), zoom = 12):
+    """ 
+    Geometrias de la agregacion que tocan la vista, leidas por teselas y guardadas en cache_vista
+
+    Cada tesela se consulta con geo_vista_query y se simplifica a un pixel de su nivel; al mover el mapa solo
+    se leen las teselas nuevas. Con BACKEND=duckdb (sin extension espacial) las teselas se recortan de la capa
+    completa en memoria con su indice espacial.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        agreg (str) -> string con el nombre de la agregacion
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        limites (tuple) -> (oeste, sur, este, norte) de la vista en grados
+        zoom (float) -> zoom de la vista
+
+    Returns:
+        (obj) -> GeoDataFrame indexado por 'id' con los poligonos de la vista, o el mensaje de error
+    """
+    z, teselas = teselas_vista(limites, zoom)
+    tolerancia = 360 / (256 * 2 ** (z + 1)) # un pixel con el zoom mas lejano que usa estas teselas
+
+    def tesela(x, y):
+        def calcular():
+            oeste, sur, este, norte = limites_tesela(z, x, y)
+
+            if isinstance(conn, BackendDuckDB):
+                completa = cache_geo.obtener(conn, agreg = agreg, esquema = esquema)
+                if isinstance(completa, str):
+                    return completa
+                return simplificar(completa.cx[oeste:este, sur:norte], tolerancia)
+
+            gdf = postgresql_to_GEOdataframe(conn, geo_vista_query(esquema = esquema, agreg = agreg, limites = (oeste, sur, este, norte)))
+            if isinstance(gdf, str):
+                return gdf
+            return simplificar(gdf.set_index('id'), tolerancia)
+
+        return cache_vista.obtener(('vista', esquema, agreg, z, x, y), calcular, etiquetas = (agreg,))
+
+    partes = []
+    for x, y in teselas:
+        parte = tesela(x, y)
+        if isinstance(parte, str):
+            return parte
+        partes.append(parte)
+
+    gdf = pd.concat(partes)
+    return gdf[~gdf.index.duplicated()] # un poligono que cruza teselas viene en cada una
+
+def unir_capa(gdf1, df1, agreg1 = 'sectores'):
+    """ 
+    Une la capa de geometrias con la tabla agregada; los poligonos sin datos quedan en 0
+
+    Args:
+        gdf1 (obj) -> GeoDataFrame de la agregacion indexado por 'id'
+        df1 (obj) -> DataFrame agregado con la columna de los primeros 4 caracteres de la agregacion
+        agreg1 (str) -> string con el nombre de la agregacion
+
+    Returns:
+        (obj) -> GeoDataFrame unido, indexado por la columna de la agregacion
+    """
+    loc1 = agreg1[0:4]
 
     un1 = pd.merge(gdf1,df1,how='left', left_on=gdf1.index,right_on=loc1 )
     un1.set_index(loc1, inplace = True)
     un1 = un1.fillna(0)
     un1[loc1]= un1.index.values
+
+    return un1
+
+def figura_error(mensaje):
+    """ 
+    Args:
+        mensaje (str) -> texto que se muestra al usuario
+
+    Returns:
+        (obj) -> figura vacia de plotly con el mensaje al centro
+    """
+    fig = go.Figure()
+    fig.update_layout(xaxis = {'visible': False}, yaxis = {'visible': False},
+                      annotations = [{'text': mensaje, 'showarrow': False, 'font': {'size': 16}}])
+    return fig
+
+def mapa(conn, esquema = 'Dashboards',
+    base = 'manzanas' ,
+    datos = 'caracteristicas_poblacionales',
+
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma',
+
+    agreg1 = 'sectores',
+    nivel = 'panel',
+    vista = None):
+    """ 
+    Mapa coropletico de una columna agregada por agregacion
+
+    Une la tabla agregada (agregados, en cache_agregados) con la capa de geometrias (cache_geo o, con una vista,
+    capa_vista) y arma la figura de plotly coloreada con col1_1.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla con la minima granularidad
+        datos (str) -> tema o nombre de la tabla de datos
+        col1_1 (str) -> string con el nombre de la columna del mapa
+        col1_2 (str) -> string con el nombre de la columna del color de la grafica
+        estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
+        estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
+        agreg1 (str) -> string con el nombre de la agregacion
+        nivel (str) -> nivel de detalle de las geometrias: 'panel' para el mapa del panel, 'modal' para el mapa maximizado
+        vista (dic) -> vista de limites_vista; si se da solo se pintan los poligonos dentro de ella (ver capa_vista)
+
+    Returns:
+        (tuple) -> (figura, GeoDataFrame unido de la agregacion); si falla la consulta, una figura con el aviso y None
+    """
+
+    #obtener los primeros 4 caracteres de la columna de agregacion para crear los nombres de las nuevas columnas de agrupacion
+    loc1 = agreg1[0:4]
+
+    d = tabla_tema(datos) #  elije entre las opciones de tablas de datos para la variable datos
+
+    df1 = agregados(conn, esquema=esquema, #obtener el primer DF, compartido con las demas vistas del mismo estado
+                    agreg=agreg1, 
+                    base=base ,
+                    datos=datos ,
+                    col1_1=col1_1,
+                    col1_2=col1_2,
+                    estad1_1=estad1_1,
+                    estad1_2=estad1_2
+                    )
+
+    if vista is None:
+        gdf1 = cache_geo.obtener(conn, agreg=agreg1, esquema=esquema, nivel=nivel) #obtener el primer GDF, ya indexado por id y simplificado
+    else:
+        gdf1 = capa_vista(conn, agreg=agreg1, esquema=esquema, limites=vista['limites'], zoom=vista['zoom'])
+
+    if isinstance(df1, str) or isinstance(gdf1, str): # error en la consulta, el panel muestra el aviso en lugar del mapa
+        log.error('mapa %s de %s: %s', agreg1, d, df1 if isinstance(df1, str) else gdf1)
+        return figura_error('No se pudieron consultar los datos del mapa'), None
+
+    if vista is None:
+        log.info('mapa %s nivel %s: %s poligonos, %s bytes de geojson', agreg1, nivel, len(gdf1),
+                 cache_geo.peso_geojson(conn, agreg=agreg1, esquema=esquema, nivel=nivel))
+    else:
+        log.info('mapa %s en la vista %s: %s poligonos', agreg1, vista['limites'], len(gdf1))
+
+    #graficando el primer mapa
+
+    un1 = unir_capa(gdf1, df1, agreg1)
     l1 = un1.columns.to_list()
     l1.remove('geom')
-    labs1 = {
-            col1_2: estad1_1 + ' de ' + col_desc[col_desc['col']== col1_2].iloc[0,1],
-            col1_1: estad1_2 + ' de ' + col_desc[col_desc['col']== col1_1].iloc[0,1],
+
+
+
+    labs1 = { #labels
+            col1_2: catalogo.etiqueta(d, col1_2, estad1_2),
+            col1_1: catalogo.etiqueta(d, col1_1, estad1_1),
             'ident':agreg1,
             agreg1+'_cont':'conteo de manzanas',
             loc1:agreg1,
             'index':'id'
             }
 
-    #----------------------------------------------------------------------------------------------------
-    fig = px.bar(un1.loc[un1[loc1].isin(sel1)] , width=800,
-                    x=col1_1, y='ident',
-                    orientation='h' ,
-                    hover_name= 'ident', 
-                    hover_data=l1,
-                    color = col1_2,
-                    labels=labs1
-                    )
-    
-    fig.update_layout(margin={"r":10,"t":10,"l":10,"b":10},
-                        height = len(un1.loc[un1[loc1].isin(sel1)].index) * 50, 
-                        coloraxis_colorbar = dict( titleside = 'right'),
-                        barmode='stack', 
-                        yaxis={'categoryorder':'total ascending'}
-                        )
+    #----------------------------------------------------------------------------------------------------
+    #con GEOJSON_URL la figura solo referencia la capa por URL y lleva los valores, las geometrias se descargan una vez
+    geo1 = ruta_geojson(conn, agreg=agreg1, esquema=esquema, nivel=nivel) if geojson_url and esquema == esqu and vista is None else None
+
+    fig = px.choropleth_mapbox(un1, width = 800,
+                               geojson=geo1 if geo1 else un1.geometry, 
+                               featureidkey='id',
+                               locations=un1.index , color=col1_1,
+                               hover_name= 'ident',
+                               hover_data=l1,
+                               color_continuous_scale="Viridis",
+                               range_color=(df1[col1_1].min(), df1[col1_1].max()),
+                               mapbox_style="carto-positron",
+                               zoom=zoom_mapa if vista is None else vista['zoom'], 
+                               center = centro_mapa if vista is None else vista['centro'],
+                               opacity=0.5,
+                               labels=labs1
+                               )
+    fig.update_layout(margin={"r":10,"t":10,"l":10,"b":10},coloraxis_colorbar = dict( titleside = 'right'), autosize=True,
+                      uirevision = agreg1) # el navegador conserva el centro y el zoom al cambiar la figura de la misma agregacion
+
+    return fig ,un1
+
+def cortes_manzanas(conn, esquema = 'Dashboards', base = 'manzanas', datos = 'caracteristicas_poblacionales', col = 'POB1', clases = CLASES_MANZANAS):
+    """ 
+    Cortes por cuantiles de una columna para las clases del mapa de manzanas, guardados en cache_agregados
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla de manzanas
+        datos (str) -> tema o nombre de la tabla de datos
+        col (str) -> columna de la tabla de datos
+        clases (int) -> numero de clases
+
+    Returns:
+        (list) -> cortes distintos y ordenados (hasta clases + 1 valores), vacia si no se pudieron calcular
+    """
+    d = tabla_tema(datos)
+
+    c = cache_agregados.obtener(('cortes', esquema, d, col, clases),
+                                lambda: postgresql_to_dataframe(conn, cortes_query(esquema = esquema, datos = d, col = col, clases = clases),
+                                                                modo = 'read_sql'), # percentile_cont regresa un arreglo
+                                etiquetas = (d, base))
+
+    return sorted(set(v for v in c['cortes'].iloc[0] if v is not None)) if not isinstance(c, str) else []
+
+def rango_clase(cortes, clase):
+    """ 
+    Args:
+        cortes (list) -> cortes de cortes_manzanas
+        clase (int) -> indice de la clase
+
+    Returns:
+        (tuple) -> (minimo, maximo) de la clase, la ultima incluye el maximo; None si la clase no existe
+    """
+    if not 0 <= clase < len(cortes) - 1:
+        return None
+    return cortes[clase], (cortes[clase + 1] if clase < len(cortes) - 2 else math.inf)
+
+def mapa_manzanas(conn, esquema = 'Dashboards',
+    base = 'manzanas',
+    datos = 'caracteristicas_poblacionales',
+    col1_1 = 'POB1',
+    clases = CLASES_MANZANAS,
+    width = 800):
+    """ 
+    Mapa a nivel manzana con teselas vectoriales de /tiles, sin mandar las geometrias en la figura
+
+    Los valores se dividen en clases por cuantiles y cada clase es una capa vectorial con su color, porque
+    las capas de mapbox en plotly solo tienen un color por capa.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        base (str) -> string con el nombre de la tabla de manzanas
+        datos (str) -> tema o nombre de la tabla de datos
+        col1_1 (str) -> columna que se pinta
+        clases (int) -> numero de clases de color
+        width (int) -> ancho de la figura
+
+    Returns:
+        (obj) -> figura de plotly
+    """
+    d = tabla_tema(datos)
+
+    cortes = cortes_manzanas(conn, esquema = esquema, base = base, datos = d, col = col1_1, clases = clases)
+    colores = escalas.sample_colorscale('Viridis', max(len(cortes) - 1, 1))
+
+    # en un callback en segundo plano no hay request de flask, dash guarda el origen de la peticion en el contexto
+    servidor = flask.request.host_url.rstrip('/') if flask.has_request_context() else ctx.origin.rstrip('/')
+
+    fig = go.Figure()
+    capas = []
+
+    for i in range(len(cortes) - 1):
+        url = servidor + app.get_relative_path( # mapbox necesita URLs absolutas para las teselas
+            '/tiles/{}/{}/{{z}}/{{x}}/{{y}}.pbf?clase={}'.format(d, col1_1, i))
+
+        capas.append({'sourcetype': 'vector', 'source': [url], 'sourcelayer': base, 'type': 'fill',
+                      'color': colores[i], 'opacity': 0.6, 'below': 'traces'})
+
+        fig.add_trace(go.Scattermapbox(lat = [None], lon = [None], mode = 'markers', # solo para la leyenda
+                                       marker = {'color': colores[i], 'size': 12},
+                                       name = '{:,.2f} - {:,.2f}'.format(cortes[i], cortes[i + 1])))
+
+    fig.update_layout(width = width,
+                      margin = {"r":10,"t":10,"l":10,"b":10},
+                      legend = {'title': {'text': catalogo.descripcion(d, col1_1)}},
+                      mapbox = {'style': 'carto-positron', 'zoom': zoom_mapa, 'center': centro_mapa, 'layers': capas})
+
+    return fig
+
+def datos_grafica(un1, datos = 'caracteristicas_poblacionales',
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma',
+    agreg1 = 'sectores'):
+    """ 
+    Filas del panel para construir la grafica de barras en el navegador (assets/graficas.js)
+
+    Se guardan una sola vez en el dcc.Store del panel al generar el mapa; la seleccion del mapa y el
+    dibujo de las barras se hacen despues del lado del cliente sin volver al servidor.
+
+    Args:
+        un1 (obj) -> GeoDataFrame unido que regresa mapa()
+        datos (str) -> tema o nombre de la tabla de datos
+        col1_1 (str) -> string con el nombre de la columna del eje x
+        col1_2 (str) -> string con el nombre de la columna del color
+        estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
+        estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
+        agreg1 (str) -> string con el nombre de la agregacion
+
+    Returns:
+        (dic) -> listas 'loc', 'ident', 'x', 'color' y 'hover' por fila, y las etiquetas de los ejes
+    """
+    loc1 = agreg1[0:4]
+    d = tabla_tema(datos)
+
+    etiquetas = {
+        'x': catalogo.etiqueta(d, col1_1, estad1_1),
+        'color': catalogo.etiqueta(d, col1_2, estad1_2),
+        'y': agreg1
+        }
+
+    cols = [c for c in un1.columns if c != 'geom']
+
+    hover = ['<b>{}</b>'.format(i) for i in un1['ident'].astype(str)] #texto de hover con todas las columnas del panel
+    for c in cols:
+        nombre = etiquetas['x'] if c == col1_1 else etiquetas['color'] if c == col1_2 else c
+        hover = [h + '<br>{}={}'.format(nombre, v) for h, v in zip(hover, un1[c].to_list())]
+
+    return {
+        'loc': un1[loc1].to_list(),
+        'ident': un1['ident'].to_list(),
+        'x': un1[col1_1].to_list(),
+        'color': un1[col1_2].to_list(),
+        'hover': hover,
+        'etiquetas': etiquetas
+        }
+
+def figura_panel(conn, esquema = 'Dashboards',
+    datos = 'caracteristicas_poblacionales',
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma',
+    agreg1 = 'sectores',
+    avance = None):
+    """ 
+    Figura del mapa del panel y datos de su grafica, ya serializados y guardados en cache_figuras
+
+    El panel y el mapa maximizado comparten la misma entrada, asi maximizar o volver a generar un mapa
+    con el mismo estado no vuelve a unir datos ni a construir la figura.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        esquema (str) -> string con el nombre del esquema al que se conecta la bse de datos
+        datos (str) -> tema o nombre de la tabla de datos
+        col1_1 (str) -> string con el nombre de la columna del mapa
+        col1_2 (str) -> string con el nombre de la columna del color de la grafica
+        estad1_1 (str) -> string con el nombre del estadistico que se usara para col1_1 
+        estad1_2 (str) -> string con el nombre del estadistico que se usara para col1_2 
+        agreg1 (str) -> string con el nombre de la agregacion
+        avance (function) -> funcion opcional (paso, total, texto) para reportar el progreso del callback
+
+    Returns:
+        (tuple) -> (figura en JSON, datos de la grafica en JSON); si falla la consulta, una figura con el aviso y null
+    """
+    d = tabla_tema(datos)
+    avance = avance or (lambda paso, total, texto: None)
+
+    def calcular():
+        avance(1, 3, 'consultando datos')
+        agregados(conn, esquema=esquema, datos=datos, agreg=agreg1, col1_1=col1_1, col1_2=col1_2,
+                  estad1_1=estad1_1, estad1_2=estad1_2) # queda en cache_agregados para el mapa
+
+        avance(2, 3, 'armando mapa')
+        fig, un1 = mapa(conn, esquema=esquema, datos=datos, agreg1=agreg1, col1_1=col1_1, col1_2=col1_2,
+                        estad1_1=estad1_1, estad1_2=estad1_2, nivel='panel')
+        if un1 is None: # los mensajes de error no se guardan en cache_figuras
+            return 'Error: en mapa'
+
+        avance(3, 3, 'armando grafica')
+        g = datos_grafica(un1, datos=datos, agreg1=agreg1, col1_1=col1_1, col1_2=col1_2, estad1_1=estad1_1, estad1_2=estad1_2)
+
+        return fig.to_json(), json.dumps(g)
+
+    r = cache_figuras.obtener(('figura', esquema, d, agreg1, col1_1, col1_2, estad1_1, estad1_2), calcular,
+                              etiquetas = (d, agreg1))
+    if isinstance(r, str):
+        return figura_error('No se pudieron consultar los datos del mapa').to_json(), json.dumps(None)
+    return r
+
+def figura_modal(conn, esquema = 'Dashboards',
+    datos = 'caracteristicas_poblacionales',
+    col1_1 = 'POB1',
+    col1_2 = 'POB2',
+    estad1_1 = 'suma',
+    estad1_2 = 'suma',
+    agreg1 = 'sectores'):
+    """ 
+    Figura del mapa maximizado a partir de la figura ya generada para el panel
+
+    Solo se cambia el ancho y, si la capa se referencia por URL, se apunta al nivel de detalle 'modal'.
+
+    Args:
+        (mismos que figura_panel)
+
+    Returns:
+        (dic) -> figura de plotly como diccionario
+    """
+    fig = json.loads(figura_panel(conn, esquema=esquema, datos=datos, agreg1=agreg1, col1_1=col1_1, col1_2=col1_2,
+                                  estad1_1=estad1_1, estad1_2=estad1_2)[0])
+
+    fig['layout']['width'] = 1000
 
-    fig.update_traces(width= 0.75 )
+    for traza in fig['data']:
+        if isinstance(traza.get('geojson'), str):
+            traza['geojson'] = ruta_geojson(conn, agreg=agreg1, esquema=esquema, nivel='modal') or traza['geojson']
 
     return fig
 
+class TrabajosFondo:
+    """ 
+    Registro de los backends de postgres que usa cada callback en segundo plano
+
+    Dash termina el proceso de un trabajo viejo cuando se vuelve a disparar el mismo callback, pero postgres
+    sigue corriendo su consulta hasta que intenta mandar el resultado. Cada trabajo anota aqui los pids de
+    sus backends y el siguiente trabajo cancela los de procesos que ya no existen.
+
+    Cada trabajo corre en un proceso nuevo que hereda una copia de las metricas del proceso web; se descartan
+    al empezar y al terminar se vuelcan al almacen compartido de las metricas para que aparezcan en /metrics.
+
+    Args:
+        cache (obj) -> diskcache.Cache compartido entre procesos
+        expira (float) -> segundos que se guarda el registro de un trabajo
+        metricas (obj) -> Metricas del proceso, con su almacen compartido
+    """
+
+    def __init__(self, cache, expira = 3600, metricas = None):
+        self.cache = cache
+        self.expira = expira
+        self.metricas = metricas
+        self._pid = os.getpid() # proceso web, los trabajos corren en otros
+
+    def registrar(self, pid_pg):
+        """ 
+        Anota un backend de postgres usado por el proceso actual
+
+        Args:
+            pid_pg (int) -> pid del backend de postgres
+        """
+        clave = ('pg', os.getpid())
+        with self.cache.transact():
+            pids = self.cache.get(clave, set())
+            pids.add(pid_pg)
+            self.cache.set(clave, pids, expire = self.expira)
+
+    def terminar(self):
+        """ Borra el registro del proceso actual cuando su trabajo termina sin ser cancelado """
+        self.cache.delete(('pg', os.getpid()))
+
+    def cancelar_huerfanos(self, conn):
+        """ 
+        Cancela en postgres las consultas de trabajos cuyo proceso ya fue terminado
+
+        Args:
+            conn (obj) -> pool de conexiones a base de datos
+
+        Returns:
+            (list) -> pids de postgres cancelados
+        """
+        import psutil # opcional como diskcache y multiprocess, ver requirements-opcional.txt
+
+        huerfanos = []
+        with self.cache.transact():
+            for clave in list(self.cache.iterkeys()):
+                if isinstance(clave, tuple) and clave[0] == 'pg' and not psutil.pid_exists(clave[1]):
+                    huerfanos.extend(self.cache.pop(clave, default = set()))
+
+        if huerfanos:
+            log.info('cancelando %s consultas de trabajos terminados: %s', len(huerfanos), huerfanos)
+            with conn.conexion() as c:
+                with c.cursor() as cursor:
+                    cursor.execute('SELECT pg_cancel_backend(pid) FROM unnest(%s) AS pid', (huerfanos,))
+                c.commit()
+
+        return huerfanos
+
+    def ejecutar(self, conn, funcion, *args, **kwargs):
+        """ 
+        Corre el cuerpo de un callback en segundo plano registrando sus backends
+
+        Args:
+            conn (obj) -> pool de conexiones a base de datos
+            funcion (function) -> cuerpo del callback
+
+        Returns:
+            (obj) -> lo que regrese la funcion
+        """
+        propio = self.metricas is not None and os.getpid() != self._pid
+        if propio:
+            self.metricas.reiniciar()
+
+        try:
+            self.cancelar_huerfanos(conn)
+        except Exception as error: # no cancelar una consulta vieja no impide generar el mapa nuevo
+            log.warning('no se pudieron cancelar las consultas de trabajos terminados: %s', error)
+
+        conn.al_prestar = self.registrar
+        try:
+            return funcion(*args, **kwargs)
+        finally:
+            conn.al_prestar = None
+            self.terminar()
+            if propio:
+                try:
+                    self.metricas.volcar()
+                except Exception as error: # perder las metricas de un trabajo no debe perder su resultado
+                    log.warning('no se pudieron guardar las metricas del trabajo: %s', error)
+
 #-------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 #************************************************************************************#
 #██████╗  █████╗ ██████╗  █████╗ ███╗   ███╗███████╗████████╗███████╗██████╗ ███████╗#
@@ -412,8 +3154,11 @@ def grafica(conn, esquema = 'Dashboards',
 #╚═╝     ╚═╝  ╚═╝╚═╝  ╚═╝╚═╝  ╚═╝╚═╝     ╚═╝╚══════╝   ╚═╝   ╚══════╝╚═╝  ╚═╝╚══════╝#
 #************************************************************************************#                                                                                    
 
+t_parametros = time.perf_counter()
 load_dotenv()
 
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'), format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+
 param_dic = { #} parametros de coneccion
     "host"      : os.getenv('HOST'),
     "database"  : os.getenv('DATABASE'),
@@ -427,12 +3172,149 @@ estad = os.getenv('estad').split(',') #lsita de estadisticos
 temas =os.getenv('temas').split(',') #lista de temas
 bds = os.getenv('bds').split(',') #lsita de nombre de tablas de temas
 agreg = os.getenv('agreg').split(',') #lista de agregaciones
+paneles = int(os.getenv('PANELES', 2)) #numero de paneles de mapa y grafica
+
+metricas = Metricas() # latencias de callbacks, rutas y consultas, se leen en /metrics
+
+pool = PoolConexiones(param_dic, #pool de conexiones a base de datos, conecta hasta la primera consulta
+                      minimo = int(os.getenv('POOL_MIN', 1)),
+                      maximo = int(os.getenv('POOL_MAX', 8)),
+                      espera = float(os.getenv('POOL_ESPERA', 30))
+                      )
+
+backend = os.getenv('BACKEND', 'postgres') # 'postgres' o 'duckdb' (archivos Parquet/GeoParquet locales en DUCKDB_DIR)
+dir_duckdb = os.getenv('DUCKDB_DIR', '/app/datos')
+
+fuente = pool # de donde se leen catalogo, mapas, graficas y exportaciones
 
-conn = connect(param_dic) #coneccion a base de datos
+if backend == 'duckdb':
+    try:
+        fuente = BackendDuckDB(dir_duckdb, esquema = esqu, hilos = os.getenv('DUCKDB_HILOS'))
+    except Exception as error: # duckdb es opcional, sin el o sin los archivos se sigue con postgres
+        log.warning('BACKEND=duckdb pero no se pudo abrir %s (%s), se usa postgres', dir_duckdb, error)
+
+catalogo = CatalogoMetadatos(fuente, bds, esquema = esqu, #columnas y descripciones de las tablas de datos
+                             refresco = float(os.getenv('CATALOGO_REFRESCO', 0))
+                             )
+
+precarga_catalogo = os.getenv('CATALOGO_PRECARGA', '0') == '1' #carga el catalogo al arrancar (en un hilo, ver crear_app) en lugar de en la primera consulta
+
+max_preparadas = int(os.getenv('PREPARADAS_MAX', 200)) # sentencias preparadas por conexion antes de liberarlas
+
+modo_datos = os.getenv('MODO_DATOS', 'cubo') # 'cubo': un query por tema y agregacion, 'consulta': un query por columnas pedidas
+
+cache_compartido = None # segundo nivel en disco para agregados, figuras y geometrias, compartido por los workers del host
+
+if os.getenv('CACHE_COMPARTIDO_DIR'):
+    try:
+        cache_compartido = CacheCompartido(os.getenv('CACHE_COMPARTIDO_DIR'),
+                                           max_bytes = int(float(os.getenv('CACHE_COMPARTIDO_MB', 512)) * 1024 ** 2),
+                                           ttl = float(os.getenv('AGG_CACHE_TTL', 600))
+                                           )
+    except ImportError as error: # diskcache es opcional
+        log.warning('CACHE_COMPARTIDO_DIR definido pero falta una dependencia (%s), cada worker usa solo su cache en memoria', error)
+
+cache_agregados = CacheLRU(max_items = int(os.getenv('AGG_CACHE_MAX', 128)), #resultados de las agregaciones
+                           ttl = float(os.getenv('AGG_CACHE_TTL', 600)),
+                           compartido = None if cache_compartido is None else cache_compartido.espacio('agregados'),
+                           nombre = 'agregados'
+                           )
+
+geojson_url = os.getenv('GEOJSON_URL', '1') == '1' # las figuras referencian /geo/<agreg>.geojson en lugar de incrustar las geometrias
+
+cache_figuras = CacheLRU(max_items = int(os.getenv('FIG_CACHE_MAX', 64)), #figuras de los mapas ya serializadas, compartidas con el mapa maximizado
+                         ttl = float(os.getenv('AGG_CACHE_TTL', 600)),
+                         max_bytes = int(float(os.getenv('FIG_CACHE_MB', 32)) * 1024 ** 2),
+                         medir = lambda v: sum(len(x) for x in v),
+                         compartido = None if cache_compartido is None else cache_compartido.espacio('figuras'),
+                         nombre = 'figuras'
+                         )
+
+spool_exportacion = int(float(os.getenv('EXPORT_SPOOL_MB', 64)) * 1024 ** 2) # copia de la exportacion en memoria, arriba de eso en disco
+
+dir_teselas = os.getenv('TILE_CACHE_DIR', '/tmp/teselas') # cache en disco de las teselas vectoriales de manzanas
+max_teselas = int(float(os.getenv('TILE_CACHE_MB', 512)) * 1024 ** 2) # arriba de esto se borran las usadas hace mas tiempo
+
+cache_geo = CacheGeometrias(max_bytes = int(float(os.getenv('GEO_CACHE_MB', 256)) * 1024 ** 2), #capas de geometrias en memoria
+                            niveles = { #tolerancia de simplificacion de cada nivel de detalle, en grados
+                                'panel': float(os.getenv('GEO_TOL_PANEL', 0.0005)),
+                                'modal': float(os.getenv('GEO_TOL_MODAL', 0.0001))
+                                },
+                            compartido = None if cache_compartido is None else cache_compartido.espacio('geometrias')
+                            )
+
+centro_mapa = dict(zip(('lat', 'lon'), (float(v) for v in os.getenv('MAPA_CENTRO', '32.484948,-116.936904').split(',')))) # vista inicial de los mapas
+zoom_mapa = float(os.getenv('MAPA_ZOOM', 10))
+
+vista_mapa = os.getenv('VISTA_MAPA', '0') == '1' # al mover o acercar el mapa del panel solo se pintan los poligonos de la vista
+vista_zoom_min = float(os.getenv('VISTA_ZOOM_MIN', 12)) # con menos zoom se pinta la capa completa
+
+cache_vista = CacheLRU(max_items = int(os.getenv('VISTA_CACHE_MAX', 512)), #geometrias por tesela de la vista
+                       ttl = float(os.getenv('AGG_CACHE_TTL', 600)),
+                       max_bytes = int(float(os.getenv('VISTA_CACHE_MB', 64)) * 1024 ** 2),
+                       medir = CacheGeometrias._tamano,
+                       compartido = None if cache_compartido is None else cache_compartido.espacio('vista'),
+                       nombre = 'vista'
+                       )
+
+vigilante = None # descarta de los caches lo que depende de una tabla en cuanto cambia
+
+if os.getenv('CAMBIOS_ESCUCHAR', '0') == '1' and fuente is pool:
+    vigilante = VigilanteCambios(param_dic, ['manzanas'] + bds + agreg + [rollup_nombre(d, ag) for d in bds for ag in agreg],
+                                 invalidar_cambios, esquema = esqu,
+                                 sondeo = float(os.getenv('CAMBIOS_SONDEO', 60)) #respaldo para las tablas sin disparador
+                                 )
+
+manager_fondo = None # callbacks de mapas en procesos aparte, cancelables al volver a presionar Trigger
+trabajos = None
+
+if os.getenv('CALLBACKS_FONDO', '0') == '1':
+    try:
+        import diskcache
+        from dash import DiskcacheManager
+
+        cache_fondo = diskcache.Cache(os.getenv('FONDO_CACHE_DIR', '/tmp/callbacks'))
+        manager_fondo = DiskcacheManager(cache_fondo)
+        metricas.compartido = cache_fondo # los trabajos vuelcan ahi sus metricas al terminar
+        trabajos = TrabajosFondo(cache_fondo, metricas = metricas)
+    except ImportError as error: # diskcache, multiprocess y psutil son opcionales
+        log.warning('CALLBACKS_FONDO=1 pero falta una dependencia (%s), los mapas se generan en el proceso web', error)
+
+arranque['parametros'] = time.perf_counter() - t_parametros
 
 # -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
-app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
+def callback_mapa(*args, progreso = None, ejecutando = None, **kwargs):
+    """ 
+    Registra un callback de mapas en segundo plano si CALLBACKS_FONDO esta activo, si no como callback normal
+
+    El cuerpo del callback siempre recibe primero la funcion set_progress; sin segundo plano es una funcion vacia.
+    En los dos casos el cuerpo se mide con medir_callback.
+
+    Args:
+        progreso (list) -> Outputs que se actualizan con set_progress
+        ejecutando (list) -> tuplas (Output, valor mientras corre, valor al terminar)
+
+    Returns:
+        (function) -> decorador
+    """
+    def decorador(funcion):
+        medida = medir_callback(funcion)
+
+        if manager_fondo is None:
+            @functools.wraps(funcion)
+            def sincrono(*valores):
+                return medida(lambda valor: None, *valores)
+            callback(*args, **kwargs)(sincrono)
+            return funcion
+
+        @functools.wraps(funcion) # dash arma la llave del trabajo con el codigo de la funcion original
+        def fondo(set_progress, *valores):
+            return trabajos.ejecutar(pool, medida, set_progress, *valores)
+        callback(*args, background = True, manager = manager_fondo, progress = progreso, running = ejecutando, **kwargs)(fondo)
+        return funcion
+
+    return decorador
 
 #********************************************************************************#
 # █████╗ ██████╗ ██████╗     ██╗      █████╗ ██╗   ██╗ ██████╗ ██╗   ██╗████████╗#
@@ -443,157 +3325,130 @@ app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 #╚═╝  ╚═╝╚═╝     ╚═╝         ╚══════╝╚═╝  ╚═╝   ╚═╝    ╚═════╝  ╚═════╝    ╚═╝   #
 #********************************************************************************#                                                                                
 
-app.layout = html.Div([
+def id_panel(tipo, i):
+    """ 
+    Args:
+        tipo (str) -> tipo de componente del panel, p. ej. 'mapa' o 'tema'
+        i (int) -> indice del panel, desde 0
 
-    html.Div([
+    Returns:
+        (dic) -> id de dash del componente, para los callbacks con MATCH/ALL
+    """
+    return {'type': tipo, 'index': i}
 
-            dbc.Modal(
-        [
-            dbc.ModalHeader(dbc.ModalTitle( id ='m_title', children="Fullscreen modal")),
-            dcc.Graph(id='map_mod',style={"height": "100%", "width": "100%"})
-        ],
-        id="modal-fs",
-        fullscreen=True,
-        is_open=False
+def controles_panel(i):
+    """ 
+    Args:
+        i (int) -> indice del panel, desde 0
+
+    Returns:
+        (list) -> titulo, dropdowns y boton del panel para la columna de controles
+    """
+    return [
+        dcc.Markdown('## PANEL {}'.format(i + 1)),
+
+        dcc.Dropdown(
+            temas,
+            id=id_panel('tema', i),
+            placeholder="Selecciona un tema"
         ),
 
-        html.Div([  
-
-            dcc.Markdown(
-                '## PANEL 1',
-                id='mk_1'),
-
-            dcc.Dropdown(
-                temas,
-                id='selector_de_tema1',
-                placeholder="Selecciona un tema"
-            ),
-
-            dcc.Dropdown(
-                agreg,
-                agreg[2],
-                id='agreg_1',
-                placeholder="Selecciona una agregacion",
-                disabled = True
-            ) ,
-            dcc.Dropdown(
-                id='col_1',
-                placeholder="Selecciona un columna para el mapa",
-                optionHeight=70,
-                disabled = True
-            ) ,
-            dcc.Dropdown(
-                estad,
-                estad[0],
-                id='tipo_1-1',
-                placeholder="Selecciona un estadistico",
-                disabled = True
-            ) ,
-            dcc.Dropdown(
-                id='color_1', 
-                placeholder="Selecciona un columna para graficar",
-                optionHeight=70,
-                disabled = True
-            ),
-            dcc.Dropdown(
-                estad,
-                estad[0],
-                id='tipo_1-2',
-                placeholder="Selecciona un estadistico",
-                disabled = True
-            ),
-            html.Button(
-                'Trigger_1',
-                id='boton_1'
-            ),
-            dcc.Markdown(
-                '## PANEL 2',
-                id= 'mk_2'),
-
-            dcc.Dropdown(
-                temas,
-                id='selector_de_tema2',
-                placeholder="Selecciona un tema"
-            ),
-
-            dcc.Dropdown(
-                agreg,
-                agreg[2],
-                id='agreg_2',
-                placeholder="Selecciona una agregacion",
-                disabled = True
-            ) ,
-            dcc.Dropdown(
-                id='col_2',
-                placeholder="Selecciona un columna para el mapa",
-                optionHeight=70,
-                disabled = True
-            ) ,
-            dcc.Dropdown(
-                estad,
-                estad[0],
-                id='tipo_2-1',
-                placeholder="Selecciona un estadistico",
-                disabled = True
-            ) ,
-            dcc.Dropdown(
-                id='color_2', 
-                placeholder="Selecciona un columna para graficar",
-                optionHeight=70,
-                disabled = True
-            ),
-            dcc.Dropdown(
-                estad,
-                estad[0],
-                id='tipo_2-2',
-                placeholder="Selecciona un estadistico",
-                disabled = True
-            ),
-            html.Button(
-                'Trigger_2',
-                id='boton_2'
-            ),
-            
-            html.Div(id='hidden-div', style={'display':'none'}, children = 'mhe') #este se va a eliminar alv
-
-            ], style={'width': '15%', 'display': 'inline-block', "height": "350"}),
+        dcc.Dropdown(
+            agreg + (['manzanas'] if fuente is pool else []), # manzanas se pinta con teselas vectoriales de postgis
+            agreg[2],
+            id=id_panel('agreg', i),
+            placeholder="Selecciona una agregacion",
+            disabled = True
+        ) ,
+        dcc.Dropdown(
+            id=id_panel('col', i),
+            placeholder="Selecciona un columna para el mapa",
+            optionHeight=70,
+            disabled = True
+        ) ,
+        dcc.Dropdown(
+            estad,
+            estad[0],
+            id=id_panel('estad_col', i),
+            placeholder="Selecciona un estadistico",
+            disabled = True
+        ) ,
+        dcc.Dropdown(
+            id=id_panel('color', i),
+            placeholder="Selecciona un columna para graficar",
+            optionHeight=70,
+            disabled = True
+        ),
+        dcc.Dropdown(
+            estad,
+            estad[0],
+            id=id_panel('estad_color', i),
+            placeholder="Selecciona un estadistico",
+            disabled = True
+        ),
+        html.Button(
+            'Trigger_{}'.format(i + 1),
+            id=id_panel('boton', i)
+        )
+        ]
+
+def vista_panel(i):
+    """ 
+    Args:
+        i (int) -> indice del panel, desde 0
+
+    Returns:
+        (obj) -> Div con el mapa, la grafica, la descarga y el boton para maximizar del panel
+    """
+    return html.Div([
+        dcc.Markdown('## MAPA {}'.format(i + 1)),
+        html.Button( 'maximizar mapa' ,id=id_panel('maximizar', i) ,disabled = True),
+        html.Button('Get Data tab{}'.format(i + 1),id=id_panel('tabla', i),disabled = True),
+        dcc.Dropdown(['csv'] + (['parquet', 'arrow'] if hay_pyarrow() else []), 'csv', id=id_panel('formato', i), clearable = False,
+                     style = {'width': '120px', 'display': 'inline-block', 'verticalAlign': 'middle'}),
+        dcc.Download(id=id_panel('descarga', i)),
 
         html.Div([
 
-            html.Div([
-                dcc.Markdown('## MAPA 1'), 
-                html.Button( 'maximizar mapa' ,id="max_map1" ,disabled = True),
-                html.Button('Get Data tab1',id='tabla1',disabled = True),
-                dcc.Download(id="download-csv1"),   
+            dbc.Progress(id=id_panel('progreso', i), value=0, max=3, striped=True, animated=True, style={'visibility': 'hidden'}),
 
-                html.Div([
+            dcc.Graph(id=id_panel('mapa', i),style={ 'maxWidth': '900px'}),
 
-                    dcc.Graph(id='mapa_1',style={ 'maxWidth': '900px'}),
-                    
-                    dcc.Graph(id='grafica_1', style={'overflowY': 'scroll', 'maxHeight': '500px', 'maxWidth': '500'}),
+            dcc.Store(id=id_panel('datos', i)),
 
-                ], style={'display': 'inline-block'})
+            dcc.Store(id=id_panel('vista', i)), # estado con el que se genero el mapa y teselas que muestra (VISTA_MAPA)
 
-            ], style={'width': '50%', 'float': 'left','display': 'inline-block'}),
+            dcc.Graph(id=id_panel('grafica', i), style={'overflowY': 'scroll', 'maxHeight': '500px', 'maxWidth': '500'}),
 
-            html.Div([
-                dcc.Markdown('## MAPA 2'),
-                html.Button( 'maximizar mapa' ,id="max_map2",disabled = True ),
-                html.Button('Get Data tab2',id='tabla2',disabled = True),
-                dcc.Download(id="download-csv2"),
+        ], style={'display': 'inline-block'})
 
-                html.Div([
+    ], style={'width': '50%', 'display': 'inline-block', 'verticalAlign': 'top'})
 
-                    dcc.Graph(id='mapa_2',style={ 'maxWidth': '900px'}),
-                    
-                    dcc.Graph(id='grafica_2' , style={'overflowY': 'scroll', 'maxHeight': '500px', 'maxWidth': '500'} ),
+layout = html.Div([
 
-                ], style={'display': 'inline-block'})
+    html.Div([
+
+            dbc.Modal(
+        [
+            dbc.ModalHeader(dbc.ModalTitle( id ='m_title', children="Fullscreen modal")),
+            dcc.Graph(id='map_mod',style={"height": "100%", "width": "100%"})
+        ],
+        id="modal-fs",
+        fullscreen=True,
+        is_open=False
+        ),
+
+        html.Div(
 
-            ], style={'width': '50%', 'float': 'right','display': 'inline-block'})
+            [c for i in range(paneles) for c in controles_panel(i)]
 
+            , style={'width': '15%', 'display': 'inline-block', "height": "350"}),
 
-        ],style={'width': '85%', 'float': 'right', 'display': 'inline-block'})
+        html.Div(
+
+            [vista_panel(i) for i in range(paneles)]
+
+        ,style={'width': '85%', 'float': 'right', 'display': 'inline-block'})
 
     ]),
 
@@ -609,67 +3464,25 @@ app.layout = html.Div([
 #╚═╝     ╚═╝╚═╝  ╚═╝╚══════╝   ╚═╝        ╚═════╝╚═╝  ╚═╝╚══════╝╚══════╝╚═════╝ ╚═╝  ╚═╝ ╚═════╝╚═╝  ╚═╝#
 #********************************************************************************************************#                                                                                                    
 
-@app.callback(
-    [
-    Output(component_id='col_1', component_property='options'),
-    Output(component_id='color_1', component_property='options'),
-    Output(component_id='tipo_1-1', component_property='disabled'),
-    Output(component_id='tipo_1-2', component_property='disabled'),
-    Output(component_id='agreg_1', component_property='disabled'),
-    Output(component_id='col_1', component_property='disabled'),
-    Output(component_id='color_1', component_property='disabled'),
-    ],
-
-    [
-    Input(component_id='selector_de_tema1', component_property= 'value')
-    ], prevent_initial_call=True
-)
-
-def first( tema):
-    print('first callback...')
-    if tema == 'Poblacion':
-        d ='caracteristicas_poblacionales'
-        c = query_columnas(conn,datos=d)
-        
-    elif tema == 'Economia':
-        d='caracteristicas_economicas'
-        c = query_columnas(conn,datos=d)
-    
-
-    col_desc = postgresql_to_dataframe(conn, col_description_query(tabla=d) )
-    c = col_desc.groupby(['col']).apply(lambda x: x['description'].tolist()).to_dict()
-
-    return c,c, False, False, False, False, False
-
-@app.callback(
+@callback(
     [
-    Output(component_id='col_2', component_property='options'),
-    Output(component_id='color_2', component_property='options'),
-    Output(component_id='tipo_2-1', component_property='disabled'),
-    Output(component_id='tipo_2-2', component_property='disabled'),
-    Output(component_id='agreg_2', component_property='disabled'),
-    Output(component_id='col_2', component_property='disabled'),
-    Output(component_id='color_2', component_property='disabled')
+    Output(component_id=id_panel('col', MATCH), component_property='options'),
+    Output(component_id=id_panel('color', MATCH), component_property='options'),
+    Output(component_id=id_panel('estad_col', MATCH), component_property='disabled'),
+    Output(component_id=id_panel('estad_color', MATCH), component_property='disabled'),
+    Output(component_id=id_panel('agreg', MATCH), component_property='disabled'),
+    Output(component_id=id_panel('col', MATCH), component_property='disabled'),
+    Output(component_id=id_panel('color', MATCH), component_property='disabled')
     ],
 
     [
-    Input(component_id='selector_de_tema2', component_property= 'value'),
+    Input(component_id=id_panel('tema', MATCH), component_property= 'value')
     ], prevent_initial_call=True
 )
 
-def second( tema):
-    print('first callback...')
-    if tema == 'Poblacion':
-        d ='caracteristicas_poblacionales'
-        c = query_columnas(conn,datos=d)
-        
-    elif tema == 'Economia':
-        d='caracteristicas_economicas'
-        c = query_columnas(conn,datos=d)
-    
-
-    col_desc = postgresql_to_dataframe(conn, col_description_query(tabla=d) )
-    c = col_desc.groupby(['col']).apply(lambda x: x['description'].tolist()).to_dict()
+def opciones_panel( tema):
+    log.debug('opciones del panel %s para %s', ctx.triggered_id['index'] + 1, tema)
+    c = catalogo.opciones(tabla_tema(tema)) #opciones desde el catalogo en memoria, sin consultar la base de datos
 
     return c,c, False, False, False, False, False
 
@@ -682,74 +3495,86 @@ def second( tema):
 #╚══════╝╚══════╝ ╚═════╝ ╚═════╝ ╚═╝  ╚═══╝╚═════╝      ╚═════╝╚═╝  ╚═╝╚══════╝╚══════╝╚═════╝ ╚═╝  ╚═╝ ╚═════╝╚═╝  ╚═╝#
 #***********************************************************************************************************************#
 
-@app.callback(
-    [
-    Output(component_id='mapa_1', component_property='figure'),
-    Output(component_id='tabla1', component_property='disabled'),
-    Output(component_id='max_map1',component_property='disabled')
-    ],
-    [
-    Input(component_id='boton_1', component_property= 'n_clicks'),
-    State(component_id='selector_de_tema1', component_property= 'value'),
-    State(component_id='tipo_1-1', component_property='value'),
-    State(component_id='tipo_1-2', component_property='value'),
-    State(component_id='agreg_1', component_property='value'),
-    State(component_id='col_1', component_property='value'),
-    State(component_id='color_1', component_property='value')
-    ], prevent_initial_call=True
-)
-
-def mapas(n, tema1, est1_1, est1_2, agreg_1, col_1, color_1 ):
-    print('second.1 callback...')
-    s1= None
-    ss1 = []
-
-    if s1 is None:
-        pass
-    else:
-        for i in s1['points']:
-            ss1.append(i['location'])
-
-    m1 = mapa(conn,datos = tema1, agreg1 = agreg_1,col1_1 = col_1 ,col1_2=color_1,estad1_1 = est1_1, estad1_2 = est1_2)[0]
-
-    return m1, False, False
-
-
-@app.callback(
-    [
-    Output(component_id='mapa_2', component_property='figure'),
-    Output(component_id='tabla2', component_property='disabled'),
-    Output(component_id='max_map2',component_property='disabled')
-    ],
-    [
-    Input(component_id='boton_2', component_property= 'n_clicks'),
-    State(component_id='selector_de_tema2', component_property= 'value'),
-    State(component_id='tipo_2-1', component_property='value'),
-    State(component_id='tipo_2-2', component_property='value'),
-    State(component_id='agreg_2', component_property='value'),
-    State(component_id='col_2', component_property='value'),
-    State(component_id='color_2', component_property='value')
-    ], prevent_initial_call=True
-)
+def mapas(set_progress, n, tema, est_col, est_color, agreg_p, col, color):
+    log.debug('mapa del panel %s: %s %s por %s', ctx.triggered_id['index'] + 1, tema, col, agreg_p)
 
-def mapas(n, tema2,est2_1, est2_2 , agreg_2, col_2, color_2):
-    print('second.2 callback...')
+    estado = {'tema': tema, 'agreg': agreg_p, 'col': col, 'color': color, 'estad_col': est_col, 'estad_color': est_color, 'teselas': None}
 
-    s2 = None
+    if agreg_p == 'manzanas': # sin grafica ni descarga, son demasiadas manzanas
+        return mapa_manzanas(pool, datos = tema, col1_1 = col), True, False, None, estado
 
-    ss2 = []
+    m, d = figura_panel(fuente, datos = tema, agreg1 = agreg_p, col1_1 = col, col1_2 = color, estad1_1 = est_col, estad1_2 = est_color,
+                        avance = lambda paso, total, texto: set_progress((paso, texto)))
 
-    if s2  is None:
-        pass
-    else:
-        for i in s2['points']:
-            ss2.append(i['location'])
+    d = json.loads(d) # None si fallo la consulta, sin tabla ni mapa maximizado
+    return json.loads(m), d is None, d is None, d, estado
 
-    m2 = mapa(conn, datos = tema2,agreg1 = agreg_2,col1_1 = col_2 ,col1_2=color_2,estad1_1 = est2_1, estad1_2 = est2_2)[0]
+for i in range(paneles): # un registro por panel y no MATCH: dash no acepta ids con comodines en progress/running de los callbacks en segundo plano
+    callback_mapa(
+        [
+        Output(component_id=id_panel('mapa', i), component_property='figure'),
+        Output(component_id=id_panel('tabla', i), component_property='disabled'),
+        Output(component_id=id_panel('maximizar', i),component_property='disabled'),
+        Output(component_id=id_panel('datos', i), component_property='data'),
+        Output(component_id=id_panel('vista', i), component_property='data')
+        ],
+        [
+        Input(component_id=id_panel('boton', i), component_property= 'n_clicks'),
+        State(component_id=id_panel('tema', i), component_property= 'value'),
+        State(component_id=id_panel('estad_col', i), component_property='value'),
+        State(component_id=id_panel('estad_color', i), component_property='value'),
+        State(component_id=id_panel('agreg', i), component_property='value'),
+        State(component_id=id_panel('col', i), component_property='value'),
+        State(component_id=id_panel('color', i), component_property='value')
+        ], prevent_initial_call=True,
+        progreso = [Output(component_id=id_panel('progreso', i), component_property='value'),
+                    Output(component_id=id_panel('progreso', i), component_property='label')],
+        ejecutando = [(Output(component_id=id_panel('progreso', i), component_property='style'), {'visibility': 'visible'}, {'visibility': 'hidden'})]
+    )(mapas)
+
+def mover_mapa(relayout, estado):
+    """ 
+    Con VISTA_MAPA, vuelve a pintar el mapa del panel solo con los poligonos de la vista al moverlo o acercarlo
 
-    return m2, False, False
+    Los valores y la escala de color salen de los mismos agregados del panel (ya en cache_agregados), asi
+    los colores no cambian al moverse. Con menos zoom que VISTA_ZOOM_MIN se regresa a la capa completa.
 
+    Args:
+        relayout (dic) -> relayoutData del mapa
+        estado (dic) -> estado con el que se genero el mapa (ver mapas) y teselas que muestra
 
+    Returns:
+        (tuple) -> (figura, estado actualizado)
+    """
+    vista = limites_vista(relayout)
+    if not estado or estado['agreg'] == 'manzanas' or vista is None: # manzanas ya se carga por teselas vectoriales
+        raise PreventUpdate
+
+    args = dict(datos = estado['tema'], agreg1 = estado['agreg'], col1_1 = estado['col'], col1_2 = estado['color'],
+                estad1_1 = estado['estad_col'], estad1_2 = estado['estad_color'])
+
+    if vista['zoom'] < vista_zoom_min:
+        if estado['teselas'] is None: # ya se muestra la capa completa
+            raise PreventUpdate
+        m, d = figura_panel(fuente, **args)
+        return json.loads(m), dict(estado, teselas = None)
+
+    z, teselas = teselas_vista(vista['limites'], vista['zoom'])
+    clave = [z] + [min(t[0] for t in teselas), min(t[1] for t in teselas), max(t[0] for t in teselas), max(t[1] for t in teselas)]
+    if estado['teselas'] == clave: # la vista sigue dentro de las mismas teselas
+        raise PreventUpdate
+
+    fig, un1 = mapa(fuente, esquema = esqu, vista = vista, **args)
+    return fig, dict(estado, teselas = clave)
+
+if vista_mapa:
+    callback(
+        Output(component_id=id_panel('mapa', MATCH), component_property='figure', allow_duplicate=True),
+        Output(component_id=id_panel('vista', MATCH), component_property='data', allow_duplicate=True),
+        Input(component_id=id_panel('mapa', MATCH), component_property='relayoutData'),
+        State(component_id=id_panel('vista', MATCH), component_property='data'),
+        prevent_initial_call=True
+    )(medir_callback(mover_mapa)) # como los de callback_mapa, aunque siempre corre en el proceso web
 
 #********************************************************************************************************#
 #████████╗██╗  ██╗██╗██████╗ ██████╗      ██████╗ █████╗ ██╗     ██╗     ██████╗  █████╗  ██████╗██╗  ██╗#
@@ -760,72 +3585,16 @@ def mapas(n, tema2,est2_1, est2_2 , agreg_2, col_2, color_2):
 #   ╚═╝   ╚═╝  ╚═╝╚═╝╚═╝  ╚═╝╚═════╝      ╚═════╝╚═╝  ╚═╝╚══════╝╚══════╝╚═════╝ ╚═╝  ╚═╝ ╚═════╝╚═╝  ╚═╝#
 #********************************************************************************************************#       
 
-@app.callback(
-Output(component_id='grafica_1', component_property='figure'),
-[
-Input(component_id='mapa_1', component_property= 'selectedData'),
-State(component_id='selector_de_tema1', component_property= 'value'),
-State(component_id='tipo_1-1', component_property='value'),
-State(component_id='tipo_1-2', component_property='value'),
-State(component_id='agreg_1', component_property='value'),
-State(component_id='col_1', component_property='value'),
-State(component_id='color_1', component_property='value')
-], prevent_initial_call=True
-)
-
-def filt1(s1, tema, est1_1, est1_2, agreg_1, col_1, color_1 ):
-    print('third callback...')
-    ss1 =[]
-
-    try:
-        for i in s1['points']:
-
-            ss1.append(i['location'])
-
-    except:
-        s1 = None
-        pass
-
-    g = grafica(conn, select_1=ss1, datos = tema, agreg1 = agreg_1, col1_1 = col_1, col1_2=color_1, estad1_1 = est1_1, estad1_2 = est1_2 ) 
-
-    return g
-
-@app.callback(
-
-Output(component_id='grafica_2', component_property='figure')
-,
-[
-
-Input(component_id='mapa_2', component_property= 'selectedData'),
-
-State(component_id='selector_de_tema2', component_property= 'value'),
-
-State(component_id='tipo_2-1', component_property='value'),
-State(component_id='tipo_2-2', component_property='value'),
-State(component_id='agreg_2', component_property='value'),
-State(component_id='col_2', component_property='value'),
-State(component_id='color_2', component_property='value')
+# la seleccion del mapa filtra las barras en el navegador con los datos del dcc.Store del panel (assets/graficas.js)
 
-], prevent_initial_call=True
+clientside_callback(
+    ClientsideFunction(namespace='dashboard', function_name='filtrar_grafica'),
+    Output(component_id=id_panel('grafica', MATCH), component_property='figure'),
+    Input(component_id=id_panel('mapa', MATCH), component_property= 'selectedData'),
+    Input(component_id=id_panel('datos', MATCH), component_property='data'),
+    prevent_initial_call=True
 )
 
-def filt2(s2,  tema ,est2_1, est2_2 , agreg_2, col_2, color_2):
-    print('third callback...')
-    ss2 =[]
-
-    try:
-        for i in s2['points']:
-
-            ss2.append(i['location'])
-    except:
-        s2 = None
-        pass
-
-    g = grafica(conn,select_1=ss2,datos = tema,agreg1 = agreg_2,col1_1 = col_2,col1_2=color_2, estad1_1 = est2_1, estad1_2 = est2_2) 
-
-    return g
-
-
 #**************************************************************************************************************#
 #███████╗ ██████╗ ██████╗ ████████╗██╗  ██╗     ██████╗ █████╗ ██╗     ██╗     ██████╗  █████╗  ██████╗██╗  ██╗#
 #██╔════╝██╔═══██╗██╔══██╗╚══██╔══╝██║  ██║    ██╔════╝██╔══██╗██║     ██║     ██╔══██╗██╔══██╗██╔════╝██║ ██╔╝#
@@ -835,44 +3604,23 @@ def filt2(s2,  tema ,est2_1, est2_2 , agreg_2, col_2, color_2):
 #╚═╝      ╚═════╝ ╚═╝  ╚═╝   ╚═╝   ╚═╝  ╚═╝     ╚═════╝╚═╝  ╚═╝╚══════╝╚══════╝╚═════╝ ╚═╝  ╚═╝ ╚═════╝╚═╝  ╚═╝#                                                                                                          
 #**************************************************************************************************************#                                                                                                     
 
-@app.callback(
-    Output("download-csv1", "data"),
-    [
-    Input("tabla1", "n_clicks"),
-    State(component_id='selector_de_tema1', component_property= 'value'),
-    State(component_id='tipo_1-1', component_property='value'),
-    State(component_id='tipo_1-2', component_property='value'),
-    State(component_id='agreg_1', component_property='value'),
-    State(component_id='col_1', component_property='value'),
-    State(component_id='color_1', component_property='value')
-    ],prevent_initial_call=True,
-)                                          
-
-def download1(n, tema1, est1_1, est1_2, agreg_1, col_1, color_1 ):
-    print('forth callback...')
-    m1 = mapa(conn,datos = tema1, agreg1 = agreg_1,col1_1 = col_1 ,col1_2=color_1,estad1_1 = est1_1, estad1_2 = est1_2)[1]
+# la descarga la hace la ruta /exportar en streaming, el navegador solo arma la URL con el estado del panel y la abre
+# en un iframe oculto (assets/graficas.js)
 
-    return dcc.send_data_frame(m1.drop('geom',axis=1).to_csv, "data.csv") 
-
-@app.callback(
-    Output("download-csv2", "data"),
+clientside_callback(
+    ClientsideFunction(namespace='dashboard', function_name='exportar'),
+    Output(id_panel('descarga', MATCH), "data"),
     [
-    Input("tabla2", "n_clicks"),
-    State(component_id='selector_de_tema2', component_property= 'value'),
-    State(component_id='tipo_2-1', component_property='value'),
-    State(component_id='tipo_2-2', component_property='value'),
-    State(component_id='agreg_2', component_property='value'),
-    State(component_id='col_2', component_property='value'),
-    State(component_id='color_2', component_property='value')
+    Input(id_panel('tabla', MATCH), "n_clicks"),
+    State(component_id=id_panel('tema', MATCH), component_property= 'value'),
+    State(component_id=id_panel('estad_col', MATCH), component_property='value'),
+    State(component_id=id_panel('estad_color', MATCH), component_property='value'),
+    State(component_id=id_panel('agreg', MATCH), component_property='value'),
+    State(component_id=id_panel('col', MATCH), component_property='value'),
+    State(component_id=id_panel('color', MATCH), component_property='value'),
+    State(component_id=id_panel('formato', MATCH), component_property='value')
     ],prevent_initial_call=True,
-)                                          
-
-def download2(n, tema1, est1_1, est1_2, agreg_1, col_1, color_1 ):
-    print('forth callback...')
-    m1 = mapa(conn,datos = tema1, agreg1 = agreg_1,col1_1 = col_1 ,col1_2=color_1,estad1_1 = est1_1, estad1_2 = est1_2)[1]
-
-    return dcc.send_data_frame(m1.drop('geom',axis=1).to_csv, "data.csv") 
-
+)
 
 #********************************************************************************************************# 
 #███████╗██╗███████╗████████╗██╗  ██╗     ██████╗ █████╗ ██╗     ██╗     ██████╗  █████╗  ██████╗██╗  ██╗#
@@ -883,56 +3631,421 @@ def download2(n, tema1, est1_1, est1_2, agreg_1, col_1, color_1 ):
 #╚═╝     ╚═╝╚═╝        ╚═╝   ╚═╝  ╚═╝     ╚═════╝╚═╝  ╚═╝╚══════╝╚══════╝╚═════╝ ╚═╝  ╚═╝ ╚═════╝╚═╝  ╚═╝#                                                                                                       
 #********************************************************************************************************#                                                           
 
-@app.callback(
+@callback_mapa(
     [
     Output(component_id='modal-fs', component_property='is_open'),
     Output(component_id='map_mod', component_property='figure'),
     Output(component_id='m_title' , component_property='children')
     ] , 
     [ 
-    Input(component_id='max_map1', component_property='n_clicks'), 
-    Input(component_id='max_map2', component_property='n_clicks'), 
-    State(component_id='selector_de_tema1', component_property= 'value'),
-    State(component_id='selector_de_tema2', component_property= 'value'),
-    State(component_id='tipo_1-1', component_property='value'),
-    State(component_id='tipo_1-2', component_property='value'),
-    State(component_id='agreg_1', component_property='value'),
-    State(component_id='col_1', component_property='value'),
-    State(component_id='color_1', component_property='value'),
-    State(component_id='tipo_2-1', component_property='value'),
-    State(component_id='tipo_2-2', component_property='value'),
-    State(component_id='agreg_2', component_property='value'),
-    State(component_id='col_2', component_property='value'),
-    State(component_id='color_2', component_property='value')
+    Input(component_id=id_panel('maximizar', ALL), component_property='n_clicks'),
+    State(component_id=id_panel('tema', ALL), component_property= 'value'),
+    State(component_id=id_panel('estad_col', ALL), component_property='value'),
+    State(component_id=id_panel('estad_color', ALL), component_property='value'),
+    State(component_id=id_panel('agreg', ALL), component_property='value'),
+    State(component_id=id_panel('col', ALL), component_property='value'),
+    State(component_id=id_panel('color', ALL), component_property='value')
     ], prevent_initial_call=True
     )
 
-def mapas_max(n1,n2, tema1, tema2, est1_1, est1_2, agreg_1, col_1, color_1 ,est2_1, est2_2 , agreg_2, col_2, color_2):
+def mapas_max(set_progress, n, temas_p, est_cols, est_colors, agregs, cols, colors):
+
+    log.debug('mapa maximizado desde %s', ctx.triggered_id)
 
-    print('quinto callback')
+    if not isinstance(ctx.triggered_id, dict) or not n[ctx.triggered_id['index']]:
+        raise PreventUpdate
 
-    triggered_id = ctx.triggered_id
+    i = ctx.triggered_id['index']
 
-    if triggered_id == 'max_map1':
-        m1 = mapa(conn,datos = tema1, agreg1 = agreg_1,col1_1 = col_1 ,col1_2=color_1,estad1_1 = est1_1, estad1_2 = est1_2)[0]
+    if agregs[i] == 'manzanas':
 
-        m1.update_layout(width = 1000)
+        return True, mapa_manzanas(pool, datos = temas_p[i], col1_1 = cols[i], width = 1000), 'Mapa por ' + agregs[i]
 
-        return True, m1 , 'Mapa por ' + agreg_1
+    m = figura_modal(fuente, datos = temas_p[i], agreg1 = agregs[i], col1_1 = cols[i], col1_2 = colors[i], estad1_1 = est_cols[i], estad1_2 = est_colors[i])
 
-    elif triggered_id == 'max_map2':
+    return True, m , 'Mapa por ' + agregs[i]
 
-        m2 = mapa(conn, datos = tema2,agreg1 = agreg_2,col1_1 = col_2 ,col1_2=color_2,estad1_1 = est2_1, estad1_2 = est2_2)[0]
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+#rutas del servidor, se registran en la app de flask en crear_app
 
-        m2.update_layout(width = 1000)
+rutas = flask.Blueprint('dashboard', __name__)
 
-        return True, m2 , 'Mapa por ' + agreg_2
-    
+@rutas.before_app_request
+def inicio_peticion():
+    flask.g.t0 = time.perf_counter()
+
+@rutas.after_app_request
+def medir_peticion(resp):
+    # los callbacks de dash llegan todos a la misma ruta, se etiquetan con su primera salida
+    # (con CALLBACKS_FONDO la peticion regresa antes del calculo, el calculo se mide en medir_callback)
+    if 't0' not in flask.g:
+        return resp
+    duracion = time.perf_counter() - flask.g.t0
+
+    if flask.request.path.endswith('/_dash-update-component'):
+        salidas = (flask.request.get_json(silent = True) or {}).get('outputs') or {}
+        salida = salidas[0] if isinstance(salidas, list) else salidas
+        ident = salida.get('id')
+        callback = '{}.{}'.format(ident.get('type', json.dumps(ident, sort_keys = True)) if isinstance(ident, dict) else ident,
+                                  salida.get('property'))
+
+        metricas.observar('dashboard_callback_segundos', duracion, callback = callback)
+        if not resp.is_streamed:
+            metricas.observar('dashboard_callback_bytes', resp.calculate_content_length() or 0, cubetas = CUBETAS_BYTES, callback = callback)
+
+    elif flask.request.url_rule is not None and not resp.is_streamed: # en las descargas solo se mide hasta el primer byte
+        metricas.observar('dashboard_http_segundos', duracion, ruta = flask.request.url_rule.rule)
+
+    return resp
+
+@rutas.route('/metrics')
+def servir_metricas():
+    instantaneas = []
+
+    for nombre, valor in pool.metricas().items():
+        tipo = 'gauge' if nombre in ('en_uso', 'espera_max', 'espera_prom') else 'counter'
+        instantaneas.append(('dashboard_pool_{}'.format(nombre), tipo, {}, valor))
+
+    caches = [('agregados', cache_agregados.metricas()), ('figuras', cache_figuras.metricas()), ('geometrias', cache_geo.metricas()),
+              ('vista', cache_vista.metricas())]
+    if cache_compartido is not None:
+        caches.append(('compartido', cache_compartido.metricas()))
+
+    if vigilante is not None:
+        for nombre, valor in vigilante.metricas().items():
+            instantaneas.append(('dashboard_cambios_{}'.format(nombre), 'counter', {}, valor))
+
+    for cache, m in caches:
+        for nombre, valor in m.items():
+            tipo = 'gauge' if nombre in ('entradas', 'bytes') else 'counter'
+            instantaneas.append(('dashboard_cache_{}'.format(nombre), tipo, {'cache': cache}, valor))
+
+    for etapa, segundos in arranque.items():
+        instantaneas.append(('dashboard_arranque_segundos', 'gauge', {'etapa': etapa}, segundos))
+
+    return flask.Response(metricas.texto(instantaneas), mimetype = 'text/plain; version=0.0.4')
+
+@rutas.route('/ready')
+def servir_listo():
+    """ 
+    Prueba de disponibilidad: el catalogo esta cargado, la base de datos contesta y las librerias pesadas estan importadas
+
+    La primera llamada hace el trabajo que si no le tocaria a la primera peticion de un usuario (conexion,
+    catalogo e importaciones), asi la sonda de arranque de Cloud Run calienta la instancia.
+
+    Returns:
+        (obj) -> respuesta JSON con el estado y los tiempos de arranque, 200 si esta lista o 503 si no
+    """
+    estado = {'backend': 'postgres' if fuente is pool else 'duckdb'}
+
+    try:
+        for modulo in (pd, np, gpd, px, go):
+            modulo._cargar()
+        catalogo.columnas(bds[0]) # carga el catalogo si no se ha cargado
+        r = postgresql_to_dataframe(fuente, 'SELECT 1 AS listo', modo = 'preparada')
+        if isinstance(r, str):
+            raise RuntimeError(r)
+        listo = True
+    except Exception as error:
+        estado['error'] = str(error)
+        listo = False
+
+    estado['listo'] = listo
+    estado['arranque'] = {etapa: round(segundos, 4) for etapa, segundos in arranque.items()}
+
+    return flask.Response(json.dumps(estado), status = 200 if listo else 503, mimetype = 'application/json')
+
+
+@rutas.route('/geo/<agreg_capa>.geojson')
+def servir_geojson(agreg_capa):
+    """ 
+    Sirve la capa de geometrias de una agregacion con ETag fuerte y gzip
+
+    Args:
+        agreg_capa (str) -> nombre de la agregacion, solo se aceptan las de la lista agreg
+
+    Returns:
+        (obj) -> respuesta de flask con el GeoJSON, o 304 si el navegador ya tiene la misma version
+    """
+    if agreg_capa not in agreg:
+        flask.abort(404)
+
+    g = cache_geo.geojson(fuente, agreg = agreg_capa, esquema = esqu, nivel = flask.request.args.get('nivel', 'panel'))
+    if isinstance(g, str):
+        flask.abort(503)
+
+    cuerpo, comprimido, etag = g
+
+    if 'gzip' in flask.request.accept_encodings: # cada codificacion lleva su propio ETag fuerte
+        resp = flask.Response(comprimido, mimetype = 'application/geo+json')
+        resp.headers['Content-Encoding'] = 'gzip'
+        resp.set_etag(etag + '-gz')
     else:
+        resp = flask.Response(cuerpo, mimetype = 'application/geo+json')
+        resp.set_etag(etag)
+
+    resp.headers['Vary'] = 'Accept-Encoding'
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 86400 # la URL cambia con la version (?v=) cuando cambia la capa
+
+    return resp.make_conditional(flask.request)
+
+_escrito_teselas = [0] # bytes escritos en el cache de teselas desde la ultima poda, por proceso
+_lock_teselas = threading.Lock()
 
-        return 'error al generar la grafica...'
+def tesela(conn, datos = 'caracteristicas_poblacionales', col = 'POB1', z = 0, x = 0, y = 0, clase = 0):
+    """ 
+    Tesela MVT de las manzanas, leida del cache en disco o generada con ST_AsMVT y guardada en disco
+
+    El rango de valores sale de los cortes de la columna, nunca de la peticion, asi el cache en disco solo
+    tiene una carpeta por clase (y por version de los cortes) de cada columna.
+
+    Args:
+        conn (obj) -> pool de conexiones a base de datos
+        datos (str) -> tema o nombre de la tabla de datos
+        col (str) -> columna de la tabla de datos
+        z, x, y (int) -> coordenadas de la tesela
+        clase (int) -> indice de la clase que se pinta, ver cortes_manzanas
+
+    Returns:
+        (bytes) -> tesela en formato Mapbox Vector Tile, o None si la clase no existe
+    """
+    d = tabla_tema(datos)
+    cortes = cortes_manzanas(conn, esquema = esqu, datos = d, col = col)
+    rango = rango_clase(cortes, clase)
+    if rango is None:
+        return None
+
+    minimo, maximo = rango
+    version = hashlib.sha1(repr(cortes).encode('utf-8')).hexdigest()[0:8] # los cortes cambian con los datos
+    ruta = os.path.join(dir_teselas, esqu, d, col, '{}_{}'.format(clase, version), str(z), str(x), '{}.pbf'.format(y))
+
+    if os.path.exists(ruta):
+        with open(ruta, 'rb') as f:
+            return f.read()
+
+    with conn.conexion() as c:
+        with c.cursor() as cursor:
+            cursor.execute(mvt_query_constructor(esquema = esqu, datos = d, col = col),
+                           {'z': z, 'x': x, 'y': y, 'minimo': minimo, 'maximo': maximo})
+            mvt = bytes(cursor.fetchone()[0] or b'')
+        c.rollback()
+
+    os.makedirs(os.path.dirname(ruta), exist_ok = True)
+    temporal = '{}.{}.tmp'.format(ruta, threading.get_ident()) # se escribe aparte y se renombra para no servir teselas a medias
+    with open(temporal, 'wb') as f:
+        f.write(mvt)
+    os.replace(temporal, ruta)
+
+    with _lock_teselas:
+        _escrito_teselas[0] += len(mvt)
+        podar = _escrito_teselas[0] > max_teselas / 10
+        if podar:
+            _escrito_teselas[0] = 0
+    if podar:
+        podar_teselas(max_teselas)
+
+    return mvt
+
+def podar_teselas(max_bytes):
+    """ 
+    Borra las teselas usadas hace mas tiempo hasta que el cache en disco quede debajo del limite
+
+    Args:
+        max_bytes (int) -> tamano maximo del cache de teselas en disco
+    """
+    archivos = []
+    for carpeta, _, nombres in os.walk(dir_teselas):
+        for nombre in nombres:
+            ruta = os.path.join(carpeta, nombre)
+            try:
+                info = os.stat(ruta)
+            except OSError: # otro proceso la borro
+                continue
+            archivos.append((max(info.st_atime, info.st_mtime), info.st_size, ruta))
+
+    total = sum(a[1] for a in archivos)
+    for _, tamano, ruta in sorted(archivos):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(ruta)
+        except OSError:
+            pass
+        total -= tamano
+
+def invalidar_teselas(datos = None):
+    """ 
+    Borra del disco las teselas guardadas
+
+    Args:
+        datos (str) -> tema o nombre de la tabla de datos cuyas teselas se borran, si es None se borran todas
+    """
+    ruta = os.path.join(dir_teselas, esqu) if datos is None else os.path.join(dir_teselas, esqu, tabla_tema(datos))
+    shutil.rmtree(ruta, ignore_errors = True)
+
+@rutas.route('/tiles/<tabla>/<col>/<int:z>/<int:x>/<int:y>.pbf')
+def servir_tesela(tabla, col, z, x, y):
+    """ 
+    Sirve una tesela vectorial de las manzanas con el valor de una columna
+
+    Args:
+        tabla (str) -> tabla de datos, solo se aceptan las de la lista bds
+        col (str) -> columna numerica de la tabla
+        z, x, y (int) -> coordenadas de la tesela; ?clase= es el indice de la clase de valores (ver cortes_manzanas)
+
+    Returns:
+        (obj) -> respuesta de flask con la tesela
+    """
+    if tabla not in bds or col not in catalogo.numericas(tabla) or not (0 <= z <= 22 and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        flask.abort(404)
+
+    clase = flask.request.args.get('clase', type = int)
+    if clase is None:
+        flask.abort(400)
+
+    mvt = tesela(pool, datos = tabla, col = col, z = z, x = x, y = y, clase = clase)
+    if mvt is None:
+        flask.abort(404)
+
+    resp = flask.Response(mvt, mimetype = 'application/vnd.mapbox-vector-tile')
+    resp.cache_control.public = True
+    resp.cache_control.max_age = 3600
+
+    return resp
+
+FORMATOS_EXPORTACION = { #formato -> (mimetype, extension)
+    'csv': ('text/csv', 'csv'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrow')
+    }
+
+@rutas.route('/exportar')
+def servir_exportacion():
+    """ 
+    Descarga en streaming de la tabla del panel: ?tema=&agreg=&col1=&col2=&est1=&est2=&formato=csv|parquet|arrow
+
+    El query corre y el primer bloque se lee antes de responder, asi un error de la base de datos es un 503
+    y no un 200 con un archivo cortado. Con postgres el resultado completo se copia primero a un archivo
+    temporal (ver filas_exportacion), por lo que la descarga empieza cuando termina la consulta; despues
+    el archivo se manda por bloques sin juntarlo en memoria.
+
+    Returns:
+        (obj) -> respuesta de flask que va mandando el archivo por bloques
+    """
+    a = flask.request.args
+    tabla = tabla_tema(a.get('tema', ''))
+    formato = a.get('formato', 'csv')
+    cols = [a.get('col1'), a.get('col2')]
+    ests = [a.get('est1', 'suma'), a.get('est2', 'suma')]
+
+    if tabla not in bds or a.get('agreg') not in agreg or formato not in FORMATOS_EXPORTACION \
+        or not all(c in catalogo.columnas(tabla) for c in cols) or not all(e in estad for e in ests):
+        flask.abort(400)
+
+    if formato != 'csv' and not hay_pyarrow(): # sin pyarrow solo hay CSV
+        flask.abort(501)
+
+    Q = exportar_query(esquema = esqu, datos = tabla, agreg = a['agreg'], col1_1 = cols[0], col1_2 = cols[1],
+                       estad1_1 = ests[0], estad1_2 = ests[1])
+
+    bloques = filas_exportacion(fuente, Q, tamano = int(os.getenv('EXPORT_BLOQUE', 5000)),
+                                tipos = tipos_exportacion(agreg = a['agreg'], col1_1 = cols[0], col1_2 = cols[1]))
+    try:
+        primero = next(bloques, None)
+    except Exception as error:
+        log.error('no se pudo exportar %s por %s: %s', tabla, a['agreg'], error)
+        flask.abort(503)
+    bloques = itertools.chain([] if primero is None else [primero], bloques)
+
+    cuerpo = exportar_csv(bloques) if formato == 'csv' else exportar_arrow(bloques, formato = formato)
+
+    mimetype, extension = FORMATOS_EXPORTACION[formato]
+
+    return flask.Response(cuerpo, mimetype = mimetype,
+                          headers = {'Content-Disposition': 'attachment; filename=data.{}'.format(extension)})
 
 # -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
 
+def iniciar_servicio():
+    """ 
+    Arranca los hilos que solo necesita el servidor: la precarga del catalogo (CATALOGO_PRECARGA=1) y el
+    vigilante de cambios (CAMBIOS_ESCUCHAR=1). Los comandos rollups, parquet y disparadores no los arrancan.
+    """
+    if precarga_catalogo:
+        def precargar():
+            try:
+                catalogo.cargar()
+            except Exception as error:
+                log.warning('no se pudo precargar el catalogo, se cargara en la primera consulta: %s', error)
+        threading.Thread(target = precargar, name = 'precarga-catalogo', daemon = True).start()
+
+    if vigilante is not None:
+        vigilante.iniciar()
+
+def crear_app(servicio = True):
+    """ 
+    Arma la app de Dash con el layout, los callbacks (registrados con dash.callback) y las rutas del servidor
+
+    No se conecta a la base de datos: el pool conecta en el primer prestamo y, con CATALOGO_PRECARGA=1, el
+    catalogo se carga en un hilo aparte para no retrasar el arranque.
+
+    Args:
+        servicio (bool) -> arranca los hilos del servidor, ver iniciar_servicio
+
+    Returns:
+        (obj) -> app de Dash; app.server es la app WSGI de flask que sirve gunicorn
+    """
+    t0 = time.perf_counter()
+
+    dash_app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP], background_callback_manager=manager_fondo)
+    dash_app.layout = layout
+    dash_app.server.register_blueprint(rutas)
+
+    if servicio:
+        iniciar_servicio()
+
+    arranque['app'] = time.perf_counter() - t0
+    return dash_app
+
+app = crear_app(servicio = __name__ != '__main__') # desde la linea de comandos se arrancan hasta saber si el comando es servir
+server = app.server # gunicorn app:server
+
+arranque['total'] = time.perf_counter() - T_ARRANQUE
+log.info('arranque en %.2f s: %s', arranque['total'], ', '.join('{} {:.3f} s'.format(k, v) for k, v in arranque.items() if k != 'total'))
+
 if __name__ == '__main__':
-    app.run(host = '0.0.0.0', port=8080 , debug=False)
+
+    parser = argparse.ArgumentParser(description = 'Dashboard de datos por agregacion')
+    comandos = parser.add_subparsers(dest = 'comando')
+
+    comandos.add_parser('servir', help = 'levanta el servidor del dashboard (default)')
+
+    c_rollups = comandos.add_parser('rollups', help = 'construye o refresca las tablas pre-agregadas')
+    c_rollups.add_argument('--tablas', default = ','.join(bds), help = 'tablas de datos separadas por comas')
+    c_rollups.add_argument('--agreg', default = ','.join(agreg), help = 'agregaciones separadas por comas')
+
+    c_parquet = comandos.add_parser('parquet', help = 'copia de postgres los archivos Parquet que lee BACKEND=duckdb')
+    c_parquet.add_argument('--dir', default = dir_duckdb, help = 'carpeta de salida')
+
+    c_disparadores = comandos.add_parser('disparadores', help = 'instala los disparadores que avisan por NOTIFY cuando cambia una tabla')
+    c_disparadores.add_argument('--tablas', default = ','.join(['manzanas'] + bds + agreg), help = 'tablas separadas por comas')
+
+    args = parser.parse_args()
+
+    if args.comando == 'rollups':
+        refrescar_rollups(pool, esquema = esqu, tablas = args.tablas.split(','), agregaciones = args.agreg.split(','))
+    elif args.comando == 'parquet':
+        catalogo_pg = CatalogoMetadatos(pool, bds, esquema = esqu) # las descripciones siempre se leen de postgres
+        volcar_parquet(pool, args.dir, esquema = esqu, tablas = ['manzanas'] + bds + agreg,
+                       descripciones = {t: {c: catalogo_pg.descripcion(t, c) for c in catalogo_pg.columnas(t)} for t in bds})
+    elif args.comando == 'disparadores':
+        with pool.conexion() as c:
+            with c.cursor() as cursor:
+                for tabla in args.tablas.split(','):
+                    cursor.execute(disparador_query(esquema = esqu, tabla = tabla))
+                    log.info('disparador instalado en %s.%s', esqu, tabla)
+            c.commit()
+    else:
+        iniciar_servicio()
+        app.run(host = '0.0.0.0', port=8080 , debug=False)
@@ -0,0 +1,84 @@
+// Callbacks del lado del cliente del dashboard.
+// Las filas de cada panel llegan una sola vez al dcc.Store cuando se genera el mapa (datos_grafica en app.py);
+// la seleccion de lazo/caja del mapa solo filtra esas filas y vuelve a dibujar las barras, sin ir al servidor.
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    dashboard: {
+
+        filtrar_grafica: function (seleccion, datos) {
+
+            if (!datos) {
+                return window.dash_clientside.no_update;
+            }
+
+            // ubicaciones seleccionadas en el mapa, si no hay seleccion se muestran todas las filas
+            var elegidas = null;
+            if (seleccion && seleccion.points && seleccion.points.length > 0) {
+                elegidas = new Set(seleccion.points.map(function (p) { return String(p.location); }));
+            }
+
+            var x = [], y = [], color = [], hover = [];
+            for (var i = 0; i < datos.loc.length; i++) {
+                if (elegidas === null || elegidas.has(String(datos.loc[i]))) {
+                    x.push(datos.x[i]);
+                    y.push(datos.ident[i]);
+                    color.push(datos.color[i]);
+                    hover.push(datos.hover[i]);
+                }
+            }
+
+            return {
+                data: [{
+                    type: 'bar',
+                    orientation: 'h',
+                    x: x,
+                    y: y,
+                    width: 0.75,
+                    hovertext: hover,
+                    hovertemplate: '%{hovertext}<extra></extra>',
+                    marker: {
+                        color: color,
+                        coloraxis: 'coloraxis'
+                    }
+                }],
+                layout: {
+                    width: 800,
+                    height: y.length * 50,
+                    margin: {r: 10, t: 10, l: 10, b: 10},
+                    barmode: 'stack',
+                    xaxis: {title: {text: datos.etiquetas.x}},
+                    yaxis: {title: {text: datos.etiquetas.y}, categoryorder: 'total ascending'},
+                    coloraxis: {
+                        colorscale: 'Plasma',
+                        colorbar: {title: {text: datos.etiquetas.color, side: 'right'}}
+                    }
+                }
+            };
+        },
+
+        // la descarga se hace directo de la ruta /exportar, que manda el archivo en streaming; se pide desde un
+        // iframe oculto para que un error de la ruta (400, 501, 503) no reemplace la pagina del dashboard
+        exportar: function (n, tema, est1, est2, agreg, col1, col2, formato) {
+
+            formato = formato || 'csv';
+            if (!n || !tema || !agreg || !col1 || !col2 || !est1 || !est2 || ['csv', 'parquet', 'arrow'].indexOf(formato) < 0) {
+                return window.dash_clientside.no_update;
+            }
+
+            var parametros = new URLSearchParams({
+                tema: tema, agreg: agreg, col1: col1, col2: col2, est1: est1, est2: est2, formato: formato
+            });
+
+            var marco = document.getElementById('marco-exportar');
+            if (!marco) {
+                marco = document.createElement('iframe');
+                marco.id = 'marco-exportar';
+                marco.style.display = 'none';
+                document.body.appendChild(marco);
+            }
+            marco.src = 'exportar?' + parametros.toString();
+
+            return window.dash_clientside.no_update;
+        }
+    }
+});
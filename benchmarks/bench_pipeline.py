@@ -0,0 +1,396 @@
+# Micro-benchmarks del pipeline de los mapas sin base de datos
+#
+# Una conexion falsa contesta las consultas del catalogo, el COPY de la tabla agregada y la capa de geometrias
+# con datos sinteticos de N poligonos, asi cada etapa pasa por el mismo codigo que en produccion:
+#
+#   query    -> map_query_constructor / cubo_query_constructor armados y convertidos a texto
+#   fetch    -> agregados() y la capa de geometrias con los caches vacios (COPY + lector CSV, read_postgis, simplificacion)
+#   union    -> unir_capa() de la capa con la tabla agregada
+#   figura   -> mapa() con los caches llenos, sin contar la union
+#   json     -> serializacion de la figura y de los datos de la grafica
+#   grafica  -> datos_grafica(), las filas con las que el navegador arma las barras (assets/graficas.js)
+#   panel    -> figura_panel() con cache_figuras vacio, el cuerpo completo del callback de mapas con los datos en cache
+#
+# Cada corrida mide tambien una carga fija de calibracion (pandas, numpy y json) y guarda cada etapa como razon
+# contra ella ('relativo'). La comparacion usa esas razones, asi la linea base sirve en otra maquina; los
+# segundos absolutos solo se imprimen como referencia.
+#
+# Uso:
+#   python benchmarks/bench_pipeline.py                              compara contra benchmarks/baseline.json
+#   python benchmarks/bench_pipeline.py --tamanos 100 1000 100000 --repeticiones 5
+#   python benchmarks/bench_pipeline.py --sin-memoria                solo tiempos, sin la corrida con tracemalloc
+#
+# La linea base se regenera, con los tamanos por defecto, despues de un cambio que la mueva a proposito:
+#   python benchmarks/bench_pipeline.py --guardar
+#
+# Sale con codigo 1 si alguna etapa es mas lenta que la linea base por encima de --tolerancia.
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import contextlib
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+import shapely
+from psycopg2 import sql, extensions
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.chdir(RAIZ) # app.py lee .env del directorio del proyecto
+
+import app # noqa: E402
+
+BASELINE = os.path.join(RAIZ, 'benchmarks', 'baseline.json')
+
+TABLA = 'caracteristicas_poblacionales'
+AGREG = 'sectores'
+COLUMNAS = ['POB1', 'POB2', 'POB3', 'POB4']
+
+warnings.filterwarnings('ignore', message = 'pandas only supports SQLAlchemy') # read_sql con la conexion falsa
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# conexion falsa
+
+def citar_identificador(s, contexto):
+    # psycopg2 cita los identificadores con libpq y necesita una conexion real
+    return '"{}"'.format(s.replace('"', '""'))
+
+def citar_literal(self, contexto):
+    return extensions.adapt(self._wrapped).getquoted().decode('utf-8')
+
+sql.ext.quote_ident = citar_identificador
+sql.Literal.as_string = citar_literal
+
+class Datos:
+    """
+    Capa y cubo sinteticos de n poligonos en una reticula de cuadros
+
+    Args:
+        n (int) -> numero de poligonos de la agregacion
+        semilla (int) -> semilla de los valores aleatorios
+    """
+
+    def __init__(self, n, semilla = 0):
+        rng = np.random.default_rng(semilla)
+        lado = int(np.ceil(np.sqrt(n)))
+        i = np.arange(n)
+        x0 = -117.1 + (i % lado) * (0.3 / lado)
+        y0 = 32.35 + (i // lado) * (0.3 / lado)
+        paso = 0.3 / lado
+
+        cajas = shapely.box(x0, y0, x0 + paso, y0 + paso)
+        self.geometrias = pd.DataFrame({
+            'id': i,
+            'ident': ['{} {}'.format(AGREG, k) for k in i],
+            'geom': shapely.to_wkb(cajas, hex = True, include_srid = False)
+            })
+
+        cubo = {AGREG: i, AGREG + '_cont': rng.integers(1, 200, n)}
+        for col in COLUMNAS:
+            base = rng.integers(0, 5000, n).astype('float64')
+            cubo[col + '__suma'] = base
+            cubo[col + '__prom'] = base / cubo[AGREG + '_cont']
+            cubo[col + '__conteo'] = cubo[AGREG + '_cont']
+        self.cubo_csv = pd.DataFrame(cubo).to_csv(index = False).encode('utf-8')
+
+class Cursor:
+    # contesta por el texto de la consulta lo que necesitan el catalogo, el COPY y read_postgis
+
+    def __init__(self, datos):
+        self.datos = datos
+        self.description = None
+        self._filas = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def _responder(self, q):
+        # (columnas, filas) de la consulta, o None si es la del cubo
+        if 'pg_description' in q:
+            return ['col', 'description'], [(c, 'descripcion de ' + c) for c in COLUMNAS]
+        if "LIKE 'rollup" in q:
+            return ['table_name', 'column_name'], []
+        if 'information_schema.columns' in q:
+            return ['column_name'], [(c,) for c in COLUMNAS]
+        if 'GROUP BY' in q:
+            return None
+        if 'FROM "{}"."{}"'.format(app.esqu, AGREG) in q:
+            g = self.datos.geometrias
+            return list(g.columns), list(g.itertuples(index = False, name = None))
+        raise ValueError('consulta no prevista en la conexion falsa: ' + q[:120])
+
+    def execute(self, q, parametros = None):
+        columnas, self._filas = self._responder(q if isinstance(q, str) else q.as_string(None))
+        self.description = [(c, None, None, None, None, None, None) for c in columnas]
+
+    def fetchall(self):
+        return self._filas
+
+    def copy_expert(self, q, destino):
+        r = self._responder(q)
+        if r is None:
+            destino.write(self.datos.cubo_csv)
+        else:
+            destino.write(pd.DataFrame(r[1], columns = r[0]).to_csv(index = False).encode('utf-8'))
+
+class Conexion:
+    def __init__(self, datos):
+        self.datos = datos
+
+    def cursor(self, *args, **kwargs):
+        return Cursor(self.datos)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class PoolFalso:
+    # misma interfaz que PoolConexiones para las funciones del pipeline
+    def __init__(self, datos):
+        self.datos = datos
+
+    @contextlib.contextmanager
+    def conexion(self):
+        yield Conexion(self.datos)
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# etapas
+
+def vaciar_caches():
+    app.cache_agregados.invalidar(TABLA)
+    app.cache_figuras.invalidar(TABLA)
+    app.cache_geo.invalidar()
+
+def preparar(n):
+    """
+    Conecta la app a la conexion falsa con n poligonos y carga su catalogo
+
+    Returns:
+        (obj) -> pool falso
+    """
+    pool = PoolFalso(Datos(n))
+    app.catalogo.conn = pool
+    app.catalogo.tablas = [TABLA]
+    app.catalogo.cargar()
+    app.geojson_url = True
+    vaciar_caches()
+    return pool
+
+def etapas(pool):
+    """
+    Corre una vez cada etapa del pipeline
+
+    Returns:
+        (dic) -> segundos por etapa
+    """
+    args = dict(datos = TABLA, agreg1 = AGREG, col1_1 = 'POB1', col1_2 = 'POB2', estad1_1 = 'suma', estad1_2 = 'prom')
+    t = {}
+
+    t0 = time.perf_counter()
+    str(app.map_query_constructor(esquema = app.esqu, datos = TABLA, agreg = AGREG).as_string(None))
+    str(app.cubo_query_constructor(esquema = app.esqu, datos = TABLA, agreg = AGREG, columnas = COLUMNAS).as_string(None))
+    t['query'] = time.perf_counter() - t0
+
+    vaciar_caches()
+    t0 = time.perf_counter()
+    df1 = app.agregados(pool, esquema = app.esqu, datos = TABLA, agreg = AGREG, col1_1 = 'POB1', col1_2 = 'POB2',
+                        estad1_1 = 'suma', estad1_2 = 'prom')
+    gdf1 = app.cache_geo.obtener(pool, agreg = AGREG, esquema = app.esqu, nivel = 'panel')
+    t['fetch'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    app.unir_capa(gdf1, df1, AGREG)
+    t['union'] = time.perf_counter() - t0
+
+    union = [0.0] # tiempo de la union dentro de mapa(), se descuenta de la figura
+    unir = app.unir_capa
+    def unir_medido(*a, **k):
+        t1 = time.perf_counter()
+        r = unir(*a, **k)
+        union[0] += time.perf_counter() - t1
+        return r
+    app.unir_capa = unir_medido
+    try:
+        t0 = time.perf_counter()
+        fig, un1 = app.mapa(pool, esquema = app.esqu, nivel = 'panel', **args)
+        t['figura'] = time.perf_counter() - t0 - union[0]
+    finally:
+        app.unir_capa = unir
+
+    t0 = time.perf_counter()
+    fig.to_json()
+    json.dumps(app.datos_grafica(un1, **args))
+    t['json'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    app.datos_grafica(un1, **args)
+    t['grafica'] = time.perf_counter() - t0
+
+    app.cache_figuras.invalidar(TABLA)
+    t0 = time.perf_counter()
+    app.figura_panel(pool, esquema = app.esqu, **args)
+    t['panel'] = time.perf_counter() - t0
+
+    return t
+
+def medir(n, repeticiones, memoria = True):
+    """
+    Mediana de tiempo de cada etapa en varias corridas y, aparte, memoria pico de cada etapa con tracemalloc
+
+    Returns:
+        (dic) -> etapa -> {'segundos', 'pico_mb'}
+    """
+    pool = preparar(n)
+
+    etapas(pool) # calentamiento: imports perezosos y caches internos de plotly y pandas
+    corridas = [etapas(pool) for _ in range(repeticiones)]
+    resultado = {e: {'segundos': float(np.median([c[e] for c in corridas]))} for e in corridas[0]}
+
+    if memoria: # en una corrida aparte porque tracemalloc hace mucho mas lenta cada asignacion
+        for e, pico in picos(pool).items():
+            resultado[e]['pico_mb'] = round(pico / 1024 ** 2, 2)
+
+    return resultado
+
+def picos(pool):
+    """
+    Corre el pipeline una vez con tracemalloc
+
+    Returns:
+        (dic) -> bytes pico asignados durante cada etapa, sobre lo que ya estaba asignado al empezarla
+    """
+    args = dict(datos = TABLA, agreg1 = AGREG, col1_1 = 'POB1', col1_2 = 'POB2', estad1_1 = 'suma', estad1_2 = 'prom')
+    p = {}
+
+    def pico(etapa, funcion):
+        tracemalloc.reset_peak()
+        inicio = tracemalloc.get_traced_memory()[0]
+        r = funcion()
+        p[etapa] = tracemalloc.get_traced_memory()[1] - inicio
+        return r
+
+    vaciar_caches()
+    tracemalloc.start()
+    try:
+        pico('query', lambda: app.map_query_constructor(esquema = app.esqu, datos = TABLA, agreg = AGREG).as_string(None))
+        df1, gdf1 = pico('fetch', lambda: (app.agregados(pool, esquema = app.esqu, datos = TABLA, agreg = AGREG, col1_1 = 'POB1',
+                                                          col1_2 = 'POB2', estad1_1 = 'suma', estad1_2 = 'prom'),
+                                            app.cache_geo.obtener(pool, agreg = AGREG, esquema = app.esqu, nivel = 'panel')))
+        pico('union', lambda: app.unir_capa(gdf1, df1, AGREG))
+        fig, un1 = pico('figura', lambda: app.mapa(pool, esquema = app.esqu, nivel = 'panel', **args))
+        pico('json', lambda: (fig.to_json(), json.dumps(app.datos_grafica(un1, **args))))
+        pico('grafica', lambda: app.datos_grafica(un1, **args))
+        app.cache_figuras.invalidar(TABLA)
+        pico('panel', lambda: app.figura_panel(pool, esquema = app.esqu, **args))
+    finally:
+        tracemalloc.stop()
+
+    return p
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------------------------
+
+def calibrar(repeticiones = 5):
+    """
+    Mediana de tiempo de una carga fija, sin la app, que escala con la maquina como las etapas del pipeline
+
+    Returns:
+        (float) -> segundos
+    """
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({'clave': rng.integers(0, 1000, 200000), 'valor': rng.random(200000)})
+
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        g = df.groupby('clave')['valor'].agg(['sum', 'mean', 'count'])
+        df.to_csv(index = False)
+        json.dumps(g.reset_index().to_dict('records'))
+        tiempos.append(time.perf_counter() - t0)
+
+    return float(np.median(tiempos))
+
+def maquina():
+    return {'python': platform.python_version(), 'plataforma': platform.platform(), 'cpus': os.cpu_count(),
+            'pandas': pd.__version__, 'shapely': shapely.__version__}
+
+def comparar(actual, base, tolerancia):
+    """
+    Imprime la razon contra la linea base de cada etapa, con los tiempos relativos a la calibracion
+
+    Returns:
+        (list) -> etapas mas lentas que la linea base por encima de la tolerancia
+    """
+    escala = actual['calibracion'] # segundos de esta maquina por unidad relativa
+    lentas = []
+    for n, etapas_n in actual['resultados'].items():
+        for e, m in etapas_n.items():
+            b = base['resultados'].get(n, {}).get(e)
+            if not b or 'relativo' not in b:
+                continue
+            razon = m['relativo'] / b['relativo'] if b['relativo'] else float('inf')
+            marca = ''
+            if razon > 1 + tolerancia and (m['relativo'] - b['relativo']) * escala > 0.001: # se ignoran diferencias menores a 1 ms
+                marca = '  <-- regresion'
+                lentas.append((n, e))
+            print('{:>8} {:<8} {:>10.4f} s  base {:>10.4f} s  x{:.2f}{}'.format(n, e, m['segundos'], b['relativo'] * escala, razon, marca))
+    return lentas
+
+def main():
+    parser = argparse.ArgumentParser(description = 'benchmarks del pipeline de mapas con una conexion falsa')
+    parser.add_argument('--tamanos', type = int, nargs = '+', default = [100, 1000, 10000, 100000], help = 'numero de poligonos')
+    parser.add_argument('--repeticiones', type = int, default = 3)
+    parser.add_argument('--guardar', action = 'store_true', help = 'guarda la corrida como linea base')
+    parser.add_argument('--sin-memoria', action = 'store_true', help = 'no mide la memoria pico (la corrida con tracemalloc es lenta)')
+    parser.add_argument('--tolerancia', type = float, default = 0.25, help = 'fraccion de lentitud aceptada contra la linea base')
+    parser.add_argument('--base', default = BASELINE)
+    a = parser.parse_args()
+
+    actual = {'maquina': maquina(), 'calibracion': calibrar(), 'resultados': {}}
+    print('calibracion {:.4f} s'.format(actual['calibracion']), flush = True)
+
+    for n in a.tamanos:
+        actual['resultados'][str(n)] = medir(n, a.repeticiones, memoria = not a.sin_memoria)
+        for e, m in actual['resultados'][str(n)].items():
+            m['relativo'] = m['segundos'] / actual['calibracion']
+            print('{:>8} {:<8} {:>10.4f} s {:>10} MB'.format(n, e, m['segundos'], m.get('pico_mb', '-')), flush = True)
+
+    if a.guardar: # sin los segundos absolutos, que solo valen para esta maquina
+        guardar = dict(actual, resultados = {n: {e: {k: v for k, v in m.items() if k != 'segundos'} for e, m in etapas_n.items()}
+                                             for n, etapas_n in actual['resultados'].items()})
+        with open(a.base, 'w') as f:
+            json.dump(guardar, f, indent = 2)
+        print('linea base guardada en', a.base)
+        return 0
+
+    if not os.path.exists(a.base):
+        print('no hay linea base, correr con --guardar')
+        return 0
+
+    with open(a.base) as f:
+        base = json.load(f)
+    if 'calibracion' not in base:
+        print('la linea base no tiene calibracion, regenerarla con --guardar')
+        return 0
+    if base.get('maquina') != actual['maquina']:
+        print('aviso: la linea base se tomo en otra maquina o con otras versiones, se comparan tiempos relativos:', base.get('maquina'))
+
+    print()
+    lentas = comparar(actual, base, a.tolerancia)
+    return 1 if lentas else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
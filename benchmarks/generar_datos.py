@@ -0,0 +1,269 @@
+# Generador del esquema de Dashboards con datos sinteticos, para pruebas de carga sin copiar datos de produccion
+#
+# Crea en un PostgreSQL/PostGIS local las tablas que espera app.py, con los nombres de .env (esqu, bds, agreg):
+#
+#   manzanas          -> cvegeo, una columna por agregacion con el id del poligono que la contiene y geom
+#   tablas de datos   -> cvegeo y columnas enteras en mayusculas (POB1, POB2, ... / ECO1, ...) con COMMENT ON COLUMN
+#   capas             -> una por agregacion con id, ident y geom, reticulas cada vez mas gruesas sobre las manzanas
+#
+# Las manzanas son cuadros de una reticula sobre la Ciudad de Mexico y cada capa es una reticula mas gruesa, asi
+# cada manzana cae en exactamente un poligono de cada agregacion y los mapas se ven como los reales.
+#
+# Uso:
+#   python benchmarks/generar_datos.py --factor 1                  10 000 manzanas (usa HOST, DATABASE, USER y PASSWORD de .env)
+#   python benchmarks/generar_datos.py --factor 100 --reemplazar   1 000 000 manzanas, borra antes las tablas existentes
+#   python benchmarks/generar_datos.py --factor 10 --dsn "host=localhost dbname=dashboards user=postgres"
+#
+# Despues se pueden construir las tablas pre-agregadas con 'python app.py rollups' o copiar el esquema a Parquet
+# para BACKEND=duckdb con 'python app.py parquet'.
+
+import os
+import io
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+import shapely
+import psycopg2
+from psycopg2 import sql
+from dotenv import load_dotenv
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MANZANAS = 10000 # manzanas con factor 1
+BLOQUE = 100000 # filas por COPY, acota la memoria con factores grandes
+CAJA = (-99.36, 19.18, -98.94, 19.59) # lon/lat minimos y maximos de la reticula
+
+MANZANAS_POR_POLIGONO = { # tamano promedio de cada agregacion, las que no estan usan DEFAULT_POR_POLIGONO
+    'delegaciones': 1000,
+    'colonias': 40,
+    'sectores': 100,
+    'subsectores': 20
+    }
+DEFAULT_POR_POLIGONO = 100
+
+def conectar(args):
+    """
+    Args:
+        args (obj) -> argumentos de la linea de comandos
+
+    Returns:
+        (obj) -> coneccion a base de datos
+    """
+    if args.dsn:
+        return psycopg2.connect(args.dsn)
+    return psycopg2.connect(host = os.getenv('HOST'), database = os.getenv('DATABASE'), user = os.getenv('USER'), password = os.getenv('PASSWORD'))
+
+def lado_reticula(n):
+    """
+    Args:
+        n (int) -> numero aproximado de celdas
+
+    Returns:
+        (int) -> celdas por lado de una reticula cuadrada con al menos n celdas
+    """
+    return max(1, int(np.ceil(np.sqrt(n))))
+
+def prefijo(tabla):
+    """
+    Args:
+        tabla (str) -> nombre de la tabla de datos, p. ej. 'caracteristicas_poblacionales'
+
+    Returns:
+        (str) -> prefijo de sus columnas, p. ej. 'POB'
+    """
+    return tabla.split('_')[-1][0:3].upper()
+
+def copiar(c, esquema, tabla, df):
+    """
+    Carga un DataFrame con COPY ... FROM STDIN en CSV
+
+    Args:
+        c (obj) -> coneccion a base de datos
+        esquema (str) -> string con el nombre del esquema
+        tabla (str) -> nombre de la tabla
+        df (obj) -> DataFrame con las columnas en el orden de la tabla, la geometria en EWKB hexadecimal
+    """
+    buf = io.StringIO()
+    df.to_csv(buf, index = False, header = False)
+    buf.seek(0)
+
+    q = sql.SQL('COPY {}.{} ({}) FROM STDIN WITH (FORMAT csv)').format(
+        sql.Identifier(esquema), sql.Identifier(tabla), sql.SQL(', ').join(map(sql.Identifier, df.columns)))
+    with c.cursor() as cursor:
+        cursor.copy_expert(q.as_string(c), buf)
+
+def ewkb(geometrias):
+    """
+    Args:
+        geometrias (obj) -> arreglo de geometrias de shapely en EPSG:4326
+
+    Returns:
+        (obj) -> arreglo de EWKB hexadecimal con SRID 4326, el formato de texto de las columnas geometry
+    """
+    return shapely.to_wkb(shapely.set_srid(geometrias, 4326), hex = True, include_srid = True)
+
+def crear_tablas(c, esquema, bds, agreg, columnas, reemplazar = False):
+    """
+    Crea el esquema y las tablas vacias, con comentarios en las columnas de datos
+
+    Args:
+        c (obj) -> coneccion a base de datos
+        esquema (str) -> string con el nombre del esquema
+        bds (list) -> tablas de datos
+        agreg (list) -> agregaciones
+        columnas (int) -> columnas de datos por tabla
+        reemplazar (bool) -> si es True borra antes las tablas que ya existan
+    """
+    esq = sql.Identifier(esquema)
+
+    with c.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS postgis')
+        cursor.execute(sql.SQL('CREATE SCHEMA IF NOT EXISTS {}').format(esq))
+
+        if reemplazar:
+            for tabla in ['manzanas'] + bds + agreg:
+                cursor.execute(sql.SQL('DROP TABLE IF EXISTS {}.{} CASCADE').format(esq, sql.Identifier(tabla)))
+
+        for ag in agreg:
+            cursor.execute(sql.SQL('CREATE TABLE {}.{} (id integer PRIMARY KEY, ident text NOT NULL, geom geometry(Polygon, 4326) NOT NULL)').format(
+                esq, sql.Identifier(ag)))
+
+        cursor.execute(sql.SQL('CREATE TABLE {}.manzanas (cvegeo text PRIMARY KEY, {}, geom geometry(Polygon, 4326) NOT NULL)').format(
+            esq, sql.SQL(', ').join(sql.SQL('{} integer NOT NULL').format(sql.Identifier(ag)) for ag in agreg)))
+
+        for tabla in bds:
+            p = prefijo(tabla)
+            cursor.execute(sql.SQL('CREATE TABLE {}.{} (cvegeo text PRIMARY KEY, {})').format(
+                esq, sql.Identifier(tabla), sql.SQL(', ').join(sql.SQL('{} integer').format(sql.Identifier(p + str(k))) for k in range(1, columnas + 1))))
+
+            cursor.execute(sql.SQL('COMMENT ON TABLE {}.{} IS {}').format(esq, sql.Identifier(tabla), sql.Literal('Datos sinteticos de ' + tabla)))
+            for k in range(1, columnas + 1):
+                cursor.execute(sql.SQL('COMMENT ON COLUMN {}.{}.{} IS {}').format(
+                    esq, sql.Identifier(tabla), sql.Identifier(p + str(k)), sql.Literal('Variable {} de {}'.format(k, tabla.replace('_', ' ')))))
+
+    c.commit()
+
+def llenar_capas(c, esquema, agreg, n):
+    """
+    Args:
+        c (obj) -> coneccion a base de datos
+        esquema (str) -> string con el nombre del esquema
+        agreg (list) -> agregaciones
+        n (int) -> numero de manzanas
+
+    Returns:
+        (dic) -> agregacion -> celdas por lado de su reticula
+    """
+    lados = {}
+    x0, y0, x1, y1 = CAJA
+
+    for ag in agreg:
+        lado = lado_reticula(n / MANZANAS_POR_POLIGONO.get(ag, DEFAULT_POR_POLIGONO))
+        i = np.arange(lado * lado)
+        ancho, alto = (x1 - x0) / lado, (y1 - y0) / lado
+        cx, cy = x0 + (i % lado) * ancho, y0 + (i // lado) * alto
+
+        copiar(c, esquema, ag, pd.DataFrame({
+            'id': i,
+            'ident': ['{} {}'.format(ag, k) for k in i],
+            'geom': ewkb(shapely.box(cx, cy, cx + ancho, cy + alto))
+            }))
+        lados[ag] = lado
+
+    c.commit()
+    return lados
+
+def llenar_manzanas(c, esquema, bds, lados, n, columnas, rng):
+    """
+    Carga las manzanas y las tablas de datos por bloques de BLOQUE filas
+
+    Args:
+        c (obj) -> coneccion a base de datos
+        esquema (str) -> string con el nombre del esquema
+        bds (list) -> tablas de datos
+        lados (dic) -> agregacion -> celdas por lado de su reticula (ver llenar_capas)
+        n (int) -> numero de manzanas
+        columnas (int) -> columnas de datos por tabla
+        rng (obj) -> generador de numeros aleatorios de numpy
+    """
+    lado = lado_reticula(n)
+    x0, y0, x1, y1 = CAJA
+    ancho, alto = (x1 - x0) / lado, (y1 - y0) / lado
+
+    for inicio in range(0, n, BLOQUE):
+        i = np.arange(inicio, min(n, inicio + BLOQUE))
+        fx, fy = (i % lado) / lado, (i // lado) / lado # esquina de la manzana relativa a la caja, de 0 a 1
+        cvegeo = pd.Series(i).map('{:016d}'.format)
+
+        manzanas = {'cvegeo': cvegeo}
+        for ag, l in lados.items(): # celda que contiene el centro de la manzana, con aritmetica entera para no caer en el vecino
+            manzanas[ag] = ((2 * (i // lado) + 1) * l // (2 * lado)) * l + (2 * (i % lado) + 1) * l // (2 * lado)
+        cx, cy = x0 + fx * (x1 - x0), y0 + fy * (y1 - y0)
+        manzanas['geom'] = ewkb(shapely.box(cx + ancho * 0.1, cy + alto * 0.1, cx + ancho * 0.9, cy + alto * 0.9)) # con calles entre manzanas
+        copiar(c, esquema, 'manzanas', pd.DataFrame(manzanas))
+
+        for tabla in bds:
+            p = prefijo(tabla)
+            datos = {'cvegeo': cvegeo}
+            for k in range(1, columnas + 1):
+                v = pd.Series(rng.poisson(rng.uniform(5, 500), len(i)), dtype = 'Int64')
+                datos[p + str(k)] = v.mask(rng.random(len(i)) < 0.02) # algunos nulos, como en los datos reales
+            copiar(c, esquema, tabla, pd.DataFrame(datos))
+
+        c.commit()
+        print('  {} / {} manzanas'.format(i[-1] + 1, n))
+
+def indexar(c, esquema, bds, agreg):
+    """
+    Args:
+        c (obj) -> coneccion a base de datos
+        esquema (str) -> string con el nombre del esquema
+        bds (list) -> tablas de datos
+        agreg (list) -> agregaciones
+    """
+    esq = sql.Identifier(esquema)
+
+    with c.cursor() as cursor:
+        cursor.execute(sql.SQL('CREATE INDEX ON {}.manzanas USING gist (geom)').format(esq))
+        for ag in agreg:
+            cursor.execute(sql.SQL('CREATE INDEX ON {}.manzanas ({})').format(esq, sql.Identifier(ag)))
+            cursor.execute(sql.SQL('CREATE INDEX ON {}.{} USING gist (geom)').format(esq, sql.Identifier(ag)))
+    c.commit()
+
+    c.autocommit = True # ANALYZE fuera de transaccion para que el planeador vea las tablas nuevas
+    with c.cursor() as cursor:
+        for tabla in ['manzanas'] + bds + agreg:
+            cursor.execute(sql.SQL('ANALYZE {}.{}').format(esq, sql.Identifier(tabla)))
+    c.autocommit = False
+
+if __name__ == '__main__':
+
+    load_dotenv(os.path.join(RAIZ, '.env'))
+
+    parser = argparse.ArgumentParser(description = 'Genera el esquema de Dashboards con datos sinteticos en PostgreSQL/PostGIS')
+    parser.add_argument('--factor', type = int, default = 1, help = 'multiplo de {} manzanas (1, 10, 100, ...)'.format(MANZANAS))
+    parser.add_argument('--columnas', type = int, default = 12, help = 'columnas de datos por tabla')
+    parser.add_argument('--semilla', type = int, default = 0, help = 'semilla de los valores aleatorios')
+    parser.add_argument('--dsn', default = None, help = 'cadena de conexion de libpq, por defecto se usan HOST, DATABASE, USER y PASSWORD')
+    parser.add_argument('--reemplazar', action = 'store_true', help = 'borra antes las tablas del esquema que ya existan')
+    args = parser.parse_args()
+
+    esquema = os.getenv('esqu', 'Dashboards')
+    bds = os.getenv('bds', 'caracteristicas_poblacionales,caracteristicas_economicas').split(',')
+    agreg = os.getenv('agreg', 'colonias,delegaciones,sectores,subsectores').split(',')
+    n = MANZANAS * args.factor
+
+    t0 = time.perf_counter()
+    c = conectar(args)
+    try:
+        crear_tablas(c, esquema, bds, agreg, args.columnas, reemplazar = args.reemplazar)
+        lados = llenar_capas(c, esquema, agreg, n)
+        print('capas: {}'.format({ag: l * l for ag, l in lados.items()}))
+        llenar_manzanas(c, esquema, bds, lados, n, args.columnas, np.random.default_rng(args.semilla))
+        indexar(c, esquema, bds, agreg)
+    finally:
+        c.close()
+
+    print('esquema {} con {} manzanas listo en {:.1f} s'.format(esquema, n, time.perf_counter() - t0))